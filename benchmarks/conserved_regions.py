@@ -0,0 +1,189 @@
+"""Benchmark of the conserved region search used by the hybrid and conserved
+HMM modes, comparing the current implementation with the previous quadratic
+scan and greedy overlap removal. Sequences with many short blocks of
+conserved positions are timed as well, where every block starts a search.
+Run from the repository root:
+
+    python benchmarks/conserved_regions.py --lengths 1800 5000 10000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from mqr_db.make_hmms import find_conserved_hits, remove_overlaps  # noqa
+
+
+def legacy_conserved_hits(sequence, look_ahead, min_length, max_gaps):
+    """Previous region search, restarting the scan from every position.
+    """
+    hits = {}
+
+    for i in range(len(sequence)-min_length+1):
+        curr_seq = sequence[i:]
+        start = i
+        end = 0
+        curr_len = 0
+        local_gaps = 0
+        curr_gap = 0
+        score_cutoff = 10
+        score = 0
+        last_gap = 0
+        if curr_seq[0] != "x":
+            for j in range(len(curr_seq)):
+                nt = curr_seq[j]
+                if nt == "x":
+                    curr_gap += 1
+                    score -= curr_gap * local_gaps
+                else:
+                    score += 1
+                    if curr_gap > 0:
+                        local_gaps += 1
+                        last_gap = curr_gap
+                        curr_gap = 0
+                curr_len += 1
+
+                if curr_gap > look_ahead:
+                    end = start + j - (look_ahead + 1)
+                    break
+
+                if local_gaps > max_gaps:
+                    end = start + j - (last_gap + 1)
+                    break
+
+            if end == 0:
+                end = start + (len(curr_seq)-1)
+
+            if curr_len >= min_length and score >= score_cutoff:
+                hits[(start, end)] = score
+
+    return hits
+
+
+def legacy_remove_overlaps(conserved_dictionary):
+    """Previous overlap removal, greedily adding the highest scoring regions.
+    """
+    conserved_regions = []
+    sorted_hits = dict(sorted(
+        conserved_dictionary.items(),
+        key=lambda item: item[1],
+        reverse=True
+        ))
+
+    for hit in sorted_hits:
+        found = False
+        for cr in conserved_regions:
+            if (
+                hit[0] >= cr[0] and hit[0] <= cr[1]
+                or hit[1] >= cr[0] and hit[1] <= cr[1]
+            ):
+                found = True
+                break
+
+        if not found:
+            conserved_regions.append([hit[0], hit[1]])
+
+    return sorted(conserved_regions)
+
+
+def make_conservation_sequence(length, seed):
+    """Makes a conservation sequence resembling an SSU alignment, long
+    conserved stretches broken by short and long unconserved stretches.
+    """
+    rand = random.Random(seed)
+    sequence = []
+    while len(sequence) < length:
+        sequence.append("a" * rand.randint(5, 120))
+        if rand.random() < 0.8:
+            sequence.append("x" * rand.randint(1, 3))
+        else:
+            sequence.append("x" * rand.randint(5, 40))
+
+    return "".join(sequence)[:length]
+
+
+def make_short_block_sequence(length, seed):
+    """Makes a conservation sequence of short conserved blocks separated by
+    single unconserved positions, the worst case for the number of blocks.
+    """
+    rand = random.Random(seed)
+    sequence = []
+    while len(sequence) < length:
+        sequence.append("a" * rand.randint(1, 4))
+        sequence.append("x")
+
+    return "".join(sequence)[:length]
+
+
+def total_score(regions, hits):
+    """Returns the summed score of the selected regions.
+    """
+    return sum(hits[(start, end)] for start, end in regions)
+
+
+def time_call(func, *args):
+    """Returns the result and the wall time of a call.
+    """
+    start_time = time.perf_counter()
+    result = func(*args)
+
+    return result, time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--lengths', type=int, nargs='+',
+                        default=[1800, 5000, 10000])
+    parser.add_argument('--short_block_lengths', type=int, nargs='+',
+                        default=[20000, 80000])
+    parser.add_argument('--look_ahead', type=int, default=4)
+    parser.add_argument('--min_length', type=int, default=20)
+    parser.add_argument('--max_gaps', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    params = (args.look_ahead, args.min_length, args.max_gaps)
+
+    runs = [
+        ("ssu", length, make_conservation_sequence)
+        for length in args.lengths
+    ] + [
+        ("short_blocks", length, make_short_block_sequence)
+        for length in args.short_block_lengths
+    ]
+
+    print("sequence\tlength\thits\tlegacy_s\tcurrent_s\tspeedup\t"
+          "legacy_score\tcurrent_score")
+    for kind, length, make_sequence in runs:
+        sequence = make_sequence(length, args.seed)
+
+        old_hits, old_time = time_call(
+            legacy_conserved_hits, sequence, *params
+        )
+        old_regions, tmp_time = time_call(legacy_remove_overlaps, old_hits)
+        old_time += tmp_time
+
+        new_hits, new_time = time_call(find_conserved_hits, sequence, *params)
+        new_regions, tmp_time = time_call(remove_overlaps, new_hits)
+        new_time += tmp_time
+
+        if new_hits != old_hits:
+            quit(f"Candidate regions differ for {kind} at length {length}")
+
+        print("{}\t{}\t{}\t{:.3f}\t{:.3f}\t{:.1f}x\t{}\t{}".format(
+            kind,
+            length,
+            len(new_hits),
+            old_time,
+            new_time,
+            old_time / max(new_time, 1e-9),
+            total_score(old_regions, old_hits),
+            total_score(new_regions, new_hits)
+        ))
+
+
+if __name__ == "__main__":
+    main()
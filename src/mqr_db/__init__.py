@@ -14,7 +14,6 @@ from .clustering import cluster_vs
 from .cross_validation import cross_validation
 
 from .handling import float_to_str_id
-from .handling import format_file
 from .handling import check_dir
 from .handling import check_installation
 from .handling import check_qc
@@ -29,7 +28,6 @@ from .handling import print_updates
 from .handling import return_init_path
 from .handling import return_proj_path
 from .handling import return_removed_path
-from .handling import sep_tax
 from .handling import sequence_quality_check
 from .handling import tax_list_to_str
 
@@ -37,3 +35,6 @@ from .make_db import make_db
 from .make_db import get_deleted_clusters
 
 from .make_hmms import make_hmms
+
+from .manifest import read_manifest
+from .manifest import run_stage
@@ -4,16 +4,31 @@ Searching function in vsearch to compare to a finished MetaxaQR database. Any
 hits that matches old entries at below 100% sequence identity are added to the
 database. The database is backed up in '_old' files.
 """
-import subprocess
 import math
+import os
+import pickle
 import shutil
 from pathlib import Path
-from .handling import return_proj_path
-
-
-def add_entries(entries_file, run_label, cpu):
+from .handling import return_proj_path, check_file, input_records
+from .handling import piped_input
+from .clustering import run_vsearch
+from .compression import compression_of, copy_db_file, open_append
+from .compression import open_text, resolve_db_file, read_index
+from .compression import read_records
+from .fasta import fasta_records, wrap_sequence, FastaWriter
+from .label_tree import append_tree_lines, check_bin_tree, load_label_tree
+from .label_tree import return_bin_file
+from .telemetry import span, add_count
+
+
+def add_entries(entries_file, run_label, cpu, keep_index=False, format=""):
     """Main function that takes input fasta file + MQR db, uses vsearch and
-    finally writes the new entries to the finished databases
+    finally writes the new entries to the finished databases. The database is
+    indexed once for all entries, keep_index stores the index next to
+    mqr.fasta to be reused by the next run. The input file can be compressed
+    or in another format, converted while it is read. A compressed database
+    is appended to in new blocks, and the labels of the hits are read through
+    the block index of mqr.fasta instead of indexing all of mqr.repr.
     """
 
     #: file indexing
@@ -21,88 +36,155 @@ def add_entries(entries_file, run_label, cpu):
     if db_path[-1] == "/":
         db_path = db_path[:-1]
 
-    final_centroids_file = "{}/mqr.fasta".format(db_path)
-    final_centroids_tmp = "{}/mqr.fasta.tmp".format(db_path)
-    final_centroids_old = "{}/mqr.fasta.old".format(db_path)
+    final_centroids_file = resolve_db_file("{}/mqr.fasta".format(db_path))
+    final_centroids_tmp = "{}.tmp".format(final_centroids_file)
+    final_centroids_old = "{}.old".format(final_centroids_file)
+
+    final_label_tree_file = resolve_db_file("{}/mqr.tree".format(db_path))
+    final_label_tree_tmp = "{}.tmp".format(final_label_tree_file)
+    final_label_tree_old = "{}.old".format(final_label_tree_file)
+    final_tree_bin = check_bin_tree(final_label_tree_file)
+    final_tree_bin_tmp = return_bin_file(final_label_tree_tmp)
+    final_tree_bin_old = return_bin_file(final_label_tree_old)
 
-    final_label_tree_file = "{}/mqr.tree".format(db_path)
-    final_label_tree_tmp = "{}/mqr.tree.tmp".format(db_path)
-    final_label_tree_old = "{}/mqr.tree.old".format(db_path)
+    final_repr_file = resolve_db_file("{}/mqr.repr".format(db_path))
+    final_repr_tmp = "{}.tmp".format(final_repr_file)
+    final_repr_old = "{}.old".format(final_repr_file)
 
-    final_repr_file = "{}/mqr.repr".format(db_path)
-    final_repr_tmp = "{}/mqr.repr.tmp".format(db_path)
-    final_repr_old = "{}/mqr.repr.old".format(db_path)
+    db_index_file = "{}/mqr.index".format(db_path)
 
     #: creating temporary files and backing up the database
-    shutil.copy(final_centroids_file, final_centroids_tmp)
-    shutil.copy(final_label_tree_file, final_label_tree_tmp)
-    shutil.copy(final_repr_file, final_repr_tmp)
-    shutil.copy(final_centroids_file, final_centroids_old)
-    shutil.copy(final_label_tree_file, final_label_tree_old)
-    shutil.copy(final_repr_file, final_repr_old)
+    copy_db_file(final_centroids_file, final_centroids_tmp)
+    copy_db_file(final_label_tree_file, final_label_tree_tmp)
+    copy_db_file(final_repr_file, final_repr_tmp)
+    copy_db_file(final_centroids_file, final_centroids_old)
+    copy_db_file(final_label_tree_file, final_label_tree_old)
+    copy_db_file(final_repr_file, final_repr_old)
+    shutil.copy(final_tree_bin, final_tree_bin_tmp)
+    shutil.copy(final_tree_bin, final_tree_bin_old)
 
     #: handles vsearch searching
     vs_out = "{}/vs_out.txt".format(db_path)
-    v_search(entries_file, final_centroids_file, vs_out, cpu)
+    with span("vsearch"):
+        v_search(entries_file, final_centroids_file, vs_out, cpu, format)
     vs_dict = read_vsout(vs_out)
 
     #: reads in the entries file and get start number for new label
-    new_entries = read_input(entries_file)
-    new_label = get_newlabel(final_repr_file)
+    new_entries = read_input(entries_file, format)
+    fasta_index = None
+    if compression_of(final_centroids_file) and \
+            compression_of(final_repr_file):
+        fasta_index = read_index(final_centroids_file)
+    with span("load_db_index"):
+        db_index = load_db_index(
+                                 db_index_file,
+                                 final_repr_file,
+                                 final_label_tree_file,
+                                 keep_index,
+                                 indexed=fasta_index is not None
+                                 )
+    new_label = str(db_index["highest"])
+    added_entries = []
 
     #: iterates over all entries, checks if match found, appends to files
-    for entry in new_entries:
-        if entry in vs_dict:
-            entry_id = vs_dict[entry].split("\t")[1]
-            entry_perc = vs_dict[entry].split("\t")[0]
-
-            #: only works if if no match at 100% seq identity
-            #: if 100% match no need to add as it is part of a cluster
-            if int(entry_perc) < 100:
-                new_labeltree = {}
-                old_label = get_label(entry_id, final_repr_file)
-                old_labeltree = get_labeltree(old_label, final_label_tree_file)
-                new_labeltree = make_labeltree(
-                                               new_label,
-                                               old_labeltree,
-                                               entry_perc,
-                                               run_label
-                                            )
-                add_labeltree(
-                              new_labeltree,
-                              final_label_tree_tmp)
-
-                add_centroids(
-                              entry,
-                              new_entries[entry],
-                              new_label,
-                              final_centroids_tmp,
-                              run_label
-                            )
-                add_repr(
-                        new_label,
-                        new_entries[entry].split("\t")[0],
-                        entry_id,
-                        entry_perc,
-                        final_repr_tmp,
-                        run_label
-                )
-
-                new_label = str(int(new_label)+1)
+    with open_append(final_label_tree_tmp) as label_out, \
+         open_append(final_centroids_tmp, fasta=True) as centroids_out, \
+         open_append(final_repr_tmp) as repr_out:
+
+        for entry in new_entries:
+            if entry in vs_dict:
+                entry_id = vs_dict[entry].split("\t")[1]
+                entry_perc = vs_dict[entry].split("\t")[0]
+
+                #: only works if if no match at 100% seq identity
+                #: if 100% match no need to add as it is part of a cluster
+                if int(entry_perc) < 100:
+                    new_labeltree = {}
+                    old_label = lookup_label(
+                                             db_index,
+                                             fasta_index,
+                                             final_centroids_file,
+                                             entry_id
+                                             )
+                    old_labeltree = db_index["labeltree"][old_label]
+                    new_labeltree = make_labeltree(
+                                                   new_label,
+                                                   old_labeltree,
+                                                   entry_perc,
+                                                   run_label
+                                                )
+                    add_labeltree(
+                                  new_labeltree,
+                                  label_out)
+
+                    add_centroids(
+                                  entry,
+                                  new_entries[entry],
+                                  new_label,
+                                  centroids_out,
+                                  run_label
+                                )
+                    add_repr(
+                            new_label,
+                            new_entries[entry].split("\t")[0],
+                            entry_id,
+                            entry_perc,
+                            repr_out,
+                            run_label
+                    )
 
-    #: cleanup temp files and output
-    shutil.move(final_centroids_tmp, final_centroids_file)
-    shutil.move(final_label_tree_tmp, final_label_tree_file)
-    shutil.move(final_repr_tmp, final_repr_file)
+                    added_entries.append(
+                        (new_labeltree, entry_id, new_label)
+                    )
+
+                    new_label = str(int(new_label)+1)
+
+    append_tree_lines(
+        final_tree_bin_tmp,
+        [labeltree for labeltree, _, _ in added_entries]
+    )
 
+    add_count("entries", len(new_entries))
+    add_count("added", len(added_entries))
 
-def v_search(entries_file, centroids_file, vs_out, cpu):
+    #: cleanup temp files and output
+    copy_db_file(final_centroids_tmp, final_centroids_file, move=True)
+    copy_db_file(final_label_tree_tmp, final_label_tree_file, move=True)
+    copy_db_file(final_repr_tmp, final_repr_file, move=True)
+    shutil.move(final_tree_bin_tmp, final_tree_bin)
+
+    #: new entries are only looked up by the next run
+    if keep_index:
+        for labeltree, entry_id, label in added_entries:
+            add_index_entry(db_index, labeltree, entry_id, label)
+        write_db_index(
+                       db_index,
+                       db_index_file,
+                       final_repr_file,
+                       final_label_tree_file
+                       )
+
+
+def v_search(entries_file, centroids_file, vs_out, cpu, format=""):
     """Uses vsearch Searching function to compare the new entries with the
-    finished centroid database, finding hits with percentage identity
+    finished centroid database, finding hits with percentage identity. The
+    entries are piped to vsearch if converted on the fly, a compressed
+    database is decompressed to a temporary file.
     """
+    piped = piped_input(entries_file, format)
+    vs_db_file = centroids_file
+    if compression_of(centroids_file):
+        vs_db_file = f"{centroids_file}.search"
+        with FastaWriter(vs_db_file, width=80) as vs_db:
+            for header, seq in fasta_records(centroids_file):
+                vs_db.write(header, seq)
+
     id = "0.5"
-    vs_input = "{} {}".format('--usearch_global', entries_file)
-    vs_db = "{} {}".format('-db', centroids_file)
+    vs_input = "{} {}".format(
+        '--usearch_global',
+        "-" if piped else entries_file
+    )
+    vs_db = "{} {}".format('-db', vs_db_file)
     vs_id = "{} {}".format('-id', id)
     vs_out = "{} {}".format('-blast6out', vs_out)
     vs_no_progress = "{}".format('--no_progress')
@@ -119,7 +201,13 @@ def v_search(entries_file, centroids_file, vs_out, cpu):
         qu=vs_quiet
     )
 
-    subprocess.run(vs_cmd.split(" "))
+    if piped:
+        run_vsearch(vs_cmd, input_records(entries_file, format=format))
+    else:
+        run_vsearch(vs_cmd)
+
+    if vs_db_file != centroids_file:
+        os.remove(vs_db_file)
 
 
 def read_vsout(vs_output):
@@ -140,97 +228,148 @@ def read_vsout(vs_output):
     return v_result
 
 
-def read_input(file):
-    """Reads the input fasta file and indexes the new entries
+def read_input(file, format=""):
+    """Reads the input fasta file and indexes the new entries, sequences
+    wrapped at 80 as in the database
     """
     entries = {}
-    with open(file, 'r') as f:
-        first = True
-        entry_id = ''
-        entry_tax = ''
-        entry_seq = ''
-        for line in f:
-            curr_line = line.rstrip()
-
-            if curr_line and curr_line[0] == ">":
-                if not first:
-                    entries[entry_id] = "{}\t{}".format(
-                        entry_tax,
-                        entry_seq[:-1]
-                    )
-
-                entry_id = curr_line.split(" ")[0]
-                entry_tax = " ".join(curr_line.split(" ")[1:])
-                entry_seq = ''
-
-            else:
-                entry_seq += curr_line + "\n"
-
-            first = False
-
-        entries[entry_id] = "{}\t{}".format(entry_tax, entry_seq[:-1])
+    for header, seq in input_records(file, format=format):
+        entry_id = ">" + header.split(" ")[0]
+        entry_tax = " ".join(header.split(" ")[1:])
+        entries[entry_id] = "{}\t{}".format(
+            entry_tax,
+            wrap_sequence(seq, 80)
+        )
 
     return entries
 
 
-def get_newlabel(repr_file):
-    """Creates a new label id by taking the highest id in the repr database and
-    adding 1
-    """
-    highest = 0
-    with open(repr_file, 'r') as f:
-        for line in f:
-            curr_line = line.rstrip()
-            if curr_line.split("\t")[0].split("_")[-2] == "100":
-                curr_label = int(curr_line.split("\t")[0].split("_")[-1])
-                if curr_label > highest:
-                    highest = curr_label
-    return str(highest)
-
-
 def read_labels(repr_file):
-    """Indexes the repr database
+    """Indexes the repr database, returning the seq id to label index and the
+    highest label number at 100
     """
     labels = {}
+    highest = 0
 
-    with open(repr_file, 'r') as f:
+    with open_text(repr_file) as f:
         for line in f:
             if line.split("\t")[0].split("_")[-2] == "100":
                 curr_line = line.rstrip()
                 curr_label = curr_line.split("\t")[0]
                 curr_id = curr_line.split("\t")[1]
                 labels[curr_id] = curr_label
+                if int(curr_label.split("_")[-1]) > highest:
+                    highest = int(curr_label.split("_")[-1])
+
+    return labels, highest
+
 
-    return labels
+def read_index_highest(repr_file):
+    """Returns the highest label number at 100 of a compressed repr database,
+    from the labels in its block index
+    """
+    highest = 0
+    for label in read_index(repr_file):
+        if label.split("_")[-2] == "100":
+            if int(label.split("_")[-1]) > highest:
+                highest = int(label.split("_")[-1])
+
+    return highest
 
 
-def get_label(id, repr_file):
-    """Finds the label from the repr database using the seq id
+def lookup_label(db_index, fasta_index, centroids_file, entry_id):
+    """Returns the 100 label of a database entry (>id), from the database
+    index, or from the header of the entry in a compressed mqr.fasta, read
+    through its block index
     """
-    labels = read_labels(repr_file)
-    return labels[id]
+    if fasta_index is None or entry_id in db_index["labels"]:
+        return db_index["labels"][entry_id]
+
+    records = read_records(centroids_file, entry_id[1:], fasta_index)
+    if not records:
+        raise KeyError(entry_id)
+
+    return records[0].split("\n")[0].split("\t")[1]
 
 
 def read_labeltree(labeltree_file):
-    """Indexes the label tree database
+    """Indexes the label tree database, read from the binary tree
     """
     labeltree = {}
 
-    with open(labeltree_file, 'r') as f:
-        for line in f:
-            curr_line = line.rstrip()
-            curr_label = curr_line.split("\t")[0]
-            curr_tree = curr_line.split("\t")[1]
+    with load_label_tree(labeltree_file) as tree:
+        for line in tree.lines():
+            curr_label, curr_tree = line.split("\t")
             labeltree[curr_label] = curr_tree
 
     return labeltree
 
 
-def get_labeltree(label, labeltree_file):
-    """Finds a label tree from the label tree database using current label
+def file_stamps(files):
+    """Returns the size and modification time of the files, used to tell if
+    a stored index is still valid
     """
-    labeltree = read_labeltree(labeltree_file)
-    return labeltree[label]
+    stamps = []
+    for file in files:
+        stat = os.stat(file)
+        stamps.append((stat.st_size, stat.st_mtime_ns))
+
+    return stamps
+
+
+def load_db_index(
+                  index_file,
+                  repr_file,
+                  labeltree_file,
+                  keep_index=False,
+                  indexed=False
+                  ):
+    """Returns the index of the finished database: seq id to 100 label, label
+    to label tree and the highest label number. A stored index is used if it
+    matches the current repr and label tree databases. If indexed (compressed
+    database) the seq ids are not indexed, they are looked up through the
+    block index of mqr.fasta, see lookup_label
+    """
+    if keep_index and check_file(index_file):
+        with open(index_file, 'rb') as f:
+            db_index = pickle.load(f)
+        if db_index["stamps"] == file_stamps([repr_file, labeltree_file]):
+            return db_index
+
+    if indexed:
+        labels, highest = {}, read_index_highest(repr_file)
+    else:
+        labels, highest = read_labels(repr_file)
+    db_index = {
+        "labels": labels,
+        "labeltree": read_labeltree(labeltree_file),
+        "highest": highest
+    }
+
+    return db_index
+
+
+def add_index_entry(db_index, labeltree, id, label):
+    """Adds a new entry to the database index, as it is added to the repr and
+    label tree databases
+    """
+    curr_label = labeltree.split("\t")[0]
+    db_index["labels"][id] = curr_label
+    db_index["labeltree"][curr_label] = labeltree.split("\t")[1]
+    if int(label) > db_index["highest"]:
+        db_index["highest"] = int(label)
+
+
+def write_db_index(db_index, index_file, repr_file, labeltree_file):
+    """Stores the database index next to the database, stamped with the
+    size and modification time of the repr and label tree databases
+    """
+    db_index["stamps"] = file_stamps([repr_file, labeltree_file])
+    tmp_file = f"{index_file}.tmp"
+
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(db_index, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, index_file)
 
 
 def make_labeltree(new_label, label_tree, perc, run_label):
@@ -258,37 +397,34 @@ def make_labeltree(new_label, label_tree, perc, run_label):
     return new_labeltree
 
 
-def add_centroids(entry, entry_info, label, file, run_label):
+def add_centroids(entry, entry_info, label, f, run_label):
     """Appends the label, tax, seq id and sequence to the centroids database
     """
-    with open(file, 'a') as f:
-        header = ("{}\tMQR_{}_100_{}\t{}".format(
-                                            entry,
-                                            run_label,
-                                            label,
-                                            entry_info.split("\t")[0]
-        ))
-        sequence = entry_info.split("\t")[1]
-        f.write("{}\n".format(header))
-        f.write("{}\n".format(sequence))
+    header = ("{}\tMQR_{}_100_{}\t{}".format(
+                                        entry,
+                                        run_label,
+                                        label,
+                                        entry_info.split("\t")[0]
+    ))
+    sequence = entry_info.split("\t")[1]
+    f.write("{}\n".format(header))
+    f.write("{}\n".format(sequence))
 
 
-def add_repr(label, tax, id, perc, repr_file, run_label):
+def add_repr(label, tax, id, perc, f, run_label):
     """Appends new label(s) and tax(es) to the repr database
     """
-    with open(repr_file, 'a') as f:
-        for i in range(100, int(perc), -1):
-            f.write("MQR_{}_{}_{}\t{}\t{}\n".format(
-                                                 run_label,
-                                                 i,
-                                                 label,
-                                                 id,
-                                                 tax
-            ))
-
-
-def add_labeltree(labeltree, label_file):
+    for i in range(100, int(perc), -1):
+        f.write("MQR_{}_{}_{}\t{}\t{}\n".format(
+                                             run_label,
+                                             i,
+                                             label,
+                                             id,
+                                             tax
+        ))
+
+
+def add_labeltree(labeltree, f):
     """Appends a new label tree to the final label tree database
     """
-    with open(label_file, 'a') as f:
-        f.write("{}\n".format(labeltree))
+    f.write("{}\n".format(labeltree))
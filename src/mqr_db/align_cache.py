@@ -0,0 +1,132 @@
+"""Content addressed cache of the MAFFT alignments, shared by all runs in
+metaxaQR_db/alignment_cache/. An alignment is stored under the sha1 of the
+input file, the MAFFT options and the MAFFT version, so a cluster that is
+aligned again with the same sequences, by any mode, label or cross validation
+fold, is copied from the cache instead. The cache is kept below a size limit
+by removing the least recently used alignments.
+"""
+
+import hashlib
+import os
+import shutil
+import subprocess
+from pathlib import Path
+
+#: cache directory used by run_mafft in this process, empty if disabled
+cache_dir = ""
+#: MAFFT version, part of the key of every alignment
+cache_version = ""
+
+
+def return_cache_path():
+    """Returns the path to the alignment cache.
+    """
+    return f"{os.getcwd()}/metaxaQR_db/alignment_cache/"
+
+
+def return_mafft_version():
+    """Returns the version reported by mafft --version, empty if MAFFT is not
+    found.
+    """
+    try:
+        result = subprocess.run(
+            ["mafft", "--version"],
+            capture_output=True,
+            text=True
+        )
+    except FileNotFoundError:
+        return ""
+
+    return (result.stdout + result.stderr).strip()
+
+
+def set_align_cache(path, version=""):
+    """Sets the alignment cache and the MAFFT version of the process, also
+    used as the initializer of the HMM worker processes. An empty path
+    disables the cache.
+    """
+    global cache_dir, cache_version
+    cache_dir = path
+    cache_version = version
+    if path:
+        Path(path).mkdir(parents=True, exist_ok=True)
+
+
+def cache_key(file, options):
+    """Returns the key of an alignment, the sha1 hash of the MAFFT version,
+    the MAFFT options and the input file, empty if the cache is disabled.
+    """
+    if not cache_dir:
+        return ""
+
+    sha = hashlib.sha1(f"{cache_version}\n{options}".encode())
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+def return_entry_file(key):
+    """Returns the path to the cached alignment of a key.
+    """
+    return f"{cache_dir}{key[:2]}/{key}"
+
+
+def fetch_alignment(key, out_file):
+    """Copies the cached alignment of key to out_file, marking it as used.
+    Returns False if the cache is disabled or the alignment is not cached.
+    """
+    if not key:
+        return False
+
+    entry_file = return_entry_file(key)
+    try:
+        shutil.copyfile(entry_file, out_file)
+        os.utime(entry_file)
+    except FileNotFoundError:
+        return False
+
+    return True
+
+
+def store_alignment(key, out_file):
+    """Adds an alignment to the cache. The alignment is copied to a
+    temporary file first, so other processes never read a partial entry.
+    """
+    if not key:
+        return
+
+    entry_file = return_entry_file(key)
+    Path(entry_file).parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = f"{entry_file}.{os.getpid()}.tmp"
+    shutil.copyfile(out_file, tmp_file)
+    os.replace(tmp_file, entry_file)
+
+
+def evict_alignments(path, max_size):
+    """Removes the least recently used alignments of the cache until the
+    cache is at most max_size bytes.
+    """
+    entries = []
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            if file.endswith(".tmp"):
+                continue
+            entry_file = os.path.join(root, file)
+            try:
+                stat = os.stat(entry_file)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry_file))
+            total += stat.st_size
+
+    for mtime, size, entry_file in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(entry_file)
+        except FileNotFoundError:
+            pass
+        total -= size
@@ -0,0 +1,305 @@
+"""Benchmark mode (--benchmark), runs all steps of the database creation on a
+synthetic SILVA-style FASTA file using the stand-in tools from stub_tools, so
+the Python parts can be measured without VSEARCH, MAFFT or HMMER. Reports the
+wall time, CPU time, peak RSS and bytes read/written of every stage.
+"""
+
+import multiprocessing
+import os
+from pathlib import Path
+import random
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from datetime import datetime
+from .handling import return_proj_path, return_removed_path, return_init_path
+from .handling import get_v_loop
+from .cluster_tax import create_taxdb, create_cluster_tax, repr_and_flag
+from .cluster_tax import flag_correction
+from .clustering import cluster_vs
+from .cluster_loop import cluster_loop
+from .make_db import make_db
+from .make_hmms import make_hmms
+from .telemetry import span
+
+#: nucleotides used for the synthetic sequences
+bases = "ACGT"
+
+#: species epithets used for the synthetic taxonomies
+epithets = ["alba", "rubra", "minor", "major", "longa", "brevis"]
+
+
+def mutate(sequence, rate, rng):
+    """Returns the sequence with every position replaced by a random base
+    with probability rate.
+    """
+    return "".join([
+        rng.choice(bases) if rng.random() < rate else base
+        for base in sequence
+    ])
+
+
+def make_benchmark_fasta(file, seqs, depth, divergence, seed=1):
+    """Creates a synthetic SILVA-style FASTA file. A taxonomy tree of depth
+    ranks is made from the three domains, each rank splitting in two with
+    sequences diverging by divergence per rank. Entries are drawn from the
+    genera with species names, duplicates and some unidentified, mitochondria
+    and chloroplast entries.
+    """
+    rng = random.Random(seed)
+    seq_len = 420
+    nodes = []
+    for domain in ["Bacteria", "Archaea", "Eukaryota"]:
+        root = "".join([rng.choice(bases) for _ in range(seq_len)])
+        nodes.append(([domain], root))
+
+    for rank in range(1, depth):
+        new_nodes = []
+        for tax, sequence in nodes:
+            for branch in range(2):
+                if rank == depth - 1:
+                    name = f"Gen{rank}{branch}{rng.randint(0, 999)}"
+                else:
+                    name = f"Tx{rank}{branch}{rng.randint(0, 999)}"
+                new_nodes.append((
+                    tax + [name],
+                    mutate(sequence, divergence * (depth - rank), rng)
+                ))
+        nodes = new_nodes
+
+    entry = 0
+    with open(file, 'w') as f:
+        while entry < seqs:
+            tax, sequence = rng.choice(nodes)
+            tax = list(tax)
+            species = f"{tax[-1]} {rng.choice(epithets)}"
+            origin = rng.random()
+            if origin < 0.05:
+                species = "uncultured bacterium"
+            elif origin < 0.08:
+                tax = [tax[0], "Mitochondria"] + tax[1:]
+            elif origin < 0.1:
+                tax = ["Chloroplast"] + tax[1:]
+
+            if rng.random() < 0.6:
+                sequence = mutate(sequence, divergence / 4, rng)
+            sequence = sequence[:rng.randint(seq_len - 40, seq_len)]
+
+            for _ in range(rng.choice([1, 1, 2, 3])):
+                if entry >= seqs:
+                    break
+                curr_tax = tax
+                #: some entries get a conflicting taxonomy
+                if rng.random() > 0.85:
+                    curr_tax = rng.choice(nodes)[0]
+                f.write(f">ACC{entry}.1.{len(sequence)} "
+                        f"{';'.join(curr_tax)};{species}\n")
+                for i in range(0, len(sequence), 60):
+                    f.write(f"{sequence[i:i+60]}\n")
+                entry += 1
+
+
+def write_stub_tools(bin_dir):
+    """Writes the vsearch, mafft, hmmbuild and hmmpress wrapper scripts,
+    running stub_tools with the current Python interpreter.
+    """
+    stub_file = Path(__file__).with_name("stub_tools.py")
+    Path(bin_dir).mkdir(parents=True, exist_ok=True)
+
+    for tool in ["vsearch", "mafft", "hmmbuild", "hmmpress"]:
+        tool_file = f"{bin_dir}/{tool}"
+        with open(tool_file, 'w') as f:
+            f.write(f"#!/bin/sh\nexec \"{sys.executable}\" \"{stub_file}\" "
+                    f"{tool} \"$@\"\n")
+        os.chmod(tool_file, 0o755)
+
+
+def stage_worker(conn, stage, func, args, kwargs):
+    """Runs one stage in a child process as a telemetry span, sending the CPU
+    time, peak RSS and bytes read/written of the stage, including the
+    external tools it ran, back to the parent.
+    """
+    try:
+        with span(stage) as record:
+            func(*args, **kwargs)
+
+        conn.send({
+            "cpu": record["cpu"] + record["child_cpu"],
+            "max_rss": max(record["max_rss"], record["child_max_rss"]),
+            "read_bytes": record["read_bytes"],
+            "write_bytes": record["write_bytes"]
+        })
+
+    except Exception:
+        conn.send({"error": traceback.format_exc()})
+
+    conn.close()
+
+
+def run_benchmark_stage(stage, func, *args, **kwargs):
+    """Runs a stage in a forked child process and returns its measurements.
+    """
+    context = multiprocessing.get_context("fork")
+    parent_conn, child_conn = context.Pipe(duplex=False)
+    process = context.Process(
+        target=stage_worker,
+        args=(child_conn, stage, func, args, kwargs)
+    )
+
+    start_time = time.perf_counter()
+    process.start()
+    child_conn.close()
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        result = {"error": f"stage exited with code {process.exitcode}"}
+    process.join()
+    result["wall"] = time.perf_counter() - start_time
+    result["stage"] = stage
+
+    if "error" in result:
+        error_msg = f"ERROR: benchmark stage {stage} failed\n{result['error']}"
+        quit(error_msg)
+
+    return result
+
+
+def format_bytes(nr_bytes):
+    """Returns a byte count in human readable form.
+    """
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(nr_bytes) < 1024 or unit == "GB":
+            break
+        nr_bytes /= 1024
+
+    return f"{nr_bytes:.1f}{unit}"
+
+
+def benchmark_table(results):
+    """Returns the result lines, one per stage and the total.
+    """
+    res_lines = ["{:<24}{:>10}{:>10}{:>12}{:>12}{:>12}".format(
+        "stage", "wall_s", "cpu_s", "peak_rss", "read", "written"
+    )]
+    totals = {"wall": 0, "cpu": 0, "max_rss": 0,
+              "read_bytes": 0, "write_bytes": 0}
+
+    for result in results:
+        res_lines.append("{:<24}{:>10.2f}{:>10.2f}{:>12}{:>12}{:>12}".format(
+            result["stage"],
+            result["wall"],
+            result["cpu"],
+            format_bytes(result["max_rss"]),
+            format_bytes(result["read_bytes"]),
+            format_bytes(result["write_bytes"])
+        ))
+        for key in totals:
+            if key == "max_rss":
+                totals[key] = max(totals[key], result[key])
+            else:
+                totals[key] += result[key]
+
+    res_lines.append("{:<24}{:>10.2f}{:>10.2f}{:>12}{:>12}{:>12}".format(
+        "total",
+        totals["wall"],
+        totals["cpu"],
+        format_bytes(totals["max_rss"]),
+        format_bytes(totals["read_bytes"]),
+        format_bytes(totals["write_bytes"])
+    ))
+
+    return res_lines
+
+
+def run_benchmark(seqs, depth, divergence, cpu, keep=False, quiet=False):
+    """Benchmark mode. Creates a synthetic database of seqs entries, then runs
+    prepare, manual review (all flags excluded), the clustering loop, make_db
+    and every make_hmms mode using the stand-in tools, each stage in its own
+    process. The results are printed and saved in
+    metaxaQR_db/Benchmark_results/.
+    """
+    curr_dir = os.getcwd()
+    today = str(datetime.now())
+    curr_time = today.split(".")[0].replace(" ", "T").replace(":", "")[:-2]
+    bench_res_path = f"{curr_dir}/metaxaQR_db/Benchmark_results"
+    Path(bench_res_path).mkdir(parents=True, exist_ok=True)
+    bench_results_file = f"{bench_res_path}/Benchmark_{curr_time}.txt"
+
+    #: all paths are relative to the working directory, runs in a temp dir
+    bench_path = tempfile.mkdtemp(prefix="benchmark_", dir=bench_res_path)
+    bin_dir = f"{bench_path}/bin"
+    bench_fasta = f"{bench_path}/benchmark.fasta"
+    write_stub_tools(bin_dir)
+    make_benchmark_fasta(bench_fasta, seqs, depth, divergence)
+
+    old_path = os.environ.get("PATH", "")
+    os.environ["PATH"] = f"{bin_dir}{os.pathsep}{old_path}"
+    os.chdir(bench_path)
+
+    run_label = "benchmark"
+    str_id = "100"
+    Path(return_removed_path(run_label)).mkdir(parents=True, exist_ok=True)
+    Path(return_init_path(run_label)).mkdir(parents=True, exist_ok=True)
+    Path(return_proj_path(run_label)).mkdir(parents=True, exist_ok=True)
+    tree_file = f"{Path(return_proj_path(run_label)).parent}/mqr.tree"
+
+    stages = [
+        ("cluster_vs", cluster_vs, (bench_fasta, 1.0, run_label, cpu), {}),
+        ("create_taxdb", create_taxdb, (run_label,), {}),
+        ("create_cluster_tax", create_cluster_tax,
+         (str_id, run_label, True, True), {"cpu": cpu}),
+        ("repr_and_flag", repr_and_flag, (str_id, run_label, cpu), {}),
+        ("flag_correction", flag_correction, (str_id, run_label, True), {})
+    ]
+    for id in get_v_loop():
+        stages.append((f"cluster_loop_{id}", cluster_loop,
+                       (id, run_label, True, "", cpu), {}))
+    stages.append(("make_db", make_db, (run_label, False, True), {}))
+    for mode in ["divergent", "hybrid", "conserved"]:
+        stages.append((f"make_hmms_{mode}", make_hmms,
+                       (mode, tree_file, run_label, False, 0),
+                       {"seq_db": bench_fasta, "cpu": cpu}))
+
+    results = []
+    if not quiet:
+        print(benchmark_table(results)[0])
+    try:
+        for stage, func, args, kwargs in stages:
+            if stage.startswith("make_hmms"):
+                clear_hmm_dirs(run_label)
+            results.append(run_benchmark_stage(stage, func, *args, **kwargs))
+            if not quiet:
+                print(benchmark_table(results)[-2])
+
+    finally:
+        os.chdir(curr_dir)
+        os.environ["PATH"] = old_path
+        if not keep:
+            shutil.rmtree(bench_path)
+
+    res_lines = [
+        "Benchmark results:",
+        f"Entries: {seqs}, taxonomy depth: {depth}, divergence: "
+        f"{divergence}, cpu: {cpu}"
+    ] + benchmark_table(results)
+
+    with open(bench_results_file, 'w') as f:
+        for res_line in res_lines:
+            f.write(f"{res_line}\n")
+
+    if not quiet:
+        print(res_lines[-1])
+        print(f"Benchmark results saved to {bench_results_file}")
+
+
+def clear_hmm_dirs(run_label):
+    """Removes the alignment and HMM directories left by an earlier make_hmms
+    stage, so every mode starts from the same state.
+    """
+    align_dir = f"{return_proj_path(run_label)}alignment/"
+    hmm_dir = f"{Path(return_proj_path(run_label)).parent}/HMMs/"
+    for path in [align_dir, hmm_dir]:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
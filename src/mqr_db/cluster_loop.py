@@ -6,11 +6,17 @@ file to continue with next iteration.
 from .cluster_tax import repr_and_flag, create_cluster_tax
 from .cluster_tax import find_taxonomy, read_taxdb
 from .clustering import cluster_vs
+from .cluster_store import return_store_paths, ClusterStore
+from .dictionary import TaxDictionary, short_label
+from .fasta import fasta_records, FastaWriter, sort_by_length
 from .handling import return_proj_path, sequence_quality_check
 from .handling import return_removed_path
 from .make_db import get_deleted_clusters
+from .manifest import run_stage, submit_stage, finish_stage
+from .telemetry import span, add_count
 
 import os
+from concurrent.futures import ProcessPoolExecutor
 from shutil import rmtree
 
 
@@ -35,30 +41,38 @@ def create_final_repr(
     """Creates the final_repr file, includes the cluster label, centroid entry
     label and the representative taxonomy for every centroid. Cent_loop is used
     when the method is called from the cluster_loop method at identities below
-    100.
+    100. Taxonomies are written as ids of the taxonomy dictionary, below 100
+    they are also read as ids.
     """
     run_path = return_proj_path(run_label) + str_id
     repr_corr_file = run_path + '/repr_correction'
     final_repr_file = run_path + '/final_repr'
     uc_file = run_path + '/uc'
-    cluster_dir = run_path + "/clusters"
     removed_dir = return_removed_path(run_label)
     removed_cluster_file = removed_dir + 'deleted_clusters_100'
     repr_dict = {}
     removed_list = []
     tax_db = read_taxdb(run_label)
+    n_clusters = 0
+
+    tax_dict = TaxDictionary(run_label)
 
     #: reads repr_correction file into memory
     with open(repr_corr_file, 'r') as corr_file:
         for line in corr_file:
             curr_line = line.rstrip().split("\t")
-            repr_dict[curr_line[0]] = curr_line[1]
+            if cent_loop:
+                repr_dict[curr_line[0]] = tax_dict.decode(curr_line[1])
+            else:
+                repr_dict[curr_line[0]] = curr_line[1]
 
     if str_id == "100":
         removed_list = get_deleted_clusters(run_label, dels_only=True)
 
     with open(final_repr_file, 'w') as repr_out, \
-         open(uc_file, 'r') as read_uc:
+         open(uc_file, 'r') as read_uc, \
+         ClusterStore(run_path) as store, \
+         tax_dict:
 
         for line in read_uc:
             curr_line = line.rstrip().split("\t")
@@ -73,7 +87,7 @@ def create_final_repr(
                         curr_line[9].split("_")[-1]
                         )
                     centroid_label = ">{}".format(curr_line[8])
-                    singleton_repr = curr_line[10]
+                    singleton_repr = tax_dict.decode(curr_line[10])
                 else:
                     cluster_label = "MQR_{}_{}_{}".format(
                         run_label,
@@ -86,12 +100,7 @@ def create_final_repr(
 
                 if entries == 1:
                     repr_tax = clean_singleton(singleton_repr)
-                    cluster_file = cluster_dir + "/cluster_" + cluster
-                    sequence = ""
-                    with open(cluster_file, 'r') as cfile:
-                        cfile.readline()  # skips header
-                        for tmp in cfile:
-                            sequence += tmp.rstrip()
+                    sequence = store.records(cluster)[0][1]
 
                     #: fixes chloro/mito taxonomies
                     if (
@@ -133,22 +142,28 @@ def create_final_repr(
                     repr_out.write("{}\t{}\t{}\n".format(
                         cluster_label,
                         centroid_label,
-                        repr_tax
+                        tax_dict.encode(repr_tax)
                     ))
+                    n_clusters += 1
+
+    add_count("clusters", n_clusters)
 
 
 def create_final_cent(str_id, run_label, cent_loop=False):
     """Creates the final centroid file, including cluster label, centroid label
     , representative taxonomy followed by the centroid sequence. Cent_loop is
     used when the method is called from the cluster_loop method at identities
-    below 100.
+    below 100. The centroids are kept in decreasing length order, as written
+    by vsearch, so the next identity can be clustered with cluster_smallmem
+    without sorting, they are sorted if not in order.
     """
     run_path = return_proj_path(run_label) + str_id
     centroid_file = run_path + '/centroids'
     final_cent_file = run_path + '/final_centroids'
     final_repr_file = run_path + '/final_repr'
     repr_dict = {}
-    excluded = False
+    last_len = float("inf")
+    length_sorted = True
 
     with open(final_repr_file, 'r') as repr_file:
         for line in repr_file:
@@ -158,60 +173,56 @@ def create_final_cent(str_id, run_label, cent_loop=False):
                 curr_line[2]  # taxonomy
             )
 
-    with open(centroid_file, 'r') as cent_read, \
-         open(final_cent_file, 'w') as cent_out:
-
-        for line in cent_read:
-            cluster_label = ''
-            cent_label = ''
-            repr_tax = ''
+    with FastaWriter(final_cent_file, width=80) as cent_out:
+        for header, sequence in fasta_records(centroid_file):
+            if cent_loop:
+                curr_label = ">" + header.split("\t")[0]
+            else:
+                curr_label = ">" + header.split(" ")[0]
+
+            if curr_label in repr_dict:
+                cluster_label = repr_dict[curr_label].split("\t")[0]
+                repr_tax = repr_dict[curr_label].split("\t")[1]
+                cent_out.write(
+                    f"{curr_label[1:]}\t{cluster_label}\t{repr_tax}",
+                    sequence
+                )
+                if len(sequence) > last_len:
+                    length_sorted = False
+                last_len = len(sequence)
 
-            curr_line = line.rstrip()
+    if not length_sorted:
+        sort_by_length(final_cent_file, width=80)
 
-            if curr_line[0] == '>':
-                excluded = False
-                if cent_loop:
-                    curr_label = curr_line.split("\t")[0]
-                else:
-                    curr_label = curr_line.split(" ")[0]
 
-                if curr_label in repr_dict:
-                    cluster_label = repr_dict[curr_label].split("\t")[0]
-                    repr_tax = repr_dict[curr_label].split("\t")[1]
-                else:
-                    excluded = True
+def get_prev_id(str_id):
+    """Returns the identity clustered before str_id in the identity ladder,
+    (91 for 90, 90 for 85).
+    """
+    if int(str_id) < 90:
+        prev_id = str(int(str_id)+5)
+    else:
+        prev_id = str(int(str_id)+1)
 
-                if not excluded:
-                    cent_out.write("{}\t{}\t{}\n".format(
-                        curr_label,
-                        cluster_label,
-                        repr_tax
-                    ))
-
-            else:
-                if not excluded:
-                    cent_out.write(curr_line + "\n")
+    return prev_id
 
 
 def create_label_tree(str_id, run_label, tree_loop=False):
     """Creates the label_tree file, containing all cluster labels and their
     relation all other cluster labels that are in their centroid, from current
     str_id up to max str_id. Tree_loop is called when the identity is below 99
-    in order to iterate over the last tree_label file.
+    in order to iterate over the last tree_label file. Labels are written
+    without the MQR_{label}_ prefix.
     """
     run_path = return_proj_path(run_label) + str_id
     uc_file = run_path + "/uc"
     label_tree_file = run_path + "/label_tree"
-    cluster_dir = run_path + "/clusters"
     old_dict = {}
+    n_clusters = 0
 
     #: reads the last label_tree file into memory
     if tree_loop:
-        if int(str_id) < 90:
-            old_id = str(int(str_id)+5)
-        else:
-            old_id = str(int(str_id)+1)
-
+        old_id = get_prev_id(str_id)
         old_tree_file = return_proj_path(run_label) + old_id + "/label_tree"
         with open(old_tree_file, 'r') as old_tree:
             for line in old_tree:
@@ -219,15 +230,15 @@ def create_label_tree(str_id, run_label, tree_loop=False):
                 old_dict[curr_line[0]] = curr_line[1]
 
     with open(label_tree_file, 'w') as tree_file, \
-         open(uc_file, 'r') as read_uc:
+         open(uc_file, 'r') as read_uc, \
+         ClusterStore(run_path) as store:
 
         for line in read_uc:
             curr_line = line.rstrip().split("\t")
 
             if curr_line[0] == "C":
                 tree_labels = ''
-                new_label = "MQR_{}_{}_{}".format(
-                    run_label,
+                new_label = "{}_{}".format(
                     str_id,
                     curr_line[9].split("_")[-1]
                 )
@@ -236,7 +247,7 @@ def create_label_tree(str_id, run_label, tree_loop=False):
 
                 #: singletons
                 if entries == 1:
-                    old_entry = curr_line[9]
+                    old_entry = short_label(curr_line[9])
                     tree_labels += old_entry + ' '
                     if old_entry in old_dict:
                         tree_labels += old_dict[old_entry] + ' '
@@ -245,39 +256,43 @@ def create_label_tree(str_id, run_label, tree_loop=False):
                 #: centroids with multiple entries
                 elif entries > 1:
                     curr_cluster = curr_line[1]
-                    cluster_file = cluster_dir + '/cluster_' + curr_cluster
-                    with open(cluster_file, 'r') as clust_read:
-                        for line in clust_read:
-                            if line[0] == '>':
-                                curr_line = line.rstrip()
-                                old_entry = curr_line.split("\t")[1]
-                                tree_labels += old_entry + ' '
-                                if old_entry in old_dict:
-                                    tree_labels += old_dict[old_entry] + ' '
-                                    old_dict.pop(old_entry)
+                    for curr_line in store.headers(curr_cluster):
+                        old_entry = short_label(
+                            curr_line.rstrip().split("\t")[1]
+                        )
+                        tree_labels += old_entry + ' '
+                        if old_entry in old_dict:
+                            tree_labels += old_dict[old_entry] + ' '
+                            old_dict.pop(old_entry)
 
                 tree_file.write("{}\t{}\n".format(
                     new_label,
                     tree_labels[:-1]
                 ))
+                n_clusters += 1
 
+    add_count("clusters", n_clusters)
 
-def loop_repr_corr(str_id, run_label):
+
+def loop_repr_corr(str_id, run_label, cpu=1):
     """Creates the clusters_tax and repr_correction files needed in order to
     create the final_centroids and final_repr files. Used for identites below
     100.
     """
     #: create_cluser_tax
-    create_cluster_tax(
-                       str_id,
-                       run_label,
-                       qc_taxonomy_quality=False,
-                       qc_sequence_quality=False,
-                       loop=True
-                       )
+    with span("create_cluster_tax", id=str_id):
+        create_cluster_tax(
+                           str_id,
+                           run_label,
+                           qc_taxonomy_quality=False,
+                           qc_sequence_quality=False,
+                           loop=True,
+                           cpu=cpu
+                           )
 
     #: repr_and_flag
-    repr_and_flag(str_id, run_label)
+    with span("repr_and_flag", id=str_id):
+        repr_and_flag(str_id, run_label, cpu)
 
     #: cleanup repr_and_flag files
     run_path = return_proj_path(run_label) + str_id
@@ -289,12 +304,20 @@ def loop_repr_corr(str_id, run_label):
     os.rename(repr_cluster_file, repr_corr_file)
 
 
-def cluster_loop(str_id, run_label, sequence_quality_check, gene_marker, cpu):
+def cluster_loop(
+                 str_id,
+                 run_label,
+                 sequence_quality_check,
+                 gene_marker,
+                 cpu,
+                 resume=False
+                 ):
     """Prepares final_centroids and final_repr files, the tree_label file and
     starts vsearch clustering of the next identity (str_id - 0.01), looping
     over with 100, 99... allows for creation of all relevant files for all
     steps. First does one cluster for every percent 100-90, then one per five
-    50-90 e.g 50, 55, 60 ...
+    50-90 e.g 50, 55, 60 ... Every stage is recorded in the run manifest, if
+    resume is used the stages already finished are skipped.
     """
     if int(str_id) <= 90:
         next_ident = int(str_id)-5
@@ -304,36 +327,113 @@ def cluster_loop(str_id, run_label, sequence_quality_check, gene_marker, cpu):
     stop_ident = 50
     tree_loop = False
 
+    proj_path = return_proj_path(run_label)
+    run_path = proj_path + str_id
+    uc_file = run_path + '/uc'
+    cluster_data_file, cluster_index_file = return_store_paths(run_path)
+    centroid_file = run_path + '/centroids'
+    repr_corr_file = run_path + '/repr_correction'
+    final_repr_file = run_path + '/final_repr'
+    final_cent_file = run_path + '/final_centroids'
+    label_tree_file = run_path + '/label_tree'
+    tax_db_file = proj_path + '100/tax_db'
+
     if str_id == '100':
         cent_loop = False
     else:
         cent_loop = True
-        loop_repr_corr(str_id, run_label)
+        run_stage(
+                  run_label,
+                  str_id,
+                  "loop_repr_corr",
+                  [uc_file, cluster_data_file, cluster_index_file],
+                  [run_path + '/tax_clusters', repr_corr_file],
+                  loop_repr_corr,
+                  str_id,
+                  run_label,
+                  cpu,
+                  resume=resume
+                  )
         if int(str_id) < 99:
             tree_loop = True
 
-    #: creating final_repr and final_cent files for clustering
-    create_final_repr(
+    #: creating final_repr and final_cent files for clustering, the removed
+    #: clusters file is not an input as every identity appends to it
+    run_stage(
+              run_label,
+              str_id,
+              "create_final_repr",
+              [repr_corr_file, uc_file, cluster_data_file, cluster_index_file,
+               tax_db_file],
+              [final_repr_file],
+              create_final_repr,
+              str_id,
+              run_label,
+              sequence_quality_check,
+              gene_marker,
+              cent_loop,
+              params={
+                      "qc_sequence_quality": sequence_quality_check,
+                      "gene_marker": gene_marker
+                      },
+              resume=resume
+              )
+    run_stage(
+              run_label,
+              str_id,
+              "create_final_cent",
+              [final_repr_file, centroid_file],
+              [final_cent_file],
+              create_final_cent,
+              str_id,
+              run_label,
+              cent_loop,
+              resume=resume
+              )
+
+    #: vsearch clustering of the next identity using the final files, run
+    #: in the background while the label tree of this identity is created
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        next_cluster = None
+        if next_ident >= stop_ident:
+            next_path = f"{proj_path}{next_ident}"
+            next_store_files = list(return_store_paths(next_path))
+            next_cluster = submit_stage(
+                                        executor,
+                                        run_label,
+                                        str_id,
+                                        "cluster_vs",
+                                        [final_cent_file],
+                                        [next_path + '/uc',
+                                         next_path + '/centroids']
+                                        + next_store_files,
+                                        cluster_vs,
+                                        final_cent_file,
+                                        float(next_ident/100),
+                                        run_label,
+                                        cpu,
+                                        loop=True,
+                                        params={"id": next_ident},
+                                        resume=resume
+                                        )
+
+        if cent_loop:
+            tree_inputs = [uc_file, cluster_data_file, cluster_index_file]
+            if tree_loop:
+                tree_inputs.append(
+                    f"{proj_path}{get_prev_id(str_id)}/label_tree"
+                )
+            run_stage(
+                      run_label,
+                      str_id,
+                      "create_label_tree",
+                      tree_inputs,
+                      [label_tree_file],
+                      create_label_tree,
                       str_id,
                       run_label,
-                      sequence_quality_check,
-                      gene_marker,
-                      cent_loop
+                      tree_loop,
+                      resume=resume
                       )
-    create_final_cent(str_id, run_label, cent_loop)
-
-    if cent_loop:
-        create_label_tree(str_id, run_label, tree_loop)
-
-    run_path = return_proj_path(run_label) + str_id
-    final_cent_file = run_path + '/final_centroids'
 
-    #: vsearch clustering using final files
-    if next_ident >= stop_ident:
-        cluster_vs(
-                   final_cent_file,
-                   float(next_ident/100),
-                   run_label,
-                   cpu,
-                   loop=False
-                   )
+        finish_stage(next_cluster)
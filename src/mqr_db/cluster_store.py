@@ -0,0 +1,216 @@
+"""Packed cluster store, holding all clusters from one VSEARCH clustering run
+in a single data file together with an index of where every entry is found,
+keyed by cluster number. Replaces writing one file per cluster.
+"""
+
+import array
+import mmap
+import os
+import struct
+from .fasta import parse_fasta
+from .telemetry import add_count
+
+#: header of the index file, number of clusters and number of entries
+index_header = struct.Struct("<QQ")
+
+
+def return_store_paths(dir_path):
+    """Returns the paths to the data file and the index file of the cluster
+    store in a clustering directory (mqr_db/identity).
+    """
+    dir_path = str(dir_path).rstrip("/")
+    data_file = f"{dir_path}/clusters.dat"
+    index_file = f"{dir_path}/clusters.idx"
+
+    return data_file, index_file
+
+
+def uc_entry_label(uc_split):
+    """Returns the label of the entry from a split S or H record of a uc file.
+    Labels from the clustering loop contains tabs, the query and target labels
+    of H records are then of equal size.
+    """
+    labels = uc_split[8:]
+    if uc_split[0] == "S":
+        labels = labels[:-1]
+    elif uc_split[0] == "H":
+        labels = labels[:len(labels)//2]
+
+    return "\t".join(labels).rstrip()
+
+
+def pack_clusters(records, uc_file, dir_path):
+    """Creates the cluster store from the records (header, sequence) of the
+    clustered database and the uc file produced by VSEARCH. Every entry of
+    the database found in the uc file is copied to the data file in one pass,
+    the index then lists the offset and length of the entries of each cluster
+    in the same order as VSEARCH (the centroid first).
+    """
+    data_file, index_file = return_store_paths(dir_path)
+    entry_clusters = {}
+    cluster_entries = []
+
+    #: cluster of every entry, from the S and H records
+    with open(uc_file, 'r') as read_uc:
+        for line in read_uc:
+            curr_line = line.rstrip("\n").split("\t")
+            if curr_line[0] == "S" or curr_line[0] == "H":
+                label = uc_entry_label(curr_line)
+                cluster = int(curr_line[1])
+                if label not in entry_clusters:
+                    entry_clusters[label] = [cluster]
+                else:
+                    entry_clusters[label].append(cluster)
+                cluster_entries.append((cluster, label))
+
+    #: copies all clustered entries to the data file
+    entry_spans = {}
+    with open(data_file, 'wb') as data_out:
+        offset = 0
+        for label, seq in records:
+            if label in entry_clusters:
+                offset = write_record(
+                    f">{label}\n{seq}\n".encode(),
+                    label,
+                    offset,
+                    data_out,
+                    entry_spans
+                )
+
+    #: the index, entries ordered by cluster then as listed in the uc file
+    cluster_entries.sort(key=lambda entry: entry[0])
+    n_clusters = 0
+    if cluster_entries:
+        n_clusters = cluster_entries[-1][0] + 1
+    counts = array.array('q', [0] * n_clusters)
+    offsets = array.array('q')
+    lengths = array.array('q')
+    used_spans = {}
+
+    for cluster, label in cluster_entries:
+        #: entries sharing the same label are matched in order
+        nr = used_spans.get(label, 0)
+        used_spans[label] = nr + 1
+        spans = entry_spans.get(label, [])
+        if nr < len(spans):
+            counts[cluster] += 1
+            offsets.append(spans[nr][0])
+            lengths.append(spans[nr][1])
+
+    with open(index_file, 'wb') as index_out:
+        index_out.write(index_header.pack(n_clusters, len(offsets)))
+        counts.tofile(index_out)
+        offsets.tofile(index_out)
+        lengths.tofile(index_out)
+
+    add_count("clusters", n_clusters)
+    add_count("entries", len(offsets))
+
+
+def write_record(record_bytes, label, offset, data_out, entry_spans):
+    """Writes one FASTA record to the data file, storing its offset and
+    length. Returns the offset of the next record.
+    """
+    data_out.write(record_bytes)
+
+    if label not in entry_spans:
+        entry_spans[label] = [(offset, len(record_bytes))]
+    else:
+        entry_spans[label].append((offset, len(record_bytes)))
+
+    return offset + len(record_bytes)
+
+
+class ClusterStore:
+    """Reader of a packed cluster store, giving access to the entries of a
+    cluster by cluster number. Cluster numbers can be given as int, str or as
+    'cluster_x'.
+    """
+    def __init__(self, dir_path):
+        self.data_file, self.index_file = return_store_paths(dir_path)
+        self.starts = array.array('q')
+        self.offsets = array.array('q')
+        self.lengths = array.array('q')
+
+        with open(self.index_file, 'rb') as f:
+            n_clusters, n_entries = index_header.unpack(
+                f.read(index_header.size)
+            )
+            counts = array.array('q')
+            counts.fromfile(f, n_clusters)
+            self.offsets.fromfile(f, n_entries)
+            self.lengths.fromfile(f, n_entries)
+
+        #: start position of each cluster among the indexed entries
+        start = 0
+        for count in counts:
+            self.starts.append(start)
+            start += count
+        self.starts.append(start)
+
+        self.data = None
+        if os.path.getsize(self.data_file) > 0:
+            with open(self.data_file, 'rb') as f:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def __contains__(self, cluster):
+        nr = self.cluster_nr(cluster)
+        return 0 <= nr < len(self) and self.entry_count(nr) > 0
+
+    def cluster_nr(self, cluster):
+        return int(str(cluster).split("_")[-1])
+
+    def entry_count(self, cluster):
+        nr = self.cluster_nr(cluster)
+        return self.starts[nr+1] - self.starts[nr]
+
+    def raw(self, cluster):
+        """Returns all FASTA records of the cluster as bytes, centroid first.
+        """
+        nr = self.cluster_nr(cluster)
+        records = []
+        for i in range(self.starts[nr], self.starts[nr+1]):
+            offset = self.offsets[i]
+            records.append(self.data[offset:offset+self.lengths[i]])
+
+        return b"".join(records)
+
+    def read(self, cluster):
+        """Returns all FASTA records of the cluster as text, centroid first.
+        """
+        return self.raw(cluster).decode()
+
+    def records(self, cluster, text=True):
+        """Returns the (header, sequence) of every entry of the cluster, see
+        fasta.parse_fasta.
+        """
+        return list(parse_fasta(self.raw(cluster), text=text))
+
+    def lines(self, cluster):
+        """Returns the lines of the cluster, as read from a cluster file.
+        """
+        return [
+            f"{line}\n" for line in self.read(cluster).split("\n")[:-1]
+        ]
+
+    def headers(self, cluster):
+        """Returns the header lines, without newlines, of the cluster.
+        """
+        return [
+            line.rstrip("\n") for line in self.lines(cluster)
+            if line[0] == ">"
+        ]
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.data = None
@@ -2,16 +2,38 @@
 flags, manual review and correction and all related functions.
 """
 
-from .handling import return_proj_path, tax_list_to_str, sequence_quality_check
+from .handling import return_proj_path, sequence_quality_check
 from .handling import return_removed_path
+from .cluster_store import ClusterStore, uc_entry_label
+from .telemetry import add_count
+from .incremental import content_key, load_previous, write_reuse
+from .incremental import cluster_key, stamped_key, stamp_matches
+from .incremental import StampedTaxDB
+from .taxonomy import TaxonomyTrie, no_origin
+from .dictionary import TaxDictionary
 import os
-import subprocess
+import re
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from itertools import islice
 
 #: global list of accepted/excluded flags for prompt_accept/exclude flags
 accepted_flags = []
 excluded_flags = []
 
+#: clusters per shard of repr_and_flag, shards are calculated in parallel
+repr_shard_size = 2000
+
+#: entries per shard of create_cluster_tax, shards are processed in parallel
+cluster_tax_shard_size = 20000
+
+#: taxonomy database of a create_cluster_tax worker process
+worker_tax_db = ''
+
+#: clusters of the previous build of a create_cluster_tax worker process
+worker_prev_clusters = {}
+
 
 class Cluster:
     """Cluster class, this contains the cluster label and all entries in the
@@ -75,117 +97,87 @@ class Cluster:
 
 
 def create_taxdb(run_label):
-    """Creates a taxonomy database from all entries, no chloro/mito.
+    """Creates a taxonomy database from all entries, no chloro/mito. Headers
+    are streamed from the 100 uc file, filtered and reduced to the best
+    taxonomy of every genus in one pass.
     """
     run_path = return_proj_path(run_label) + '100'
-    cluster_dir = run_path + '/clusters/'
-    tax_db_tmp_file = run_path + '/tax_db_tmp'
-    tax_db_raw_file = run_path + '/tax_db_raw'
-    tax_cmd = []
-
-    #: finds all sequences from all cluster files (starts with '>')
-    cmd_grep_reg = "grep -r \">\" {}".format(cluster_dir)
-    #: gets only taxonomy (everything after first space)
-    cmd_cut = "cut -d ' ' -f 2-"
-    #: filters out Archaea, Bacteria, chlor/mito, etc
-    cmd_grep_seq = "grep -v {can} {mit} {chl} {sam} {low} {sp}".format(
-        can="-e \";Candidatus;\"",
-        mit="-e \";Mitochondria;\"",
-        chl="-e \";Chloroplast;\"",
-        sam="-e \"sample\"",
-        low="-e \";[a-z]\"",
-        sp="-e \"sp.$\"",
-    )
-    #: removes all non-uniques from the list (and sorting)
-    cmd_sort = "sort -u"
-
-    tax_cmd = "{gr} | {ct} | {gs} | {st} > {tf}".format(
-        gr=cmd_grep_reg,
-        ct=cmd_cut,
-        gs=cmd_grep_seq,
-        st=cmd_sort,
-        tf=tax_db_tmp_file
-    )
+    uc_file = run_path + '/uc'
+    tax_db_file = run_path + '/tax_db'
+    taxes = {}
+
+    with open(uc_file, 'r') as read_uc:
+        for line in read_uc:
+            curr_line = line.rstrip("\n").split("\t")
+
+            if curr_line[0] == "S" or curr_line[0] == "H":
+                label = uc_entry_label(curr_line)
+                #: taxonomy is everything after the first space
+                if " " in label:
+                    tax = label.split(" ", 1)[1]
+                else:
+                    tax = label
+
+                genus_tax = taxdb_genus_tax(tax)
+                if genus_tax:
+                    genus = genus_tax.split(";")[-1]
+                    taxes[genus] = best_taxdb_tax(taxes.get(genus), genus_tax)
+
+    with open(tax_db_file, 'w') as tax_db:
+        for tax in sorted(taxes.values()):
+            tax_db.write(tax + "\n")
 
-    #: runs the command
-    subprocess.run(tax_cmd, shell=True)
-    #: processing the raw file, creating the tax_db file
-    process_taxdb(run_label)
-    #: removing the raw file
-    os.remove(tax_db_raw_file)
-    os.remove(tax_db_tmp_file)
+    add_count("genera", len(taxes))
 
 
-def process_taxdb(run_label):
-    """Processing the tax_db_raw file, creating a database of all "correct"
-    unique genus entries and their taxonomy, correct taxonomy defined as the
-    one with genus as the last taxonomic category before species and the
-    taxonomy with most taxonomic categories.
+def taxdb_genus_tax(tax):
+    """Returns the taxonomy down to genus for the taxonomy database, or an
+    empty string if the taxonomy is filtered out (Candidatus, chloro/mito,
+    samples, lowercase categories, unnamed species).
     """
-    run_path = return_proj_path(run_label) + '100'
-    tax_db_tmp_file = run_path + '/tax_db_tmp'
-    tax_db_raw_file = run_path + '/tax_db_raw'
-    tax_db_file = run_path + '/tax_db'
-    taxes = {}
-    final_taxes = {}
+    for excluded in (";Candidatus;", ";Mitochondria;", ";Chloroplast;"):
+        if excluded in tax:
+            return ""
+    if "sample" in tax or re.search(";[a-z]", tax) or re.search("sp.$", tax):
+        return ""
 
-    with open(tax_db_tmp_file, 'r') as tmp_file, \
-         open(tax_db_raw_file, 'w') as out_file:
+    tax = tax.rstrip()
+    species = tax.split(";")[-1]
+    if not species or not species[0].isupper():
+        return ""
 
-        for line in tmp_file:
-            curr_line = line.rstrip()
+    genus = species.split(" ")[0]
+    if genus == "Candidatus":
+        genus = " ".join(species.split(" ")[:2])
 
-            if curr_line.split(";")[-1][0].isupper():
-                tax = ";".join(curr_line.split(";")[:-1])
-                genus = curr_line.split(";")[-1].split(" ")[0]
-                new_tax = ""
+    return "{};{}".format(";".join(tax.split(";")[:-1]), genus)
 
-                if genus == "Candidatus":
-                    genus = " ".join(curr_line.split(";")[-1].split(" ")[:2])
 
-                new_tax = "{};{}\n".format(tax, genus)
-                out_file.write(new_tax)
+def best_taxdb_tax(curr_tax, new_tax):
+    """Returns the best of two taxonomies of the same genus, "correct"
+    taxonomy defined as the one with genus as the last taxonomic category
+    before species, then the one with most taxonomic categories.
+    """
+    if not curr_tax:
+        return new_tax
 
-    with open(tax_db_raw_file, 'r') as raw_file:
+    genus = new_tax.split(";")[-1].split(" ")[0]
+    curr_correct = curr_tax.split(";")[-2] == genus
+    new_correct = new_tax.split(";")[-2] == genus
 
-        for line in raw_file:
-            species = ''
-            genus = ''
+    #: if correct taxonomy found, uses genus as category
+    if curr_correct != new_correct:
+        if new_correct:
+            return new_tax
+        return curr_tax
 
-            curr_line = line.rstrip()
-            tax_cats = ";".join(curr_line.split(";")[:-1])
-            species = curr_line.split(";")[-1]
-            tax_species = "{};{}".format(tax_cats, species)
-            genus = curr_line.split(";")[-1].split(" ")[0]
-
-            if species:
-                if species not in taxes:
-                    taxes[species] = tax_species
-                else:
-                    dict_genus = taxes[species].split(";")[-2]
-                    sp_genus = tax_species.split(";")[-2]
-                    dict_len = len(taxes[species].split(";"))
-                    sp_len = len(tax_species.split(";"))
-
-                    #: if correct taxonomy found, uses genus as category
-                    if (
-                        dict_genus != genus
-                        and sp_genus == genus
-                    ):
-                        taxes[species] = tax_species
-
-                    #: if both either correct or wrong
-                    #: but new is longer (more taxonomic categories)
-                    elif (
-                        sp_len > dict_len
-                        and ((dict_genus == genus and sp_genus == genus)
-                             or dict_genus != genus and sp_genus != genus)
-                    ):
-                        taxes[species] = tax_species
+    #: if both either correct or wrong, the longer (first sorted if tied)
+    curr_len = len(curr_tax.split(";"))
+    new_len = len(new_tax.split(";"))
+    if new_len > curr_len or (new_len == curr_len and new_tax < curr_tax):
+        return new_tax
 
-    with open(tax_db_file, 'w') as tax_db:
-        for sp in taxes:
-            tax_db.write(taxes[sp] + "\n")
+    return curr_tax
 
 
 def read_taxdb(run_label):
@@ -314,175 +306,396 @@ def create_cluster_tax(
                        qc_taxonomy_quality,
                        qc_sequence_quality,
                        loop=False,
-                       gene_marker=""
+                       gene_marker="",
+                       cpu=1
                        ):
     """Create a tax_clusters file, this contains the label for each cluster
-    followed by the label + taxonomy of all hits in the cluster.
+    followed by the label + taxonomy of all hits in the cluster. Clusters are
+    processed in shards over cpu processes, every shard collects its output
+    and removed clusters/entries, which are written in the order of the
+    clusters so the files do not depend on cpu. At 100 the result of every
+    cluster is stored by its key, clusters with the same records and tax_db
+    stamp in the previous build reuse it, and the stamped key of every
+    cluster is written to cluster_keys for repr_and_flag and flag_correction.
     """
     run_path = return_proj_path(run_label) + str_id
     removed_path = return_removed_path(run_label)
     uc_file = run_path + "/uc"
     tax_clusters_file = run_path + "/tax_clusters"
-    cluster_dir = run_path + "/clusters"
     tax_db = ''
+    deleted_clusters_file = removed_path + "deleted_clusters_100"
     deleted_entries_file = removed_path + "deleted_entries_100"
+    cluster_keys_file = run_path + "/cluster_keys"
     if not loop and qc_taxonomy_quality:
         tax_db = read_taxdb(run_label)
+    prev_clusters = {}
+    if not loop:
+        prev_clusters = load_previous(run_label, "cluster_tax")
+    reuse_clusters = {}
+    settings = (
+        run_label,
+        str_id,
+        qc_taxonomy_quality,
+        qc_sequence_quality,
+        loop,
+        gene_marker
+    )
+    workers = max(1, int(cpu))
+    n_clusters = 0
+    n_entries = 0
+    n_reused = 0
+
+    with open(tax_clusters_file, 'w') as clust_out, ExitStack() as stack:
+        keys_out = None
+        if not loop:
+            keys_out = stack.enter_context(open(cluster_keys_file, 'w'))
+        executor = None
+        if workers > 1:
+            executor = stack.enter_context(ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=init_cluster_tax_worker,
+                initargs=(tax_db, prev_clusters)
+            ))
 
-    with open(tax_clusters_file, 'w') as clust_out, \
-         open(uc_file, 'r') as read_uc:
+        shards = cluster_tax_shards(uc_file, loop)
+        while True:
+            batch = list(islice(shards, workers * 4))
+            if not batch:
+                break
 
+            if executor is None:
+                results = [
+                    cluster_tax_shard(
+                        shard,
+                        run_path,
+                        settings,
+                        tax_db,
+                        prev_clusters
+                    )
+                    for shard in batch
+                ]
+            else:
+                results = executor.map(
+                    cluster_tax_shard,
+                    batch,
+                    [run_path] * len(batch),
+                    [settings] * len(batch)
+                )
+
+            for result in results:
+                out_text, del_clusters, del_entries, n_c, n_e, reuse = result
+                clust_out.write(out_text)
+                if del_clusters:
+                    with open(deleted_clusters_file, 'a+') as f:
+                        f.write(del_clusters)
+                if del_entries:
+                    with open(deleted_entries_file, 'a+') as f:
+                        f.write(del_entries)
+                n_clusters += n_c
+                n_entries += n_e
+                for label, key, stamp, stored, reused in reuse:
+                    reuse_clusters[key] = (stamp, stored)
+                    keys_out.write("{}\t{}\n".format(
+                        label,
+                        stamped_key(key, stamp).hex()
+                    ))
+                    if reused:
+                        n_reused += 1
+
+        clust_out.write("end")
+
+    if not loop:
+        write_reuse(run_label, "cluster_tax", reuse_clusters)
+
+    add_count("clusters", n_clusters)
+    add_count("entries", n_entries)
+    add_count("reused", n_reused)
+
+
+def cluster_tax_shards(uc_file, loop):
+    """Yields shards of the clusters with more than one entry in a uc file,
+    lists of (cluster number, new cluster number) with about
+    cluster_tax_shard_size entries each.
+    """
+    shard = []
+    shard_entries = 0
+
+    with open(uc_file, 'r') as read_uc:
         for line in read_uc:
             curr_line = line.rstrip().split("\t")
 
             if curr_line[0] == "C" and int(curr_line[2]) > 1:
                 curr_cluster = curr_line[1]
-                cluster_file = cluster_dir + "/cluster_" + curr_cluster
-
-                with open(cluster_file, 'r') as read_cluster:
-                    tax_nr = 0
-                    id_dict = {}
-                    orig_dict = {}
-                    cm_dict = {}
-                    upd_cm_dict = {}
-                    out_dict = {}
-                    deleted_entries = {}
-                    new_cluster = curr_cluster
-
-                    if loop:
-                        new_cluster = curr_line[9].split("_")[-1]
-                        clust_out.write("MQR_{}_{}_{}\n".format(
-                                                             run_label,
-                                                             str_id,
-                                                             new_cluster
-                                                             ))
-
-                    sequence = ""
-                    for lines in read_cluster:
-                        if lines[0] == ">":
-                            if loop:
-                                loop_line = lines.rstrip().split("\t")
-                                loop_tlabel = loop_line[0]
-                                loop_clabel = "MQR_{}_{}_{}".format(
-                                    run_label,
-                                    str_id,
-                                    loop_line[1].split("_")[-1]
-                                )
-                                loop_repr = loop_line[2]
-
-                                curr_id = "{} {}".format(
-                                    loop_tlabel,
-                                    loop_repr
-                                )
-                                clust_out.write("{}\n".format(curr_id))
-                            else:
-                                #: sequence quality check
-                                if qc_sequence_quality and sequence:
-                                    if not sequence_quality_check(
-                                                                  sequence,
-                                                                  gene_marker
-                                    ):
-                                        deleted_entries[tax_nr-1] = curr_line
-                                    sequence = ""
-
-                                curr_line = remove_cf_line(lines.rstrip())
-                                curr_id = curr_line.split(" ")[0]
-                                id_dict[tax_nr] = curr_id
-                                curr_tax = " ".join(curr_line.split(" ")[1:])
-                                orig_dict[tax_nr] = curr_tax
-                                curr_genus = curr_tax.split(
-                                    ";")[-1].split(" ")[0]
-                                if curr_genus == "Candidatus":
-                                    curr_genus = curr_genus = " ".join(
-                                        curr_tax.split(";")[-1].split(" ")[:2]
-                                    )
-
-                                #: adding chloro/mito taxonomies
-                                #: avoiding native entries (like NCBI)
-                                cm_line = curr_tax.split(";")
-                                if (
-                                    "Chloroplast" in cm_line[1:]
-                                    or "Mitochondria" in cm_line[1:]
-                                ):
-                                    cm_dict[tax_nr] = curr_tax
-                                #: checking tax and replacing/removing for rest
-                                elif qc_taxonomy_quality:
-                                    if (
-                                        "Chloroplast" in cm_line[0]
-                                        or "Mitochondria" in cm_line[0]
-                                    ):
-                                        pass
-                                    elif curr_genus in tax_db:
-                                        curr_species = curr_tax.split(";")[-1]
-                                        curr_tax_entry = ";".join(
-                                            curr_tax.split(";")[:-1]
-                                            + [curr_genus]
-                                        )
-                                        tax_db_entry = tax_db[curr_genus]
-
-                                        if compare_tax_cats(
-                                            curr_tax_entry, tax_db_entry
-                                        ):
-                                            new_tax = ";".join(
-                                                tax_db_entry.split(";")[:-1]
-                                                + [curr_species]
-                                                )
-                                            orig_dict[tax_nr] = new_tax
-                                        else:
-                                            deleted_entries[tax_nr] = curr_line
-
-                            tax_nr += 1
+                new_cluster = curr_cluster
+                if loop:
+                    new_cluster = curr_line[9].split("_")[-1]
 
-                        else:
-                            sequence += lines.rstrip()
+                shard.append((curr_cluster, new_cluster))
+                shard_entries += int(curr_line[2])
+                if shard_entries >= cluster_tax_shard_size:
+                    yield shard
+                    shard = []
+                    shard_entries = 0
+
+    if shard:
+        yield shard
 
-                    #: checks last entry
-                    if qc_sequence_quality and sequence and not loop:
-                        if not sequence_quality_check(
-                                                      sequence,
-                                                      gene_marker
+
+def init_cluster_tax_worker(tax_db, prev_clusters):
+    """Sets the taxonomy database and the clusters of the previous build of a
+    create_cluster_tax worker process.
+    """
+    global worker_tax_db, worker_prev_clusters
+    worker_tax_db = tax_db
+    worker_prev_clusters = prev_clusters
+
+
+def cluster_tax_shard(
+                      shard,
+                      run_path,
+                      settings,
+                      tax_db=None,
+                      prev_clusters=None
+                      ):
+    """Processes a shard of clusters for create_cluster_tax. Returns the
+    tax_clusters text, the removed clusters and the removed entries of the
+    shard, the number of clusters and entries, and the (label, key, tax_db
+    stamp, stored result, reused) of every cluster at 100. The taxonomy
+    database and previous clusters of the worker process are used if tax_db
+    is not given.
+    """
+    if tax_db is None:
+        tax_db = worker_tax_db
+        prev_clusters = worker_prev_clusters
+    run_label, str_id = settings[:2]
+    loop = settings[4]
+    out_lines = []
+    deleted_clusters = []
+    deleted_lines = []
+    reuse = []
+    n_entries = 0
+
+    with ClusterStore(run_path) as store:
+        for curr_cluster, new_cluster in shard:
+            if loop:
+                cluster_lines, deleted_cluster, deleted_entries, tax_nr = \
+                    cluster_tax_entries(
+                        store.records(curr_cluster),
+                        new_cluster,
+                        tax_db,
+                        *settings
+                    )
+            else:
+                label = "MQR_{}_{}_{}".format(run_label, str_id, new_cluster)
+                key, stamp, stored, reused = stored_cluster_tax(
+                    store,
+                    curr_cluster,
+                    tax_db,
+                    prev_clusters,
+                    settings
+                )
+                reuse.append((label, key, stamp, stored, reused))
+                entries, deleted, deleted_entries, tax_nr = stored
+                cluster_lines = []
+                deleted_cluster = ''
+                if deleted:
+                    deleted_cluster = label
+                else:
+                    cluster_lines = [label] + entries
+
+            out_lines.extend(cluster_lines)
+            if deleted_cluster:
+                deleted_clusters.append(deleted_cluster)
+            deleted_lines.extend(deleted_entries)
+            n_entries += tax_nr
+
+    return (
+        "".join([line + "\n" for line in out_lines]),
+        "".join([line + "\n" for line in deleted_clusters]),
+        "".join([line + "\n" for line in deleted_lines]),
+        len(shard),
+        n_entries,
+        reuse
+    )
+
+
+def stored_cluster_tax(store, curr_cluster, tax_db, prev_clusters, settings):
+    """Returns the key, tax_db stamp and stored result of a cluster at 100,
+    and if the result was reused from the previous build. The stored result
+    is the entries without the label, if the cluster is removed, the removed
+    entries and the number of entries, see cluster_tax_entries.
+    """
+    key = cluster_key(store.raw(curr_cluster), settings[1:])
+    if key in prev_clusters:
+        stamp, stored = prev_clusters[key]
+        if stamp_matches(stamp, tax_db):
+            return key, stamp, stored, True
+
+    stamped_db = tax_db
+    stamp = {}
+    if isinstance(tax_db, dict):
+        stamped_db = StampedTaxDB(tax_db)
+        stamp = stamped_db.stamp
+    cluster_lines, deleted_cluster, deleted_entries, tax_nr = \
+        cluster_tax_entries(
+            store.records(curr_cluster),
+            '',
+            stamped_db,
+            *settings
+        )
+    stored = (
+        cluster_lines[1:],
+        bool(deleted_cluster),
+        deleted_entries,
+        tax_nr
+    )
+
+    return key, stamp, stored, False
+
+
+def cluster_tax_entries(
+                        read_cluster,
+                        new_cluster,
+                        tax_db,
+                        run_label,
+                        str_id,
+                        qc_taxonomy_quality,
+                        qc_sequence_quality,
+                        loop,
+                        gene_marker
                         ):
-                            deleted_entries[tax_nr-1] = curr_line
-
-                    #: fixes chloro/mito taxonomies
-                    if cm_dict:
-                        upd_cm_dict = find_taxonomy(cm_dict, tax_db, str_id)
-                        for k, v in orig_dict.items():
-                            if k not in upd_cm_dict:
-                                upd_cm_dict[k] = v
-                        out_dict = upd_cm_dict
+    """Creates the tax_clusters lines of one cluster from its records,
+    checking the taxonomy and sequence quality of every entry. Returns the
+    lines, the label of the cluster if all its entries are removed, the
+    removed entries and the number of entries.
+    """
+    tax_nr = 0
+    id_dict = {}
+    orig_dict = {}
+    cm_dict = {}
+    upd_cm_dict = {}
+    out_dict = {}
+    deleted_entries = {}
+    deleted_cluster = ''
+    out_lines = []
+
+    if loop:
+        out_lines.append("MQR_{}_{}_{}".format(
+                                            run_label,
+                                            str_id,
+                                            new_cluster
+                                            ))
+
+    for header, sequence in read_cluster:
+        if loop:
+            loop_line = header.split("\t")
+            loop_tlabel = ">" + loop_line[0]
+            loop_clabel = "MQR_{}_{}_{}".format(
+                run_label,
+                str_id,
+                loop_line[1].split("_")[-1]
+            )
+            loop_repr = loop_line[2]
+
+            curr_id = "{} {}".format(
+                loop_tlabel,
+                loop_repr
+            )
+            out_lines.append(curr_id)
+        else:
+            curr_line = remove_cf_line(f">{header}")
+            curr_id = curr_line.split(" ")[0]
+            id_dict[tax_nr] = curr_id
+            curr_tax = " ".join(curr_line.split(" ")[1:])
+            orig_dict[tax_nr] = curr_tax
+            curr_genus = curr_tax.split(
+                ";")[-1].split(" ")[0]
+            if curr_genus == "Candidatus":
+                curr_genus = curr_genus = " ".join(
+                    curr_tax.split(";")[-1].split(" ")[:2]
+                )
+
+            #: adding chloro/mito taxonomies
+            #: avoiding native entries (like NCBI)
+            cm_line = curr_tax.split(";")
+            if (
+                "Chloroplast" in cm_line[1:]
+                or "Mitochondria" in cm_line[1:]
+            ):
+                cm_dict[tax_nr] = curr_tax
+            #: checking tax and replacing/removing for rest
+            elif qc_taxonomy_quality:
+                if (
+                    "Chloroplast" in cm_line[0]
+                    or "Mitochondria" in cm_line[0]
+                ):
+                    pass
+                elif curr_genus in tax_db:
+                    curr_species = curr_tax.split(";")[-1]
+                    curr_tax_entry = ";".join(
+                        curr_tax.split(";")[:-1]
+                        + [curr_genus]
+                    )
+                    tax_db_entry = tax_db[curr_genus]
+
+                    if compare_tax_cats(
+                        curr_tax_entry, tax_db_entry
+                    ):
+                        new_tax = ";".join(
+                            tax_db_entry.split(";")[:-1]
+                            + [curr_species]
+                            )
+                        orig_dict[tax_nr] = new_tax
                     else:
-                        out_dict = orig_dict
-
-                    #: writing out the entries from the cluster
-                    if not loop and len(deleted_entries) < len(out_dict):
-                        clust_out.write("MQR_{}_{}_{}\n".format(
-                                                             run_label,
-                                                             str_id,
-                                                             new_cluster
-                                                             ))
-                        for i in out_dict:
-                            if i not in deleted_entries:
-                                curr_id = "{} {}".format(
-                                    id_dict[i],
-                                    out_dict[i]
-                                )
-                                clust_out.write("{}\n".format(curr_id))
-                    elif not loop and len(deleted_entries) == len(out_dict):
-                        exc_clusters = removed_path + "deleted_clusters_100"
-                        with open(exc_clusters, 'a+') as f:
-                            f.write("MQR_{}_{}_{}\n".format(
-                                                         run_label,
-                                                         str_id,
-                                                         new_cluster
-                            ))
-
-                    if deleted_entries:
-                        with open(deleted_entries_file, 'a+') as f:
-                            for entry in deleted_entries:
-                                f.write(deleted_entries[entry] + "\n")
+                        deleted_entries[tax_nr] = curr_line
 
-        clust_out.write("end")
+            #: sequence quality check
+            if qc_sequence_quality and sequence:
+                if not sequence_quality_check(
+                                              sequence,
+                                              gene_marker
+                ):
+                    deleted_entries[tax_nr] = curr_line
+
+        tax_nr += 1
+
+    #: fixes chloro/mito taxonomies
+    if cm_dict:
+        upd_cm_dict = find_taxonomy(cm_dict, tax_db, str_id)
+        for k, v in orig_dict.items():
+            if k not in upd_cm_dict:
+                upd_cm_dict[k] = v
+        out_dict = upd_cm_dict
+    else:
+        out_dict = orig_dict
+
+    #: writing out the entries from the cluster
+    if not loop and len(deleted_entries) < len(out_dict):
+        out_lines.append("MQR_{}_{}_{}".format(
+                                            run_label,
+                                            str_id,
+                                            new_cluster
+                                            ))
+        for i in out_dict:
+            if i not in deleted_entries:
+                curr_id = "{} {}".format(
+                    id_dict[i],
+                    out_dict[i]
+                )
+                out_lines.append(curr_id)
+    elif not loop and len(deleted_entries) == len(out_dict):
+        deleted_cluster = "MQR_{}_{}_{}".format(
+            run_label,
+            str_id,
+            new_cluster
+        )
+
+    return (
+        out_lines,
+        deleted_cluster,
+        list(deleted_entries.values()),
+        tax_nr
+    )
 
 
 def compare_tax_cats(tax_in, tax_db):
@@ -514,108 +727,79 @@ def remove_cf_line(tax_line):
     return tax_line.replace('cf. ', '')
 
 
-def flag_check(cluster):
+def flag_check(trie, cluster):
     """Checks various flag scenarios and returns appropriate flags.
     """
     flag = ''
 
-    ori_flag = origin_flag(cluster)
+    ori_flag = origin_flag(trie, cluster)
     if ori_flag:
         flag += ori_flag + ", "
 
     return flag[:-2]
 
 
-def origin_flag(cluster):
+def origin_flag(trie, cluster):
     """Flags if there are more than one origin in the cluster. (Archaea,
     Bacteria, Chloroplast, Eukaryota, Mitochondria)
     """
-    arc_check = 0
-    bac_check = 0
-    chl_check = 0
-    euk_check = 0
-    mit_check = 0
     flag_out = ''
 
-    for tax in cluster:
-        if "Archaea" in tax:
-            arc_check = 1
-        elif "Bacteria" in tax:
-            bac_check = 1
-        elif "Chloroplast" in tax:
-            chl_check = 1
-        elif "Eukaryota" in tax:
-            euk_check = 1
-        elif "Mitochondria" in tax:
-            mit_check = 1
-
-        if (arc_check + bac_check + chl_check + euk_check + mit_check) > 1:
-            flag_out = "Origin"
-            break
+    found = {trie.origins[leaf] for leaf in cluster}
+    found.discard(no_origin)
+    if len(found) > 1:
+        flag_out = "Origin"
 
     return flag_out
 
 
-def find_spsplits(tax_cluster):
+def find_spsplits(trie, tax_cluster):
     """Gets how many words (split by spaces) in the entry with least words in
     the tax_cluster.
     """
-    sps = []
-
-    for tax in tax_cluster:
-        sps.append(len(tax[-1].split(" ")))
-
-    sp_splits = min(sps)
+    sp_splits = min([trie.words(tax) for tax in tax_cluster])
 
     return sp_splits
 
 
-def repr_taxonomy(tax_cluster, algo_run):
+def repr_taxonomy(trie, tax_cluster, algo_run):
     """Calculates the representative taxonomy for a cluster, checking species
     first and the continuing down to lower categories. Returning representative
-    taxonomy and any flags.
+    taxonomy and any flags. The cluster is a list of leaf nodes in the
+    taxonomy trie.
     """
     repr_tax = 'Mismatch'  # if no repr_tax is found
     flag = ''
     found = False
-    sp_splits = find_spsplits(tax_cluster)
+    #: checks of single entries are done once per distinct taxonomy
+    leaves = set(tax_cluster)
+    sp_splits = find_spsplits(trie, leaves)
     opt = ''
-    shortest = 20
-    undef = 'undefined taxonomy'
-    undef_all = all(undef in ls for ls in [lst for lst in tax_cluster])
-    new_cluster = []
+    shortest = min(20, min([trie.depths[tax] for tax in leaves]))
+    undef_all = all(trie.undefined[tax] for tax in leaves)
+    upper = {tax: trie.name(tax)[0].isupper() for tax in leaves}
 
     #: includes undef if all in the list are undef
-    for tax in tax_cluster:
-        if len(tax) < shortest:
-            shortest = len(tax)
-        if undef_all:
-            if tax[-1][0].isupper():
-                new_cluster.append(tax)
-        else:
-            if tax[-1][0].isupper() and undef not in tax:
-                new_cluster.append(tax)
+    new_cluster = [
+        tax for tax in tax_cluster
+        if upper[tax] and (undef_all or not trie.undefined[tax])
+    ]
 
     #: if all species start with lower character 'uncultured x'...
     if not new_cluster:
-        for tax in tax_cluster:
-            if undef_all:
-                new_cluster.append(tax)
-            else:
-                if undef not in tax:
-                    new_cluster.append(tax)
+        new_cluster = [
+            tax for tax in tax_cluster
+            if undef_all or not trie.undefined[tax]
+        ]
 
     #: loop for species
     opt = 'species'
     for i in range(sp_splits):
-        curr_cluster = []
-        for tax in new_cluster:
-            stripped_tax = tax[:-1]
-            sp_tax = " ".join((tax[-1].split(" ")[:(sp_splits-i)]))
-            stripped_tax.append(sp_tax)
-            curr_cluster.append(stripped_tax)
+        cut = {tax: trie.species(tax, sp_splits-i) for tax in leaves}
+        curr_cluster = [cut[tax] for tax in new_cluster]
 
         found, new_repr_tax, new_flag = calc_repr_taxonomy(
+            trie,
             curr_cluster,
             opt,
             algo_run
@@ -644,12 +828,17 @@ def repr_taxonomy(tax_cluster, algo_run):
             start = 2
 
         for i in range(start, shortest):
-            curr_cluster = []
-            for tax in tax_cluster:
-                if tax[:i+1][-1][0].isupper():
-                    curr_cluster.append(tax[:i+1])
+            categories = {tax: trie.path(tax)[i] for tax in leaves}
+            upper = {
+                tax: trie.name(category)[0].isupper()
+                for tax, category in categories.items()
+            }
+            curr_cluster = [
+                categories[tax] for tax in tax_cluster if upper[tax]
+            ]
             if curr_cluster:
                 found, new_repr_tax, new_flag = calc_repr_taxonomy(
+                    trie,
                     curr_cluster,
                     opt,
                     algo_run
@@ -667,7 +856,7 @@ def repr_taxonomy(tax_cluster, algo_run):
         repr_tax = ";".join(repr_tax.split(";")[:-1])
 
     #: fix flag
-    tmp_flag = flag_check(tax_cluster)
+    tmp_flag = flag_check(trie, leaves)
     if tmp_flag and tmp_flag not in flag.split(", "):
         flag += tmp_flag + ", "
     if repr_tax == 'Mismatch':
@@ -676,32 +865,30 @@ def repr_taxonomy(tax_cluster, algo_run):
     return flag[:-2], repr_tax
 
 
-def calc_repr_taxonomy(tax_cluster, opt, algo_run):
+def calc_repr_taxonomy(trie, tax_cluster, opt, algo_run):
     """Gets the representative taxonomy for species, first checking if all
     entries in the cluster are equal then checking if they match using the
-    algorithm.
+    algorithm. Equal taxonomies are the same node, equal species the same
+    name id.
     """
     eq_tax = True
-    repr_tax = ''
-    pruned_tax_cluster = []
-    for tax in tax_cluster:
-        if len(tax) >= 2:
-            pruned_tax_cluster.append(tax)
-            repr_tax = tax
-        else:
-            repr_tax = tax_cluster[0]
+    pruned_tax_cluster = [tax for tax in tax_cluster if trie.depths[tax] >= 2]
+    if trie.depths[tax_cluster[-1]] >= 2:
+        repr_tax = tax_cluster[-1]
+    else:
+        repr_tax = tax_cluster[0]
 
     flag = ''
     mc = []
     if pruned_tax_cluster:
         for tax in pruned_tax_cluster:
             if opt == 'species':
-                if tax[-1] != repr_tax[-1]:
+                if trie.name_of[tax] != trie.name_of[repr_tax]:
                     eq_tax = False
                     break
-                if len(tax) > len(repr_tax):
+                if trie.depths[tax] > trie.depths[repr_tax]:
                     repr_tax = tax
-                mc.append(tax[-2])
+                mc.append(trie.name_of[trie.parents[tax]])
 
             elif opt == 'rest':
                 if tax != repr_tax:
@@ -711,7 +898,7 @@ def calc_repr_taxonomy(tax_cluster, opt, algo_run):
         if opt == 'species' and eq_tax:
             mc_term = Counter(mc).most_common(1)[0][0]
             for tax in tax_cluster:
-                if mc_term in tax:
+                if trie.contains(tax, mc_term):
                     repr_tax = tax
                     break
     else:
@@ -724,36 +911,27 @@ def calc_repr_taxonomy(tax_cluster, opt, algo_run):
             eq_tax = False
 
     if not eq_tax and algo_run:
-        eq_tax, repr_tax, flag = algo_repr(tax_cluster, opt)
+        eq_tax, repr_tax, flag = algo_repr(trie, tax_cluster, opt)
 
-    return eq_tax, tax_list_to_str(repr_tax), flag
+    return eq_tax, trie.string(repr_tax), flag
 
 
-def algo_repr(tax_cluster, opt):
+def algo_repr(trie, tax_cluster, opt):
     """Algorithm used to calculate representative taxonomy in cluster, looking
     for highest fraction and calculating if smaller fraction(s) are just
-    wrongly annotated.
+    wrongly annotated. Species are counted by name id, other categories by
+    node.
     """
-    new_cluster = []
-    repr_tax = ''
+    repr_tax = 0
     found = False
     flag = ''
 
     if len(tax_cluster) > 10:
-        for tax in tax_cluster:
-            if opt == 'species':
-                new_cluster.append(tax[-1])
-            elif opt == 'rest':
-                new_cluster.append(";".join(tax))
-
-        c_cluster = []
-        high_fract = 0.0
-        total_count = 0
-        highest = 0
-        c_cluster = Counter(new_cluster)
-        mc = c_cluster.most_common(1)
-        repr_tax = mc[0][0].split(";")
-        highest = mc[0][1]
+        if opt == 'species':
+            c_cluster = Counter([trie.name_of[tax] for tax in tax_cluster])
+        else:
+            c_cluster = Counter(tax_cluster)
+        mc_term, highest = c_cluster.most_common(1)[0]
         total_count = len(tax_cluster)
 
         high_fract = highest/total_count
@@ -761,9 +939,11 @@ def algo_repr(tax_cluster, opt):
             found = True
             if opt == 'species':
                 for tax in tax_cluster:
-                    if repr_tax[0] in tax:
+                    if trie.contains(tax, mc_term):
                         repr_tax = tax
                         break
+            else:
+                repr_tax = mc_term
 
     return found, repr_tax, flag
 
@@ -810,11 +990,103 @@ def flag_header(str_id, run_label):
     return header
 
 
-def repr_and_flag(str_id, run_label):
+def read_tax_clusters(tax_clusters_file):
+    """Yields (label, entries) for every cluster in a tax_clusters file.
+    """
+    with open(tax_clusters_file, 'r') as tax_file:
+        first_line = True
+        curr_cluster = []
+        c_label = ''
+
+        for line in tax_file:
+            curr_line = line.rstrip()
+            if (curr_line[0:3] == 'MQR' or curr_line == 'end'):
+                if not first_line and curr_cluster:
+                    yield c_label, curr_cluster
+
+                c_label = curr_line
+                first_line = False
+                curr_cluster = []
+
+            else:
+                curr_cluster.append(curr_line)
+
+
+def read_cluster_keys(run_path):
+    """Returns the stamped key of every cluster by label, as written by
+    create_cluster_tax at 100.
+    """
+    cluster_keys = {}
+    with open(run_path + '/cluster_keys', 'r') as keys_file:
+        for line in keys_file:
+            label, key = line.rstrip().split("\t")
+            cluster_keys[label] = bytes.fromhex(key)
+
+    return cluster_keys
+
+
+def repr_shard(shard, algo_run):
+    """Calculates the representative taxonomy and flags of a shard of
+    clusters, each a list of taxonomy strings. Run in a worker process, with
+    its own taxonomy trie.
+    """
+    trie = TaxonomyTrie()
+    results = []
+    for taxes in shard:
+        flag, repr_tax = repr_taxonomy(
+            trie,
+            [trie.leaf(tax) for tax in taxes],
+            algo_run
+        )
+        results.append((flag, repr_tax))
+
+    return results
+
+
+def calc_reprs(batch, reprs, prev_reprs, algo_run, executor):
+    """Calculates the representative taxonomy and flags of all clusters in a
+    batch of (key, taxonomies) that are not in reprs or prev_reprs. The
+    clusters are split into shards of repr_shard_size, calculated by the
+    executor (process pool) or here if None. Returns a dictionary by key.
+    """
+    pending = {}
+    for repr_key, taxes in batch:
+        if repr_key not in reprs and repr_key not in prev_reprs:
+            pending[repr_key] = taxes
+
+    keys = list(pending)
+    shards = [
+        [pending[key] for key in keys[i:i+repr_shard_size]]
+        for i in range(0, len(keys), repr_shard_size)
+    ]
+    if executor is None:
+        shard_results = [repr_shard(shard, algo_run) for shard in shards]
+    else:
+        shard_results = executor.map(
+            repr_shard,
+            shards,
+            [algo_run] * len(shards)
+        )
+
+    results = {}
+    for i, shard_result in enumerate(shard_results):
+        start = i * repr_shard_size
+        results.update(zip(keys[start:start+repr_shard_size], shard_result))
+
+    return results
+
+
+def repr_and_flag(str_id, run_label, cpu=1):
     """Takes an identity (in str) and opens the corresponding tax_clusters
     file, where all clusters are iterated over. Each cluster is assigned a
     representative taxonomy and those that are considered unusual are flagged
-    for later manual review.
+    for later manual review. The result of every cluster is stored by its
+    stamped key at 100 (see create_cluster_tax) and by the taxonomies of its
+    entries below, clusters with the same key in this or the previous build
+    reuse it. Clusters are read in batches, the new clusters of
+    a batch are calculated in shards over cpu processes and written in order,
+    so the output does not depend on cpu. Below 100 the taxonomies are ids of
+    the taxonomy dictionary, decoded to calculate and encoded when written.
     """
     run_path = return_proj_path(run_label) + str_id
     tax_clusters_file = run_path + '/tax_clusters'
@@ -824,57 +1096,88 @@ def repr_and_flag(str_id, run_label):
         algo_run = True
     else:
         algo_run = False
+    cluster_keys = {}
+    if algo_run:
+        cluster_keys = read_cluster_keys(run_path)
+    prev_reprs = load_previous(run_label, f"repr_{str_id}")
+    reprs = {}
+    n_reused = 0
+    workers = max(1, int(cpu))
+    batch_size = repr_shard_size * workers * 4
+
+    with open(repr_clusters_file, 'w') as repr_file, \
+         open(flag_clusters_file, 'w') as flag_file, \
+         TaxDictionary(run_label) as tax_dict, \
+         ExitStack() as stack:
+
+        executor = None
+        if workers > 1:
+            executor = stack.enter_context(
+                ProcessPoolExecutor(max_workers=workers)
+            )
 
-    with open(tax_clusters_file, 'r') as tax_file, \
-         open(repr_clusters_file, 'w') as repr_file, \
-         open(flag_clusters_file, 'w') as flag_file:
-
-        first_line = True
-        curr_cluster = []
         header_dict = {}
-        c_label = ''
-        old_label = ''
-
-        for line in tax_file:
-            curr_line = line.rstrip()
-            if (curr_line[0:3] == 'MQR' or curr_line == 'end'):
-                old_label = c_label
+        n_clusters = 0
+        n_flagged = 0
+        clusters = read_tax_clusters(tax_clusters_file)
+
+        while True:
+            batch = []
+            for label, entries in islice(clusters, batch_size):
+                my_cluster = Cluster(label, entries)
+                taxes = my_cluster.get_taxesstring()
+                if algo_run:
+                    repr_key = cluster_keys[label]
+                else:
+                    taxes = [tax_dict.decode(tax) for tax in taxes]
+                    repr_key = content_key(taxes)
+                batch.append((my_cluster, repr_key, taxes))
+            if not batch:
+                break
 
-                if not first_line and curr_cluster:
-                    my_cluster = Cluster(old_label, curr_cluster)
-                    flag, repr_tax = repr_taxonomy(
-                                                   my_cluster.get_taxeslist(),
-                                                   algo_run
-                                                   )
+            results = calc_reprs(
+                [(repr_key, taxes) for _, repr_key, taxes in batch],
+                reprs,
+                prev_reprs,
+                algo_run,
+                executor
+            )
 
-                    my_cluster.change_flags(flag)
-                    my_cluster.change_reprtax(repr_tax)
+            for my_cluster, repr_key, _ in batch:
+                if repr_key in reprs:
+                    flag, repr_tax = reprs[repr_key]
+                elif repr_key in prev_reprs:
+                    flag, repr_tax = prev_reprs[repr_key]
+                    n_reused += 1
+                else:
+                    flag, repr_tax = results[repr_key]
+                reprs[repr_key] = (flag, repr_tax)
+                if not algo_run:
+                    repr_tax = tax_dict.encode(repr_tax)
+
+                my_cluster.change_flags(flag)
+                my_cluster.change_reprtax(repr_tax)
+                n_clusters += 1
+
+                repr_file.write("{}\t{}\n".format(
+                    my_cluster.get_label(),
+                    my_cluster.get_reprtax()
+                    ))
+                if my_cluster.get_flags():
+                    n_flagged += 1
+                    for flag in my_cluster.get_flags().split(", "):
+                        if flag not in header_dict:
+                            header_dict[flag] = 1
+                        else:
+                            header_dict[flag] += 1
 
-                    repr_file.write("{}\t{}\n".format(
+                    flag_file.write("{}\t{}\t{}\n".format(
                         my_cluster.get_label(),
-                        my_cluster.get_reprtax()
+                        my_cluster.get_reprtax(),
+                        my_cluster.get_flags()
                         ))
-                    if my_cluster.get_flags():
-                        for flag in my_cluster.get_flags().split(", "):
-                            if flag not in header_dict:
-                                header_dict[flag] = 1
-                            else:
-                                header_dict[flag] += 1
-
-                        flag_file.write("{}\t{}\t{}\n".format(
-                            my_cluster.get_label(),
-                            my_cluster.get_reprtax(),
-                            my_cluster.get_flags()
-                            ))
-                        for tax in my_cluster.get_entries():
-                            flag_file.write(tax + "\n")
-
-                c_label = curr_line
-                first_line = False
-                curr_cluster = []
-
-            else:
-                curr_cluster.append(curr_line)
+                    for tax in my_cluster.get_entries():
+                        flag_file.write(tax + "\n")
 
     #: creates a new file with the header at start, followed by all flags
     header_flag = '#\t'
@@ -890,6 +1193,11 @@ def repr_and_flag(str_id, run_label):
             flag_file.write(line)
         flag_file.write('end')
     os.remove(flag_clusters_file)
+    write_reuse(run_label, f"repr_{str_id}", reprs)
+
+    add_count("clusters", n_clusters)
+    add_count("flagged", n_flagged)
+    add_count("reused", n_reused)
 
 
 def confirm_accept_exclude(option, flag=''):
@@ -1235,8 +1543,9 @@ def prompt_remove(input, my_cluster):
     from the cluster and fed into the repr_tax function and a new suggestion
     is attained using the trimmed cluster.
     """
-    cluster = my_cluster.get_taxeslist()
+    cluster = my_cluster.get_taxesstring()
     algo_run = True
+    trie = TaxonomyTrie()
 
     remove_loop = True
     entries = input.split(" ")[1:]
@@ -1260,9 +1569,9 @@ def prompt_remove(input, my_cluster):
     new_cluster = []
     for i in range(len(cluster)):
         if i+1 not in removed_ids:
-            new_cluster.append(cluster[i])
+            new_cluster.append(trie.leaf(cluster[i]))
 
-    _, temp_repr_tax = repr_taxonomy(new_cluster, algo_run)
+    _, temp_repr_tax = repr_taxonomy(trie, new_cluster, algo_run)
 
     removed_ids_str = ''
     kept_ids_str = ''
@@ -1518,7 +1827,8 @@ def valid_input(input):
 def flag_correction(str_id, run_label, exclude_all=False):
     """Opens the flag file, and with the use of manual inputs corrects the
     flagged suggestions of representative taxonomy, into a new file with all
-    non-flagged suggestions.
+    non-flagged suggestions. Clusters with the same stamped key as a cluster
+    reviewed in the previous build get the same decision without review.
     """
     accepted_flags = []
     excluded_flags = []
@@ -1533,6 +1843,10 @@ def flag_correction(str_id, run_label, exclude_all=False):
         os.remove(flag_exclusions_file)
 
     rem_header = flag_header(str_id, run_label)
+    cluster_keys = read_cluster_keys(run_path)
+    prev_reviews = load_previous(run_label, "review")
+    reviews = {}
+    n_reused = 0
 
     with open(flag_clusters_file, 'r') as flag_file, \
          open(flag_correction_file, 'w') as corr_file:
@@ -1567,17 +1881,31 @@ def flag_correction(str_id, run_label, exclude_all=False):
                         repr_tax=old_repr,
                         flags=old_flags
                     )
-                    review, rem_header = run_correction(
-                        my_cluster,
-                        review,
-                        rem_header,
-                        exclude_all,
-                        run_label
-                    )
+                    review_key = cluster_keys[old_label]
+                    if review_key in prev_reviews:
+                        reuse_review(
+                            my_cluster,
+                            prev_reviews[review_key],
+                            rem_header,
+                            run_label
+                        )
+                        n_reused += 1
+                    else:
+                        review, rem_header = run_correction(
+                            my_cluster,
+                            review,
+                            rem_header,
+                            exclude_all,
+                            run_label
+                        )
 
                     if review == 'exit':
                         break
 
+                    #: only decisions of the review are kept for next build
+                    if review_key in prev_reviews or not exclude_all:
+                        reviews[review_key] = my_cluster.get_reprtax()
+
                     corr_file.write("{}\t{}\n".format(
                         my_cluster.get_label(),
                         my_cluster.get_reprtax()
@@ -1595,3 +1923,17 @@ def flag_correction(str_id, run_label, exclude_all=False):
                 curr_cluster.append(curr_line)
 
     repr_correction(str_id, run_label)
+    write_reuse(run_label, "review", reviews)
+    add_count("reused", n_reused)
+
+
+def reuse_review(my_cluster, decision, rem_header, run_label):
+    """Applies the review decision of the previous build to an unchanged
+    cluster, the representative taxonomy chosen or the exclusion.
+    """
+    if decision == 'Excluded':
+        cluster_exclude(my_cluster, run_label)
+    else:
+        my_cluster.change_reprtax(decision)
+
+    rem_flag_update(rem_header, my_cluster.get_flags().lower().split(", "))
@@ -3,12 +3,21 @@
 
 import subprocess
 from .handling import return_proj_path, float_to_str_id, create_dir_structure
+from .handling import input_records, piped_input
+from .cluster_store import pack_clusters
+from .fasta import FastaWriter
+from .telemetry import span
 
 
-def cluster_vs(database, float_id, run_label, cpu, loop=False):
+def cluster_vs(database, float_id, run_label, cpu, loop=False, format="",
+               tax_file=""):
     """Used to perform clustering of a FASTA file at certain taxonomy identity
-    using VSEARCH, producing cluster files which are later analysed.
+    using VSEARCH, the clusters are then packed into the cluster store which
+    is later analysed. Compressed databases, other formats and separate
+    taxonomy files are converted on the fly and piped to VSEARCH.
     """
+    piped = piped_input(database, format, tax_file)
+    vs_database = "-" if piped else database
     str_id = float_to_str_id(float_id)
     create_dir_structure(str_id, run_label)
     proj_path = return_proj_path(run_label)
@@ -16,16 +25,14 @@ def cluster_vs(database, float_id, run_label, cpu, loop=False):
     uc_file = dir_path + '/uc'
     centroids_file = dir_path + '/centroids'
     log_file = dir_path + '/vs_log.txt'
-    cluster_file = dir_path + '/clusters/cluster_'
 
     #: if using already sorted database
     if loop:
-        vs_cluster_option = "{} {}".format('--cluster_smallmem', database)
+        vs_cluster_option = "{} {}".format('--cluster_smallmem', vs_database)
     #: if not using already sorted database (start of clustering)
     else:
-        vs_cluster_option = "{} {}".format('--cluster_fast', database)
+        vs_cluster_option = "{} {}".format('--cluster_fast', vs_database)
 
-    vs_clusters = "{} {}".format('--clusters', cluster_file)
     vs_uc = "{} {}".format('--uc', uc_file)
     vs_centroids = "{} {}".format('--centroids', centroids_file)
     vs_id = "{} {}".format('--id', float_id)
@@ -35,9 +42,8 @@ def cluster_vs(database, float_id, run_label, cpu, loop=False):
     vs_cpu = "{} {}".format('--threads', cpu)
     vs_quiet = "{}".format('--quiet')
 
-    vs_cmd = 'vsearch {co} {cl} {uc} {ce} {id} {lo} {np} {nt} {cp} {qu}'.format(
+    vs_cmd = 'vsearch {co} {uc} {ce} {id} {lo} {np} {nt} {cp} {qu}'.format(
         co=vs_cluster_option,
-        cl=vs_clusters,
         uc=vs_uc,
         ce=vs_centroids,
         id=vs_id,
@@ -48,4 +54,35 @@ def cluster_vs(database, float_id, run_label, cpu, loop=False):
         qu=vs_quiet
     )
 
-    subprocess.run(vs_cmd.split(" "))
+    with span("vsearch", id=str_id):
+        if piped:
+            run_vsearch(vs_cmd, input_records(database, format, tax_file))
+        else:
+            run_vsearch(vs_cmd)
+
+    #: packs all clusters into the cluster store
+    with span("pack_clusters", id=str_id):
+        pack_clusters(
+            input_records(database, format, tax_file),
+            uc_file,
+            dir_path
+        )
+
+
+def run_vsearch(vs_cmd, records=None):
+    """Runs a VSEARCH command, records (header, sequence) are written to its
+    standard input, read by VSEARCH as the file '-'.
+    """
+    if records is None:
+        subprocess.run(vs_cmd.split(" "))
+        return
+
+    process = subprocess.Popen(
+        vs_cmd.split(" "),
+        stdin=subprocess.PIPE,
+        text=True
+    )
+    with FastaWriter(process.stdin) as vs_in:
+        for header, seq in records:
+            vs_in.write(header, seq)
+    process.wait()
@@ -0,0 +1,271 @@
+"""Compressed files. Inputs compressed with gzip or Zstandard are found by
+their magic bytes and read as streams, without decompressing them to disk.
+The finished database can be written compressed (--compress_output), as
+independent blocks of whole records. The index next to a compressed file
+({file}.idx) lists the block and position of every record, so single records
+can be read without decompressing the whole file (used by add_entries), and
+new blocks can be appended.
+"""
+
+import gzip
+import io
+import os
+import shutil
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#: magic bytes and file extension of the supported compressions
+magic_bytes = {"gz": b"\x1f\x8b", "zst": b"\x28\xb5\x2f\xfd"}
+extensions = {"gz": ".gz", "zst": ".zst"}
+
+#: uncompressed size of the blocks of a compressed output file
+block_size = 1 << 20
+
+
+def compression_of(file):
+    """Returns the compression of a file, gz or zst, empty string if the file
+    is not compressed or missing.
+    """
+    try:
+        with open(file, 'rb') as f:
+            start = f.read(4)
+    except OSError:
+        return ""
+
+    for method, magic in magic_bytes.items():
+        if start.startswith(magic):
+            return method
+
+    return ""
+
+
+def open_input(file):
+    """Opens a file for binary reading, decompressing gzip and Zstandard
+    files as a stream.
+    """
+    method = compression_of(file)
+    if method == "gz":
+        return gzip.open(file, 'rb')
+
+    if method == "zst":
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            open(file, 'rb'),
+            read_across_frames=True,
+            closefd=True
+        )
+        return io.BufferedReader(reader)
+
+    return open(file, 'rb')
+
+
+def open_text(file):
+    """Opens a, possibly compressed, file for reading lines of text.
+    """
+    return io.TextIOWrapper(open_input(file))
+
+
+def compress_block(data, method):
+    """Compresses bytes as an independent gzip member or Zstandard frame.
+    """
+    if method == "gz":
+        return gzip.compress(data, mtime=0)
+
+    return zstandard.ZstdCompressor().compress(data)
+
+
+def decompress_block(data, method):
+    """Decompresses one block written by compress_block.
+    """
+    if method == "gz":
+        return gzip.decompress(data)
+
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+def resolve_db_file(file):
+    """Returns the path of a database file as written, the file itself or
+    its compressed version (.gz, .zst). Returns file if none exist.
+    """
+    for ext in [""] + list(extensions.values()):
+        if os.path.isfile(f"{file}{ext}"):
+            return f"{file}{ext}"
+
+    return file
+
+
+def remove_db_file(file):
+    """Removes all versions of a database file and their indexes, before it
+    is written anew.
+    """
+    for ext in [""] + list(extensions.values()):
+        for path in [f"{file}{ext}", f"{file}{ext}.idx"]:
+            if os.path.isfile(path):
+                os.remove(path)
+
+
+def copy_db_file(src, dst, move=False):
+    """Copies, or moves, a database file together with its index.
+    """
+    transfer = shutil.move if move else shutil.copy
+    transfer(src, dst)
+    if os.path.isfile(f"{src}.idx"):
+        transfer(f"{src}.idx", f"{dst}.idx")
+
+
+def open_output(file, method="", mode='w', fasta=False):
+    """Opens a database file for writing text, compressed in blocks if
+    method (gz or zst) is given. The extension is added to file.
+    """
+    if not method:
+        return open(file, mode)
+
+    return BlockWriter(f"{file}{extensions[method]}", method, mode, fasta)
+
+
+def open_append(file, fasta=False):
+    """Opens a database file for appending text, in new blocks if the file is
+    compressed.
+    """
+    method = compression_of(file)
+    if not method:
+        return open(file, 'a')
+
+    return BlockWriter(file, method, 'a', fasta)
+
+
+def record_key(record):
+    """Returns the key of a record in the index, the first field of its first
+    line without '>' (entry id of FASTA records, label of repr and tree
+    lines).
+    """
+    first_line = record.split("\n", 1)[0]
+
+    return first_line.lstrip(">").split("\t")[0].split(" ")[0]
+
+
+def split_records(text, fasta):
+    """Splits text of whole records into records, FASTA records or lines.
+    """
+    if fasta:
+        records = text.split("\n>")
+        return [records[0]] + [f">{record}" for record in records[1:]]
+
+    return text.split("\n")
+
+
+class BlockWriter:
+    """Text writer of a block compressed file. Written text is collected and
+    compressed in blocks of whole records (lines, or FASTA records if fasta),
+    each block is appended to the file and its records to the index.
+    """
+    def __init__(self, file, method, mode='w', fasta=False):
+        self.file = file
+        self.method = method
+        self.fasta = fasta
+        self.out = open(file, f"{mode}b")
+        self.index = open(f"{file}.idx", mode)
+        self.offset = self.out.tell()
+        self.buffer = []
+        self.buffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def closed(self):
+        return self.out.closed
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if self.buffered >= block_size:
+            self.flush(final=False)
+
+    def flush(self, final=True):
+        """Writes all collected whole records as one block, the last,
+        possibly incomplete, record is kept unless final.
+        """
+        text = "".join(self.buffer)
+        rest = ""
+        if not final:
+            boundary = "\n>" if self.fasta else "\n"
+            cut = text.rfind(boundary)
+            if cut == -1:
+                return
+            text, rest = text[:cut+1], text[cut+1:]
+
+        self.buffer = [rest] if rest else []
+        self.buffered = len(rest)
+        if not text:
+            return
+
+        #: records of the block, the text ends with a newline
+        records = split_records(text[:-1], self.fasta)
+        encoded = [f"{record}\n".encode() for record in records]
+        block = compress_block(b"".join(encoded), self.method)
+        self.out.write(block)
+
+        index_lines = []
+        position = 0
+        for record, record_bytes in zip(records, encoded):
+            index_lines.append("{}\t{}\t{}\t{}\t{}\n".format(
+                record_key(record),
+                self.offset,
+                len(block),
+                position,
+                len(record_bytes)
+            ))
+            position += len(record_bytes)
+        self.index.write("".join(index_lines))
+        self.offset += len(block)
+
+    def close(self):
+        if not self.out.closed:
+            self.flush()
+            self.out.close()
+            self.index.close()
+
+
+def read_index(file):
+    """Reads the index of a block compressed file into a dictionary of key
+    and list of (block offset, block size, record offset, record size).
+    """
+    index = {}
+    with open(f"{file}.idx", 'r') as f:
+        for line in f:
+            key, *positions = line.rstrip("\n").split("\t")
+            if key not in index:
+                index[key] = []
+            index[key].append(tuple(int(pos) for pos in positions))
+
+    return index
+
+
+def read_records(file, key, index=None):
+    """Returns all records of a block compressed file with key (entry id or
+    label), decompressing only the blocks holding them. The index can be
+    given when reading many records.
+    """
+    if index is None:
+        index = read_index(file)
+
+    method = compression_of(file)
+    records = []
+    blocks = {}
+    with open(file, 'rb') as f:
+        for block_offset, block_len, offset, length in index.get(key, []):
+            if block_offset not in blocks:
+                f.seek(block_offset)
+                blocks[block_offset] = decompress_block(
+                    f.read(block_len), method
+                )
+            block = blocks[block_offset]
+            records.append(block[offset:offset+length].decode())
+
+    return records
@@ -6,17 +6,23 @@ correct/total % statistics
 import os
 from pathlib import Path
 import random
+import shutil
+import statistics
 import subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 from .handling import check_dir, check_file, return_proj_path, get_v_loop
 from .handling import cleanup, get_dateinfo, return_removed_path
-from .handling import return_init_path
+from .handling import return_init_path, input_records
 from .cluster_tax import create_taxdb, create_cluster_tax, repr_and_flag
 from .cluster_tax import flag_correction
 from .clustering import cluster_vs
 from .cluster_loop import cluster_loop
 from .make_db import make_db
 from .make_hmms import make_hmms
+from .compression import resolve_db_file
+from .fasta import fasta_records, FastaWriter
+from .telemetry import span
 
 
 def cross_validation(
@@ -29,17 +35,26 @@ def cross_validation(
                     qc_sequence_quality,
                     limit_entries,
                     max_limit,
+                    cap_seed,
+                    cap_stratified,
+                    align_cache,
                     exclude_all,
                     quiet,
                     keep,
-                    cpu
+                    cpu,
+                    folds=1,
+                    repeated_holdout=False,
+                    db_format=""
                     ):
     """Cross validation method. Splits a database into training set and test
     set with proportion of entries decided by eval_prop (default 10%), creates
     a new database using only the training set entries then evaluates the test
-    set entries against that database.
+    set entries against that database. Using more than one fold splits the
+    database into k folds (or k random splits of eval_prop if
+    repeated_holdout), each fold is evaluated in its own worker process and
+    the results are summarised over all folds. A FASTA file in another
+    format (db_format) is converted while it is read.
     """
-    tax_dict = {}
     centroid_file = ""
     path = ""
     if not quiet:
@@ -58,7 +73,7 @@ def cross_validation(
         #: uses a finished MQR db to evaluate
         path = Path(return_proj_path(run_label)).parent
         if check_dir(path):
-            centroid_file = f"{path}/mqr.fasta"
+            centroid_file = resolve_db_file(f"{path}/mqr.fasta")
             if not check_file(centroid_file):
                 error_msg = "ERROR: Missing centroid file from specified database"
                 quit(error_msg)
@@ -76,8 +91,120 @@ def cross_validation(
     Path(cv_res_path).mkdir(parents=True, exist_ok=True)
     cv_results_file = f"{cv_res_path}/Results_{curr_time}.txt"
 
-    #: split into training, test sets
-    training_set, test_set = split_fasta(centroid_file, eval_prop, data_path)
+    fold_args = (
+                 run_label,
+                 centroid_file,
+                 hmm_mode,
+                 qc_limited_clusters,
+                 qc_taxonomy_quality,
+                 qc_sequence_quality,
+                 limit_entries,
+                 max_limit,
+                 cap_seed,
+                 cap_stratified,
+                 align_cache,
+                 exclude_all
+                 )
+
+    if folds > 1:
+        #: split into training, test sets for every fold
+        fold_sets = split_fasta_folds(
+            centroid_file,
+            folds,
+            eval_prop,
+            data_path,
+            repeated_holdout,
+            format=db_format
+        )
+
+        if not quiet:
+            print(f"{dt} : Creating and evaluating {folds} cross validation "
+                  "databases")
+
+        fold_results = run_cv_folds(fold_sets, cv_label, fold_args, keep, cpu)
+
+    else:
+        #: split into training, test sets
+        training_set, test_set = split_fasta(
+            centroid_file,
+            eval_prop,
+            data_path,
+            format=db_format
+        )
+
+        with span("cv_fold", label=cv_label, fold=1):
+            fold_results = {1: run_cv_fold(
+                cv_label,
+                training_set,
+                test_set,
+                data_path,
+                *fold_args,
+                cpu=cpu,
+                quiet=quiet
+            )}
+
+    with open(cv_results_file, 'w') as f:
+        res_header = "Cross validation results:"
+        f.write(f"{res_header}\n")
+
+        res_hmm = f"HMM mode used: {hmm_mode}"
+        f.write(f"{res_hmm}\n")
+
+        if not quiet:
+            print(res_header)
+            if db_file:
+                db_used = db_file
+            else:
+                db_used = run_label
+            print(f"Database used: {db_used}")
+            print(res_hmm)
+
+        if folds > 1:
+            res_lines = summarise_folds(fold_results, repeated_holdout)
+        else:
+            res_lines = []
+            test_results = fold_results[1]
+            for result in test_results:
+                corr_perc = "{:.2%}".format(
+                    correct_ratio(test_results[result])
+                )
+                res_lines.append(f"{result}: {corr_perc}")
+
+        for res_line in res_lines:
+            f.write(f"{res_line}\n")
+            if not quiet:
+                print(res_line)
+
+    #: cleanup - removing data dir and the cv_label database
+    cleanup("cv", keep, run_label)
+
+
+def run_cv_fold(
+                cv_label,
+                training_set,
+                test_set,
+                data_path,
+                run_label,
+                centroid_file,
+                hmm_mode,
+                qc_limited_clusters,
+                qc_taxonomy_quality,
+                qc_sequence_quality,
+                limit_entries,
+                max_limit,
+                cap_seed,
+                cap_stratified,
+                align_cache,
+                exclude_all,
+                cpu=4,
+                quiet=True
+                ):
+    """Creates a database labelled cv_label from the training set and
+    evaluates the test set against it. Returns the evaluation of every read
+    length of the test set.
+    """
+    if not quiet:
+        dt = get_dateinfo()
 
     #: make new temp database from training set
     str_id = '100'
@@ -101,9 +228,10 @@ def cross_validation(
                        cv_label,
                        qc_taxonomy_quality,
                        qc_sequence_quality,
-                       gene_marker=gene_marker
+                       gene_marker=gene_marker,
+                       cpu=cpu
                        )
-    repr_and_flag(str_id, cv_label)
+    repr_and_flag(str_id, cv_label, cpu)
     flag_correction(str_id, cv_label, exclude_all)
     v_loop = get_v_loop()
 
@@ -125,12 +253,15 @@ def cross_validation(
             cv_label,
             limit_entries,
             max_limit,
+            cpu=cpu,
+            cap_seed=cap_seed,
+            cap_stratified=cap_stratified,
+            align_cache=align_cache
             )
 
     cleanup("mh", False, cv_label)
 
     #: creating the training taxonomy cheat sheet, and reading into dict
-    train_centroids = f"{Path(return_proj_path(cv_label)).parent}/mqr.fasta"
     training_tax_file = make_train_tax(centroid_file, data_path)
 
     tax_dict = get_tax_dict(training_tax_file)
@@ -146,66 +277,187 @@ def cross_validation(
     #: run metaxaQR on each test file
     for test_file in test_files:
         test_run = test_file.split("/")[-1].split(".")[0].split("_")[-1]
-        mqr_results = run_mqr(
-            test_file,
-            run_label,
-            cv_label,
+        with span("run_mqr", label=cv_label, test_run=test_run):
+            mqr_results = run_mqr(
+                test_file,
+                run_label,
+                cv_label,
+                data_path,
+                test_run,
+                cpu=cpu
+                )
+        test_results[test_run] = evaluation(mqr_results, tax_dict)
+
+    return test_results
+
+
+def run_cv_fold_worker(fold_label, training_set, test_set, data_path,
+                       fold_args, keep, cpu):
+    """Runs one fold in a worker process, removing the fold database unless
+    keep is used.
+    """
+    #: forked workers share the random state of the parent
+    random.seed()
+    with span("cv_fold", label=fold_label):
+        test_results = run_cv_fold(
+            fold_label,
+            training_set,
+            test_set,
             data_path,
-            test_run,
+            *fold_args,
             cpu=cpu
-            )
-        test_results[test_run] = evaluation(mqr_results, tax_dict)
+        )
 
-    with open(cv_results_file, 'w') as f:
-        res_header = "Cross validation results:"
-        f.write(f"{res_header}\n")
+    if not keep:
+        fold_path = Path(return_proj_path(fold_label)).parent
+        if check_dir(fold_path):
+            shutil.rmtree(fold_path)
 
-        res_hmm = f"HMM mode used: {hmm_mode}"
-        f.write(f"{res_hmm}\n")
+    return test_results
 
-        if not quiet:
-            print(res_header)
-            if db_file:
-                db_used = db_file
-            else:
-                db_used = run_label
-            print(f"Database used: {db_used}")
-            print(res_hmm)
 
-        for result in test_results:
-            correct = sum(test_results[result][:-1]) / sum(test_results[result])
-            corr_perc = "{:.2%}".format(correct)
-            res_length = f"{result}: {corr_perc}"
-            f.write(f"{res_length}\n")
-            if not quiet:
-                print(res_length)
+def run_cv_folds(fold_sets, cv_label, fold_args, keep, cpu):
+    """Runs all folds concurrently, each fold as an independent worker process
+    with its own cv label (cv_label_k) and an equal share of the cpu. Returns
+    the evaluation of every fold.
+    """
+    cpu = int(cpu)
+    fold_results = {}
+    workers = max(1, min(cpu, len(fold_sets)))
+    fold_cpu = max(1, cpu // workers)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for fold in fold_sets:
+            training_set, test_set, fold_data_path = fold_sets[fold]
+            future = executor.submit(
+                run_cv_fold_worker,
+                f"{cv_label}_{fold}",
+                training_set,
+                test_set,
+                fold_data_path,
+                fold_args,
+                keep,
+                fold_cpu
+            )
+            futures[future] = fold
 
-    #: cleanup - removing data dir and the cv_label database
-    cleanup("cv", keep, run_label)
+        for future in as_completed(futures):
+            fold_results[futures[future]] = future.result()
 
+    return dict(sorted(fold_results.items()))
 
-def split_fasta(fasta_file, eval_prop, out_path):
+
+def correct_ratio(evaluation_result):
+    """Returns the ratio of correct predictions (species, genus or partial)
+    from an evaluation result.
+    """
+    return sum(evaluation_result[:-1]) / sum(evaluation_result)
+
+
+def summarise_folds(fold_results, repeated_holdout=False):
+    """Summarises the evaluations of all folds, returning the result lines with
+    the correct % of every fold and the mean and standard deviation of the
+    correct % over all folds for every read length.
+    """
+    res_lines = []
+    fold_ratios = {}
+    if repeated_holdout:
+        res_lines.append(f"Repeated holdout splits: {len(fold_results)}")
+    else:
+        res_lines.append(f"Folds: {len(fold_results)}")
+
+    for fold in fold_results:
+        fold_line = []
+        for result in fold_results[fold]:
+            ratio = correct_ratio(fold_results[fold][result])
+            if result not in fold_ratios:
+                fold_ratios[result] = []
+            fold_ratios[result].append(ratio)
+            fold_line.append("{}: {:.2%}".format(result, ratio))
+        res_lines.append(f"Fold {fold}: {', '.join(fold_line)}")
+
+    for result in fold_ratios:
+        ratios = fold_ratios[result]
+        res_mean = statistics.mean(ratios)
+        res_sd = 0.0
+        if len(ratios) > 1:
+            res_sd = statistics.stdev(ratios)
+        res_lines.append("{}: {:.2%} (sd {:.2%}, n={})".format(
+            result,
+            res_mean,
+            res_sd,
+            len(ratios)
+        ))
+
+    return res_lines
+
+
+def split_fasta(fasta_file, eval_prop, out_path, format=""):
     """Splits the mqr.fasta, finished database fasta file, into a training set
     and a test set used for cross validation.
     """
-    fasta_dict = read_fasta(fasta_file)
+    fasta_dict = read_fasta(fasta_file, format)
     test_keys = get_test_keys(fasta_dict, eval_prop)
 
+    return write_split(fasta_dict, test_keys, out_path)
+
+
+def split_fasta_folds(fasta_file, folds, eval_prop, out_path,
+                      repeated_holdout=False, format=""):
+    """Splits the mqr.fasta, finished database fasta file, into a training set
+    and a test set for every fold. Each entry is used in the test set of
+    exactly one fold, or if repeated_holdout every fold uses a new random test
+    set of eval_prop. Returns dict of fold and training, test set and data
+    path.
+    """
+    fasta_dict = read_fasta(fasta_file, format)
+    fold_sets = {}
+
+    if not repeated_holdout and folds > len(fasta_dict):
+        error_msg = "ERROR: More folds than entries in the database"
+        quit(error_msg)
+
+    fold_keys = list(fasta_dict)
+    random.shuffle(fold_keys)
+
+    for fold in range(1, folds+1):
+        fold_path = f"{out_path}/fold_{fold}"
+        Path(fold_path).mkdir(parents=True, exist_ok=True)
+
+        if repeated_holdout:
+            test_keys = get_test_keys(fasta_dict, eval_prop)
+        else:
+            test_keys = fold_keys[fold-1::folds]
+
+        training_file, test_file = write_split(
+            fasta_dict,
+            test_keys,
+            fold_path
+        )
+        fold_sets[fold] = (training_file, test_file, fold_path)
+
+    return fold_sets
+
+
+def write_split(fasta_dict, test_keys, out_path):
+    """Writes the training set and test set files, entries in test_keys are
+    written to the test set.
+    """
+    test_keys = set(test_keys)
     training_file = f"{out_path}/training.fasta"
     test_file = f"{out_path}/test_full.fasta"
 
-    with open(training_file, 'w') as train, \
-         open(test_file, 'w') as test:
+    with FastaWriter(training_file, width=80) as train, \
+         FastaWriter(test_file, width=80) as test:
 
         for key in fasta_dict:
             id = key.split("\t")[0]
             tax = key.split("\t")[1]
-            tmp_seq = fasta_dict[key]
-            seq = "\n".join([tmp_seq[i:i+80] for i in range(0, len(tmp_seq), 80)])
             if key in test_keys:
-                test.write(f"{id} {tax}\n{seq}\n")
+                test.write(f"{id} {tax}", fasta_dict[key])
             else:
-                train.write(f"{id} {tax}\n{seq}\n")
+                train.write(f"{id} {tax}", fasta_dict[key])
 
     return training_file, test_file
 
@@ -226,33 +478,20 @@ def get_test_keys(fasta_dict, prop):
     return test_keys
 
 
-def read_fasta(fasta_file):
-    """Reads a fasta file and stores it as a dictionary.
+def read_fasta(fasta_file, format=""):
+    """Reads a fasta file, possibly compressed or in another format, and
+    stores it as a dictionary.
     """
     fasta_dict = {}
-    seq = ""
-    id = ""
-
-    with open(fasta_file, 'r') as f:
-        for line in f:
-            curr_line = line.rstrip()
-            if curr_line and curr_line[0] == ">":
-                if seq:
-                    fasta_dict[id] = seq
-
-                if len(curr_line.split("\t")) < 2:
-                    acc_id = curr_line.split(" ")[0]
-                    tax = " ".join(curr_line.split(" ")[1:])
-                else:
-                    acc_id = curr_line.split("\t")[0]
-                    tax = curr_line.split("\t")[-1]
-
-                id = f"{acc_id}\t{tax}"
-                seq = ""
-            else:
-                seq += curr_line
+    for header, seq in input_records(fasta_file, format=format):
+        if len(header.split("\t")) < 2:
+            acc_id = header.split(" ")[0]
+            tax = " ".join(header.split(" ")[1:])
+        else:
+            acc_id = header.split("\t")[0]
+            tax = header.split("\t")[-1]
 
-        fasta_dict[id] = seq
+        fasta_dict[f"{acc_id}\t{tax}"] = seq
 
     return fasta_dict
 
@@ -260,23 +499,19 @@ def read_fasta(fasta_file):
 def make_train_tax(centroid_file, out_dir):
     """Creates a taxonomy file used to evaluate the test set results against.
     """
-    taxes = {}
     tax_file = f"{out_dir}/train_tax.txt"
-    with open(centroid_file, 'r') as c, \
-         open(tax_file, 'w') as f:
-
-        for line in c:
-            if line[0] == ">":
-                if len(line.rstrip().split("\t")) < 2:
-                    split_line = line.rstrip().split(" ")
-                    tax = " ".join(split_line[1:])
+    with open(tax_file, 'w') as f:
+        for header, _ in fasta_records(centroid_file):
+            if len(header.split("\t")) < 2:
+                split_line = header.split(" ")
+                tax = " ".join(split_line[1:])
 
-                else:
-                    split_line = line.rstrip().split("\t")
-                    tax = split_line[-1]
+            else:
+                split_line = header.split("\t")
+                tax = split_line[-1]
 
-                id = split_line[0]
-                f.write(f"{id}\t{tax}\n")
+            id = split_line[0]
+            f.write(f">{id}\t{tax}\n")
 
     return tax_file
 
@@ -296,43 +531,25 @@ def cut_test_set(test_file, out_dir):
     smallest_seq_len = 1000
     output_files = [test_file]
 
-    with open(test_file, 'r') as f_full:
-        seq = ""
-
-        for line in f_full:
-            if line[0] == ">":
-                if seq:
-                    seq_len = len(seq)
-                    if seq_len < smallest_seq_len:
-                        smallest_seq_len = seq_len
-
-                    half_dict[id] = get_half_seq(seq)
-
-                    if len(seq) >= 300:
-                        read_dict[id] = get_read_seq(seq)
-
-                id = line.split(" ")[0]
-                seq = ""
-            else:
-                seq += line.rstrip()
+    for header, seq in fasta_records(test_file):
+        id = header.split(" ")[0]
+        seq_len = len(seq)
+        if seq_len < smallest_seq_len:
+            smallest_seq_len = seq_len
 
         half_dict[id] = get_half_seq(seq)
         if len(seq) >= 300:
             read_dict[id] = get_read_seq(seq)
 
-    with open(half_file, 'w') as f_half:
+    with FastaWriter(half_file, width=80) as f_half:
         for id in half_dict:
-            half_tmp = half_dict[id]
-            half_out = "\n".join([half_tmp[i:i+80] for i in range(0, len(half_tmp), 80)])
-            f_half.write(f"{id}\n{half_out}\n")
+            f_half.write(id, half_dict[id])
     output_files.append(half_file)
 
     if smallest_seq_len >= 300:
-        with open(read_file, 'w') as f_read:
+        with FastaWriter(read_file, width=80) as f_read:
             for id in read_dict:
-                read_tmp = read_dict[id]
-                read_out = "\n".join([read_tmp[i:i+80] for i in range(0, len(read_tmp), 80)])
-                f_read.write(f"{id}\n{read_out}\n")
+                f_read.write(id, read_dict[id])
         output_files.append(read_file)
 
     return output_files
@@ -0,0 +1,80 @@
+"""Dictionary encoding of the intermediate files of the identity ladder.
+Taxonomies are written as integer ids of a per-run taxonomy dictionary
+(mqr_db/tax_dict, one taxonomy per line, the id is the line number) in
+final_repr and final_centroids, and in all files of the identities below 100.
+Cluster labels in the label_tree files are written without the constant
+MQR_{label}_ prefix (95_12). Text is only expanded when make_db writes the
+finished database files. Files at 100% that are manually reviewed
+(tax_clusters, repr_clusters, flag_clusters) are kept as text.
+"""
+
+from .handling import return_proj_path, check_file
+
+
+def return_tax_dict_file(run_label):
+    """Returns the path to the taxonomy dictionary of a run.
+    """
+    return f"{return_proj_path(run_label)}tax_dict"
+
+
+def short_label(label):
+    """Returns a cluster label without the MQR_{label}_ prefix.
+    """
+    return "_".join(label.split("_")[-2:])
+
+
+def full_label(run_label, label):
+    """Returns the full cluster label of a label without prefix.
+    """
+    return f"MQR_{run_label}_{label}"
+
+
+class TaxDictionary:
+    """Taxonomy dictionary of a run. New taxonomies get the next id and are
+    appended to the dictionary file when it is closed. Only one process
+    encodes at a time, workers only decode.
+    """
+    def __init__(self, run_label):
+        self.file = return_tax_dict_file(run_label)
+        self.taxes = []
+        self.ids = {}
+        self.new = []
+
+        if check_file(self.file):
+            with open(self.file, 'r') as f:
+                for line in f:
+                    self.add(line.rstrip("\n"))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, tax):
+        tax_id = len(self.taxes)
+        self.taxes.append(tax)
+        self.ids[tax] = tax_id
+
+        return tax_id
+
+    def encode(self, tax):
+        """Returns the id of a taxonomy as str, adding it if new.
+        """
+        tax_id = self.ids.get(tax)
+        if tax_id is None:
+            tax_id = self.add(tax)
+            self.new.append(tax)
+
+        return str(tax_id)
+
+    def decode(self, tax_id):
+        """Returns the taxonomy of an id (str or int).
+        """
+        return self.taxes[int(tax_id)]
+
+    def close(self):
+        if self.new:
+            with open(self.file, 'a') as f:
+                f.write("".join([f"{tax}\n" for tax in self.new]))
+            self.new = []
@@ -0,0 +1,153 @@
+"""Shared FASTA reader and writer. Records are found with bytes searches on a
+memory map of the file, each header and sequence is sliced out once and the
+line breaks of wrapped sequences are removed in a single pass, rather than
+building sequences line by line. Compressed files (gzip, Zstandard) are read
+as a stream in large chunks instead.
+"""
+
+import mmap
+import os
+from .compression import compression_of, open_input
+
+#: whitespace removed from sequences, including line breaks
+seq_whitespace = b" \t\r\n"
+
+
+def parse_fasta(data, text=True):
+    """Yields (header, sequence) for every record in data (bytes or mmap),
+    the header without '>' and trailing whitespace. Returned as str if text,
+    otherwise as bytes. Anything before the first header is ignored.
+    """
+    size = len(data)
+    if data[:1] == b">":
+        pos = 0
+    else:
+        pos = data.find(b"\n>")
+        if pos != -1:
+            pos += 1
+
+    while pos != -1:
+        header_end = data.find(b"\n", pos)
+        if header_end == -1:
+            header_end = size
+
+        next_pos = data.find(b"\n>", header_end)
+        if next_pos == -1:
+            body_end = size
+        else:
+            body_end = next_pos + 1
+
+        header = data[pos+1:header_end].rstrip()
+        sequence = data[header_end+1:body_end].translate(None, seq_whitespace)
+        if text:
+            yield header.decode(), sequence.decode()
+        else:
+            yield header, sequence
+
+        if next_pos == -1:
+            pos = -1
+        else:
+            pos = body_end
+
+
+def stream_records(stream, text=True, chunk_size=1 << 22):
+    """Yields (header, sequence) for every record read from a binary stream,
+    see parse_fasta. The stream is read in chunks, records are parsed once
+    the start of the next record has been read.
+    """
+    rest = b""
+    for chunk in iter(lambda: stream.read(chunk_size), b""):
+        data = rest + chunk
+        cut = data.rfind(b"\n>")
+        if cut == -1:
+            rest = data
+            continue
+
+        yield from parse_fasta(data[:cut+1], text=text)
+        rest = data[cut+1:]
+
+    if rest:
+        yield from parse_fasta(rest, text=text)
+
+
+def fasta_records(file, text=True):
+    """Yields (header, sequence) for every record of a FASTA file, see
+    parse_fasta. The file is memory mapped while the records are read,
+    compressed files are decompressed as a stream.
+    """
+    if compression_of(file):
+        with open_input(file) as stream:
+            yield from stream_records(stream, text=text)
+        return
+
+    with open(file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield from parse_fasta(data, text=text)
+
+
+def sort_by_length(file, width=0):
+    """Sorts the records of a FASTA file by decreasing sequence length,
+    records of the same length are kept in file order.
+    """
+    records = list(fasta_records(file, text=False))
+    records.sort(key=lambda record: -len(record[1]))
+    with FastaWriter(file, width=width) as out:
+        for header, sequence in records:
+            out.write(header.decode(), sequence.decode())
+
+
+def wrap_sequence(sequence, width):
+    """Returns the sequence split into lines of width, unchanged if width is
+    0.
+    """
+    if not width:
+        return sequence
+
+    return "\n".join(
+        [sequence[i:i+width] for i in range(0, len(sequence), width)]
+    )
+
+
+class FastaWriter:
+    """Buffered FASTA writer, records are collected and written in large
+    blocks. Sequences are wrapped at width, 0 writes them on one line. The
+    file can be a path or an open text file (pipe, compressed output), which
+    is closed with the writer.
+    """
+    def __init__(self, file, width=0, mode='w', buffer_size=1 << 20):
+        if hasattr(file, "write"):
+            self.out = file
+        else:
+            self.out = open(file, mode)
+        self.width = width
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, header, sequence):
+        """Writes one record, header without '>'.
+        """
+        record = f">{header}\n{wrap_sequence(sequence, self.width)}\n"
+        self.buffer.append(record)
+        self.buffered += len(record)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.out.write("".join(self.buffer))
+        self.buffer = []
+        self.buffered = 0
+
+    def close(self):
+        if not self.out.closed:
+            self.flush()
+            self.out.close()
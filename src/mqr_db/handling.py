@@ -5,17 +5,19 @@ the project, checking if files exists, error handling etc.
 import argparse
 import subprocess
 from datetime import datetime
-import importlib
+import importlib.util
 import os
 from pathlib import Path
 import shutil
+from .compression import compression_of, open_text, resolve_db_file
+from .fasta import fasta_records
 
 
 def create_dir_structure(str_id, run_label):
     """Creates the directory structure used by clustering and subsequent
-    handling of clusters. Cluster files in mqr_db/identity/clusters/
+    handling of clusters. Cluster store in mqr_db/identity/
     """
-    cluster_dir = return_proj_path(run_label) + str_id + '/clusters/'
+    cluster_dir = return_proj_path(run_label) + str_id + '/'
     Path(cluster_dir).mkdir(parents=True, exist_ok=True)
 
 
@@ -52,6 +54,15 @@ def return_removed_path(label):
     return path
 
 
+def return_reuse_path(label):
+    """Returns the path to the reuse directory, kept next to mqr.fasta as it
+    is used by the next incremental build.
+    """
+    path = f"{Path(return_proj_path(label)).parent}/reuse/"
+
+    return path
+
+
 def tax_list_to_str(tlist):
     """Changes a split list of taxonomies back to a string.
     """
@@ -89,6 +100,7 @@ def check_args(args):
         and not args.opt_makehmms
         and not args.opt_make
         and not args.opt_crossval
+        and not args.opt_benchmark
         # and not args.opt_ds
     ):
         error_msg = "ERROR: No option chosen"
@@ -100,8 +112,10 @@ def check_args(args):
         and args.opt_keep and not args.opt_makehmms
         and args.opt_keep and not args.opt_make
         and args.opt_keep and not args.opt_crossval
+        and args.opt_keep and not args.opt_benchmark
     ):
-        error_msg = """ERROR: --keep only works with -m, -m_d, -m_h"""
+        error_msg = """ERROR: --keep only works with -m, -m_d, -m_h, -c or
+        --benchmark"""
         quit(error_msg)
 
     #: check if --label is used outside correct modules
@@ -141,6 +155,73 @@ def check_args(args):
             """
             quit(error_msg)
 
+    #: benchmark checks
+    if (
+        args.opt_bench_seqs is not None
+        or args.opt_bench_depth is not None
+        or args.opt_bench_div is not None
+    ) and not args.opt_benchmark:
+        error_msg = """ERROR: --benchmark_seqs, --benchmark_depth and
+        --benchmark_divergence only work with --benchmark"""
+        quit(error_msg)
+    if args.opt_bench_seqs is not None and args.opt_bench_seqs < 1:
+        error_msg = """ERROR: --benchmark_seqs requires a number of 1 or
+        more."""
+        quit(error_msg)
+    if args.opt_bench_depth is not None and args.opt_bench_depth < 2:
+        error_msg = """ERROR: --benchmark_depth requires a number of 2 or
+        more."""
+        quit(error_msg)
+    if (
+        args.opt_bench_div is not None
+        and not 0 <= args.opt_bench_div < 1
+    ):
+        error_msg = """ERROR: --benchmark_divergence only allows for values
+        between 0-1."""
+        quit(error_msg)
+
+    #: keep index check
+    if args.opt_keep_index and not args.opt_addseq:
+        error_msg = """ERROR: --keep_index only works with -a"""
+        quit(error_msg)
+
+    #: incremental build checks
+    if args.opt_previous and not args.opt_prepare:
+        error_msg = """ERROR: --previous_label only works with -p"""
+        quit(error_msg)
+    if (
+        args.opt_previous
+        and not check_dir(return_reuse_path(args.opt_previous))
+    ):
+        error_msg = f"""ERROR: No previous build found for the label
+        '{args.opt_previous}'"""
+        quit(error_msg)
+
+    #: telemetry check
+    if args.opt_telemetry and not (
+        args.opt_prepare
+        or args.opt_make
+        or args.opt_makedb
+        or args.opt_makehmms
+        or args.opt_crossval
+        or args.opt_addseq
+        or args.opt_benchmark
+    ):
+        error_msg = """ERROR: --telemetry only works with -p, -m, -m_d, -m_h,
+        -c, -a or --benchmark"""
+        quit(error_msg)
+
+    #: compressed output check
+    if args.opt_compress and not (args.opt_make or args.opt_makedb):
+        error_msg = """ERROR: --compress_output only works with -m or -m_d"""
+        quit(error_msg)
+
+    #: resume check
+    if args.opt_resume:
+        if not args.opt_make and not args.opt_makedb:
+            error_msg = """ERROR: --resume only works with -m or -m_d"""
+            quit(error_msg)
+
     #: --qc mode check
     if args.opt_qc:
         if 's' in args.opt_qc or 't' in args.opt_qc:
@@ -236,6 +317,25 @@ def check_args(args):
                 between 0-1."""
                 quit(error_msg)
 
+    #: folds checks:
+    if args.opt_folds is not None:
+        if not args.opt_crossval:
+            error_msg = """ERROR: --folds only works using -c."""
+            quit(error_msg)
+        elif args.opt_folds < 1:
+            error_msg = """ERROR: --folds requires a number of 1 or more."""
+            quit(error_msg)
+        elif args.opt_folds > 1 and not args.opt_exclude_all:
+            error_msg = """ERROR: --folds above 1 requires
+            --exclude_all_flags, folds are run without manual review."""
+            quit(error_msg)
+
+    if args.opt_repeated_holdout:
+        if not args.opt_folds or args.opt_folds < 2:
+            error_msg = """ERROR: --repeated_holdout requires --folds above
+            1."""
+            quit(error_msg)
+
     #: cross_validation checks:
     if args.opt_crossval:
         if not args.opt_label and not args.opt_cvfile:
@@ -261,6 +361,32 @@ def check_args(args):
     if args.opt_max_entries and not args.opt_limit_entries:
         error_msg = """ERROR: --hmm_align_max requires --hmm_limit_entries"""
         quit(error_msg)
+    if (
+        (args.opt_cap_seed is not None or args.opt_cap_stratified)
+        and not args.opt_limit_entries
+    ):
+        error_msg = """ERROR: --hmm_cap_seed and --hmm_cap_stratified require
+        --hmm_limit_entries"""
+        quit(error_msg)
+    if args.opt_hmm_delta and not args.opt_makehmms:
+        error_msg = """ERROR: --hmm_delta only works with -m_h"""
+        quit(error_msg)
+    if args.opt_align_cache < 0:
+        error_msg = """ERROR: --align_cache must be 0 or more MB"""
+        quit(error_msg)
+    if args.opt_slice_regions or args.opt_slice_report:
+        if not args.opt_make and not args.opt_makehmms:
+            error_msg = """ERROR: --hmm_slice_regions and --hmm_slice_report
+            only work with -m or -m_h"""
+            quit(error_msg)
+        if str(args.opt_mode).lower() not in ["hybrid", "conserved"]:
+            error_msg = """ERROR: --hmm_slice_regions and --hmm_slice_report
+            require the hybrid or conserved mode"""
+            quit(error_msg)
+    if args.opt_slice_regions and args.opt_slice_report:
+        error_msg = """ERROR: --hmm_slice_report measures the realignments,
+        it can't be used with --hmm_slice_regions"""
+        quit(error_msg)
 
 
 def check_dir(path):
@@ -290,16 +416,35 @@ def check_installation(args):
         args.opt_makehmms
     ):
         reqs = ['mafft', 'hmmbuild', 'hmmpress']
+        preqs = ['numpy']
     elif (
-          args.opt_crossval
+          args.opt_make
+          or args.opt_crossval
     ):
         reqs = ['vsearch', 'mafft', 'hmmbuild', 'hmmpress']
+        preqs = ['numpy']
+    elif (
+          args.opt_benchmark
+    ):
+        preqs = ['numpy']
+
+    #: Zstandard compressed output or taxonomy file
+    if (
+        args.opt_compress == "zst"
+        or (args.opt_taxfile and compression_of(args.opt_taxfile) == "zst")
+    ):
+        preqs.append('zstandard')
 
     for tool in reqs:
         error_msg = "{} was not found".format(tool)
         if not is_tool(tool):
             quit(error_msg)
 
+    for module in preqs:
+        error_msg = "Python module {} was not found".format(module)
+        if not importlib.util.find_spec(module):
+            quit(error_msg)
+
 
 def cleanup(mode, keep, run_label):
     """Cleanup of intermediate files, moves all files in /removed/ and
@@ -369,7 +514,7 @@ def check_prereqs(args):
 
     #: check to find problem before starting make_hmm module
     if args.opt_makehmms:
-        mqr_fasta_file = f"{Path(path).parent}/mqr.fasta"
+        mqr_fasta_file = resolve_db_file(f"{Path(path).parent}/mqr.fasta")
         if not check_file(mqr_fasta_file):
             error_msg = "ERROR: {file} {txt}".format(
                 file=mqr_fasta_file,
@@ -465,6 +610,13 @@ def logging(option, id='', quiet=False):
                 st="Manual Review of flagged clusters finished!"
             ))
 
+        elif option == "resume":
+            print("{dt} : {st}".format(
+                dt=get_dateinfo(),
+                st="Resuming using the run manifest, finished stages are"
+                " skipped."
+            ))
+
         elif option == "finalize_start":
             print("{dt} : {st}\n{ln}\n{he}\n{ln}".format(
                 he=get_header(option.split("_")[0]),
@@ -556,6 +708,11 @@ finished.".format(id=str(int(id)-5))
                 dt=get_dateinfo(),
                 st="Creating MetaxaQR HMMs..."
             ))
+        elif option == "make hmms_usage":
+            print("{dt} : {st}".format(
+                dt=get_dateinfo(),
+                st="HMM building used {id} of the cpu (--cpu).".format(id=id)
+            ))
         elif option == "make hmms_end":
             print("{dt} : {st}\n".format(
                 dt=get_dateinfo(),
@@ -573,6 +730,18 @@ finished.".format(id=str(int(id)-5))
                 dt=get_dateinfo(),
                 st="Cross validation is completed!"
             ))
+        elif option == "benchmark_start":
+            print("{he}\n{ln}\n{dt} : {st}".format(
+                he=get_header(option.split("_")[0]),
+                ln=ln,
+                dt=get_dateinfo(),
+                st="Benchmark started, using stand-in external tools..."
+            ))
+        elif option == "benchmark_end":
+            print("{dt} : {st}\n".format(
+                dt=get_dateinfo(),
+                st="Benchmark is completed!"
+            ))
 
 
 def get_dateinfo():
@@ -668,6 +837,15 @@ def get_header(option):
             version,
         )
 
+    elif option == "benchmark":
+        htext = "MetaxaQR_dbb Benchmark -- Time and resources used by every" \
+            " stage, on a synthetic database."
+        header = "{}\n{}\n{}".format(
+            htext,
+            bytext,
+            version,
+        )
+
     return header
 
 
@@ -706,116 +884,80 @@ def print_license():
         print(f"License file not found in directory. Visit {url} instead.")
 
 
-def format_file(file, format):
-    """Formatting method, used to take different inputs formats and format
-    these to SILVA style.
+def input_records(file, format="", tax_file=""):
+    """Yields (header, sequence) of every entry of an input database in
+    SILVA style, without '>'. The file can be compressed (gzip, Zstandard),
+    taxonomies from a separate tax_file are joined and other formats (ibol,
+    unite) are converted while the file is read.
     """
-    out_file = "{}_formatted".format(file)
-
-    with open(file, 'r') as to_format, \
-         open(out_file, 'w') as formatted:
+    if format == "ibol":
+        return ibol_records(file)
 
-        if format == "ibol":
-            format_ibol(to_format, formatted)
-        elif format == "unite":
-            format_unite(to_format, formatted)
+    records = fasta_records(file)
+    if tax_file:
+        records = join_taxonomy(records, tax_file)
+    if format == "unite":
+        records = unite_records(records)
 
-    return out_file
+    return records
 
 
-def silva_format(id, tax, seq):
-    """The format used by silva, this is used to create the final output format
+def piped_input(file, format="", tax_file=""):
+    """Checks if an input database has to be converted while it is read
+    (compressed, other format or separate taxonomy file), it is then given
+    to VSEARCH through a pipe.
     """
-    silva_out = "{} {}\n{}\n".format(id, tax, seq)
-
-    return silva_out
+    return bool(compression_of(file) or format or tax_file)
 
 
-def format_ibol(to_format, formatted):
+def ibol_records(file):
     """Formatting used by ibol
     """
-    to_format.readline()  # removes header
+    with open_text(file) as to_format:
+        to_format.readline()  # removes header
 
-    for line in to_format:
-        splitline = line.rstrip().split("\t")
+        for line in to_format:
+            splitline = line.rstrip().split("\t")
 
-        tmp_id = splitline[0]
-        id = ">{}".format(tmp_id)
+            id = splitline[0]
 
-        tmp_tax = splitline[8:15]
-        tax = ";".join(filter(None, tmp_tax))
+            tmp_tax = splitline[8:15]
+            tax = ";".join(filter(None, tmp_tax))
 
-        tmp_seq = splitline[30]
-        seq = "\n".join([tmp_seq[i:i+80] for i in range(0, len(tmp_seq), 80)])
+            yield f"{id} {tax}", splitline[30]
 
-        formatted.write(silva_format(id, tax, seq))
 
-
-def format_unite(to_format, formatted):
-    """Formatting used by ibol
+def unite_records(records):
+    """Formatting used by unite
     """
     base_tax = 'Eukaryota;Amorphea;Obazoa;Opisthokonta;Nucletmycea'
-    tax = base_tax
-
-    first_line = True
-
-    for line in to_format:
-        splitline = line.rstrip().split("|")
-
-        if splitline[0][0] == '>':
-            if not first_line:
-                formatted.write(silva_format(id, tax, seq))
-                tax = base_tax
 
-            tmp_id = splitline[1]
-            id = ">{}".format(tmp_id)
-            for tmp_tax in splitline[4].split(";"):
-                split_tax = tmp_tax.split("__")[1]
-                tax += ";" + split_tax.replace('_', ' ').replace('sp', 'sp.')
+    for header, seq in records:
+        splitline = header.split("|")
+        tax = base_tax
 
-            first_line = False
+        id = splitline[1]
+        for tmp_tax in splitline[4].split(";"):
+            split_tax = tmp_tax.split("__")[1]
+            tax += ";" + split_tax.replace('_', ' ').replace('sp', 'sp.')
 
-        tmp_seq = splitline[0]
-        seq = "\n".join([tmp_seq[i:i+80] for i in range(0, len(tmp_seq), 80)])
+        yield f"{id} {tax}", seq
 
-    formatted.write(silva_format(id, tax, seq))
 
-
-def sep_tax(fasta_file, tax_file):
-    """Creates a combined fasta file containing taxonomies, ids and sequences
-    using separate taxonomy and fasta files.
+def join_taxonomy(records, tax_file):
+    """Adds the taxonomy of every entry from a separate taxonomy file, lines
+    of '>id' and taxonomy separated by tab.
     """
-    comb_file = "{}.combined".format(fasta_file)
     tax_dict = {}
 
-    with open(tax_file, 'r') as f:
+    with open_text(tax_file) as f:
         for line in f:
             split_line = line.rstrip().split("\t")
             tax_dict[split_line[0]] = split_line[1]
 
-    first_line = True
-    tax = ''
-    seq = ''
-    id = ''
-    with open(comb_file, 'w') as c_out, \
-         open(fasta_file, 'r') as f_read:
-
-        for line in f_read:
-            if line[0] == '>':
-                if not first_line:
-                    c_out.write("{} {}\n{}".format(id, tax, seq))
-
-                id = line.rstrip()
-                tax = tax_dict[id]
-                seq = ''
-                first_line = False
-
-            else:
-                seq += line
-
-        c_out.write("{} {}\n{}".format(id, tax, seq))
-
-    return comb_file
+    for header, seq in records:
+        tax = tax_dict[f">{header}"]
+        yield f"{header} {tax}", seq
 
 
 def get_v_loop():
@@ -895,7 +1037,17 @@ def check_fasta_file(file):
     quits and prints error messages.
     """
     if check_file(file):
-        if count_entries(file) < 1:
+        method = compression_of(file)
+        if method == "zst" and not importlib.util.find_spec("zstandard"):
+            error_msg = "Python module zstandard was not found"
+            quit(error_msg)
+
+        if method:
+            has_entries = next(fasta_records(file), None) is not None
+        else:
+            has_entries = count_entries(file) > 0
+
+        if not has_entries:
             error_msg = f"ERROR: No entries found in {file}"
             quit(error_msg)
     else:
@@ -0,0 +1,125 @@
+"""Incremental builds, every build stores the tax_clusters entries, the
+representative taxonomy and flags of its clusters and the manual review
+decisions in metaxaQR_db/label/reuse/, keyed by a hash of the records of the
+cluster and its tax_db stamp, the tax_db entries the cluster looked up. A
+build prepared with --previous_label reuses them for all clusters that are
+unchanged since the previous build, only the new or changed clusters are
+processed and reviewed.
+"""
+
+import hashlib
+import os
+import pickle
+from pathlib import Path
+from .handling import return_reuse_path, return_init_path, check_file
+
+
+def return_reuse_file(run_label, name):
+    """Returns the path to a reuse file, cluster_tax, repr_{identity} or
+    review.
+    """
+    return f"{return_reuse_path(run_label)}{name}"
+
+
+def content_key(lines):
+    """Returns the key of a cluster, the sha1 digest of its lines in order.
+    """
+    return hashlib.sha1("\n".join(lines).encode()).digest()
+
+
+def cluster_key(raw, settings):
+    """Returns the key of a cluster, the sha1 digest of the settings it is
+    processed with and its FASTA records as bytes.
+    """
+    digest = hashlib.sha1(repr(settings).encode())
+    digest.update(raw)
+    return digest.digest()
+
+
+def stamped_key(key, stamp):
+    """Returns the key of a cluster together with its tax_db stamp.
+    """
+    return content_key(
+        [key.hex()] + [f"{k}\t{v}" for k, v in sorted(stamp.items())]
+    )
+
+
+def stamp_matches(stamp, tax_db):
+    """Returns True if all tax_db entries of a stamp are unchanged in tax_db.
+    """
+    return all(tax_db.get(k) == v for k, v in stamp.items())
+
+
+class StampedTaxDB:
+    """Read only view of a tax_db dictionary, records every key looked up
+    with its value (None if missing) as the tax_db stamp of a cluster.
+    """
+    def __init__(self, tax_db):
+        self.tax_db = tax_db
+        self.stamp = {}
+
+    def __contains__(self, key):
+        self.stamp[key] = self.tax_db.get(key)
+        return key in self.tax_db
+
+    def __getitem__(self, key):
+        self.stamp[key] = self.tax_db[key]
+        return self.stamp[key]
+
+
+def set_previous_label(run_label, previous_label):
+    """Stores the label of the previous build in the init directory, used by
+    all later steps of the build. Removes it if previous_label is None.
+    """
+    previous_file = f"{return_init_path(run_label)}previous"
+    if previous_label is None:
+        if check_file(previous_file):
+            os.remove(previous_file)
+    else:
+        with open(previous_file, 'w') as f:
+            f.write(previous_label)
+
+
+def get_previous_label(run_label):
+    """Returns the label of the previous build, None if not incremental.
+    """
+    previous_file = f"{return_init_path(run_label)}previous"
+    if not check_file(previous_file):
+        return None
+
+    with open(previous_file, 'r') as f:
+        return f.read()
+
+
+def load_reuse(run_label, name):
+    """Reads a reuse file of a build into a dictionary, empty if missing.
+    """
+    reuse_file = return_reuse_file(run_label, name)
+    if not check_file(reuse_file):
+        return {}
+
+    with open(reuse_file, 'rb') as f:
+        return pickle.load(f)
+
+
+def load_previous(run_label, name):
+    """Reads a reuse file of the previous build, empty if not incremental.
+    """
+    previous_label = get_previous_label(run_label)
+    if previous_label is None:
+        return {}
+
+    return load_reuse(previous_label, name)
+
+
+def write_reuse(run_label, name, reuse):
+    """Writes a reuse file, replacing the old file only once the new one has
+    been fully written.
+    """
+    Path(return_reuse_path(run_label)).mkdir(parents=True, exist_ok=True)
+    reuse_file = return_reuse_file(run_label, name)
+    tmp_file = f"{reuse_file}.tmp"
+
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(reuse, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, reuse_file)
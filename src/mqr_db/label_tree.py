@@ -0,0 +1,266 @@
+"""Binary label tree, mqr.tree.bin next to mqr.tree. The tree is stored as a
+matrix of int32 cluster numbers, one row per 100% cluster and one column per
+identity level (100, 99 ... 90, 85 ... 50), so labels are not parsed again
+when the tree is read. The file is memory mapped by LabelTree, the text tree
+is written from it and can be converted back if the binary file is missing.
+"""
+
+import array
+import mmap
+import os
+import struct
+from .compression import extensions, open_output, open_text
+from .handling import get_v_loop
+
+#: header of the binary tree, magic, number of levels, size of the label
+#: prefix (MQR_label) and number of rows
+tree_header = struct.Struct("<4sIIQ")
+tree_magic = b"MQRT"
+
+#: rows written per block
+block_rows = 1 << 14
+
+
+def return_bin_file(tree_file):
+    """Returns the path to the binary tree of a text tree file, possibly
+    compressed (mqr.tree.gz -> mqr.tree.bin).
+    """
+    for ext in extensions.values():
+        if tree_file.endswith(ext):
+            tree_file = tree_file[:-len(ext)]
+
+    return f"{tree_file}.bin"
+
+
+def parse_tree_line(line, levels):
+    """Returns the cluster numbers of a text tree line by level, -1 for
+    levels missing in the line.
+    """
+    columns = {level: i for i, level in enumerate(levels)}
+    row = [-1] * len(levels)
+    label_100, tree = line.rstrip("\n").split("\t")
+    for label in [label_100] + tree.split(" "):
+        if label:
+            _, level, cluster = label.rsplit("_", 2)
+            row[columns[int(level)]] = int(cluster)
+
+    return row
+
+
+def write_label_tree(file, prefix, levels, rows):
+    """Writes a binary tree from rows of cluster numbers by level, the
+    labels are {prefix}_{level}_{cluster}.
+    """
+    prefix_bytes = prefix.encode()
+    n_rows = 0
+
+    with open(file, 'wb') as f:
+        f.write(tree_header.pack(
+            tree_magic,
+            len(levels),
+            len(prefix_bytes),
+            0
+        ))
+        array.array('i', levels).tofile(f)
+        f.write(prefix_bytes + b"\0" * (-len(prefix_bytes) % 4))
+
+        block = array.array('i')
+        for row in rows:
+            block.extend(row)
+            n_rows += 1
+            if n_rows % block_rows == 0:
+                block.tofile(f)
+                block = array.array('i')
+        block.tofile(f)
+
+        f.seek(0)
+        f.write(tree_header.pack(
+            tree_magic,
+            len(levels),
+            len(prefix_bytes),
+            n_rows
+        ))
+
+
+def append_tree_lines(file, lines):
+    """Appends text tree lines to a binary tree, as rows of cluster numbers
+    by the levels of the tree.
+    """
+    with open(file, 'r+b') as f:
+        magic, n_levels, prefix_size, n_rows = tree_header.unpack(
+            f.read(tree_header.size)
+        )
+        levels = array.array('i')
+        levels.fromfile(f, n_levels)
+        block = array.array('i')
+        for line in lines:
+            block.extend(parse_tree_line(line, levels))
+            n_rows += 1
+        f.seek(0, os.SEEK_END)
+        block.tofile(f)
+
+        f.seek(0)
+        f.write(tree_header.pack(magic, n_levels, prefix_size, n_rows))
+
+
+def convert_text_tree(tree_file, levels):
+    """Writes the binary tree of a text tree file (databases created before
+    the binary tree), returning its path.
+    """
+    bin_file = return_bin_file(tree_file)
+    prefix = ""
+    with open_text(tree_file) as f:
+        first_line = f.readline()
+        if first_line:
+            prefix = first_line.split("\t")[0].rsplit("_", 2)[0]
+
+    with open_text(tree_file) as f:
+        write_label_tree(
+            bin_file,
+            prefix,
+            levels,
+            (parse_tree_line(line, levels) for line in f if line.strip())
+        )
+
+    return bin_file
+
+
+def check_bin_tree(tree_file):
+    """Returns the path to the binary tree of a text tree file, converting the
+    text tree first if there is no binary tree.
+    """
+    bin_file = return_bin_file(tree_file)
+    if not os.path.isfile(bin_file):
+        convert_text_tree(tree_file, [int(v) for v in get_v_loop()])
+
+    return bin_file
+
+
+def load_label_tree(tree_file):
+    """Opens the binary tree of a text tree file, see check_bin_tree.
+    """
+    return LabelTree(check_bin_tree(tree_file))
+
+
+class LabelTree:
+    """Reader of a binary tree. Gives the cluster of a 100% cluster at any
+    level, all 100% clusters of a cluster at a level and the text lines of
+    the tree.
+    """
+    def __init__(self, file):
+        self.file = file
+        with open(file, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, n_levels, prefix_size, n_rows = tree_header.unpack_from(
+            self.data
+        )
+        if magic != tree_magic:
+            self.data.close()
+            raise ValueError(f"{file} is not a binary label tree")
+
+        pos = tree_header.size
+        self.levels = list(struct.unpack_from(f"{n_levels}i", self.data, pos))
+        pos += 4 * n_levels
+        self.prefix = self.data[pos:pos+prefix_size].decode()
+        pos += prefix_size + (-prefix_size % 4)
+
+        self.n_levels = n_levels
+        self.n_rows = n_rows
+        self.columns = {level: i for i, level in enumerate(self.levels)}
+        self.matrix = memoryview(self.data)[
+            pos:pos + 4 * n_levels * n_rows
+        ].cast('i')
+        self.rows = None
+        self.level_groups = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.n_rows
+
+    def close(self):
+        if not self.data.closed:
+            self.matrix.release()
+            self.data.close()
+
+    def row(self, i):
+        """Returns the cluster numbers of row i by level.
+        """
+        return self.matrix[i*self.n_levels:(i+1)*self.n_levels].tolist()
+
+    def column(self, level):
+        """Returns the cluster numbers at a level of all rows.
+        """
+        return self.matrix[self.columns[int(level)]::self.n_levels].tolist()
+
+    def cluster_at(self, level, cluster_100):
+        """Returns the cluster at level of 100% cluster cluster_100.
+        """
+        if self.rows is None:
+            self.rows = {c: i for i, c in enumerate(self.column(100))}
+        i = self.rows[int(cluster_100)]
+
+        return self.matrix[i*self.n_levels + self.columns[int(level)]]
+
+    def groups(self, level):
+        """Returns a dictionary of every cluster at level and its 100%
+        clusters, in the order of the tree.
+        """
+        level = int(level)
+        if level not in self.level_groups:
+            groups = {}
+            for cluster, cluster_100 in zip(
+                self.column(level),
+                self.column(100)
+            ):
+                if cluster not in groups:
+                    groups[cluster] = []
+                groups[cluster].append(cluster_100)
+            self.level_groups[level] = groups
+
+        return self.level_groups[level]
+
+    def members(self, level, cluster):
+        """Returns all 100% clusters of cluster at level.
+        """
+        return self.groups(level).get(int(cluster), [])
+
+    def label(self, level, cluster):
+        """Returns the label of a cluster, empty if the cluster is missing.
+        """
+        if cluster < 0:
+            return ""
+
+        return f"{self.prefix}_{level}_{cluster}"
+
+    def line(self, i):
+        """Returns the text tree line of row i, without line break.
+        """
+        row = self.row(i)
+        labels = [
+            self.label(level, cluster)
+            for level, cluster in zip(self.levels, row)
+        ]
+
+        return "{}\t{}".format(labels[0], " ".join(labels[1:]))
+
+    def lines(self):
+        """Yields the text tree lines of all rows.
+        """
+        for i in range(self.n_rows):
+            yield self.line(i)
+
+
+def write_text_tree(bin_file, tree_file, compress=""):
+    """Writes the text tree (mqr.tree) of a binary tree, block compressed if
+    compress (gz, zst).
+    """
+    with LabelTree(bin_file) as tree, \
+         open_output(tree_file, compress) as f:
+        for line in tree.lines():
+            f.write(f"{line}\n")
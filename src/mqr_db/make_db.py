@@ -3,9 +3,14 @@
 
 import os
 from pathlib import Path
-import shutil
 from .handling import return_proj_path, check_file, get_v_loop
 from .handling import return_removed_path, check_dir
+from .cluster_store import ClusterStore
+from .compression import open_output, remove_db_file
+from .dictionary import TaxDictionary, full_label
+from .label_tree import return_bin_file, write_label_tree, write_text_tree
+from .fasta import fasta_records, FastaWriter
+from .telemetry import span
 
 
 def get_deleted_clusters(run_label, dels_only=False):
@@ -40,36 +45,30 @@ def get_deleted_clusters(run_label, dels_only=False):
         return excluded_clusters
 
 
-def get_centroids(path, result_path, qc, run_label):
-    """Copies the 'final_centroids' file from mqr_db/100/ to db result path
+def get_centroids(path, result_path, qc, run_label, compress=""):
+    """Writes the 'final_centroids' file from mqr_db/100/ to db result path,
+    with the taxonomies expanded, compressed if compress (gz, zst)
     """
     my_cent = Path("{}100/final_centroids".format(path))
-    to_cent = Path("{}mqr.fasta".format(result_path))
+    to_cent = "{}mqr.fasta".format(result_path)
+    remove_db_file(to_cent)
 
+    excluded_clusters = set()
     if qc:
-        excluded_clusters = get_deleted_clusters(run_label)
-
-        with open(my_cent, 'r') as rf, \
-             open(to_cent, 'w') as of:
-
-            seq = ""
-            cluster = ""
-            for line in rf:
-                curr_line = line.rstrip()
-
-                if curr_line[0] == ">":
-                    if seq and id not in excluded_clusters:
-                        of.write(f"{header}\n{seq}")
-
-                    header = curr_line
-                    seq = ""
-                    cluster = header.split("\t")[1]
-
-                else:
-                    seq += f"{curr_line}\n"
-
-    else:
-        shutil.copy(my_cent, to_cent)
+        excluded_clusters = set(get_deleted_clusters(run_label))
+    tax_dict = TaxDictionary(run_label)
+
+    with FastaWriter(
+        open_output(to_cent, compress, fasta=True),
+        width=80
+    ) as of:
+        for header, seq in fasta_records(my_cent):
+            acc_id, cluster, tax_id = header.split("\t")
+            if cluster not in excluded_clusters:
+                of.write(
+                    f"{acc_id}\t{cluster}\t{tax_dict.decode(tax_id)}",
+                    seq
+                )
 
 
 def get_label_tree(
@@ -77,62 +76,76 @@ def get_label_tree(
                    result_path,
                    v_loop,
                    qc_low_clusters,
-                   run_label):
+                   run_label,
+                   compress=""):
     """Takes the label tree created at 50% seqence identity and converts it
-    into a dictionary format where the mqr_100 (100% seq id) label is key and
-    the values are all the labels of the lower sequence identities, in
-    descending order.
+    into a tree where the mqr_100 (100% seq id) label is followed by all the
+    labels of the lower sequence identities, in descending order. The tree is
+    written as the binary tree (mqr.tree.bin), the text tree (mqr.tree) is
+    written from it.
     """
-    excluded_clusters = []
+    excluded_clusters = set()
     if qc_low_clusters:
-        excluded_clusters = get_deleted_clusters(run_label)
+        excluded_clusters = set(get_deleted_clusters(run_label))
     label_file = "{}50/label_tree".format(path)
     final_label = "{}mqr.tree".format(result_path)
+    final_bin = return_bin_file(final_label)
+    remove_db_file(final_label)
+
+    write_label_tree(
+        final_bin,
+        f"MQR_{run_label}",
+        [int(v) for v in v_loop],
+        read_tree_rows(label_file, v_loop, excluded_clusters, run_label)
+    )
+    write_text_tree(final_bin, final_label, compress)
 
+
+def read_tree_rows(label_file, v_loop, excluded_clusters, run_label):
+    """Yields the cluster numbers by level of every 100% cluster in the label
+    tree created at 50% sequence identity, except excluded clusters.
+    """
     dl = {}
     for v in v_loop:
-        dl["curr_{}".format(v)] = ""
-
-    with open(final_label, 'w') as wf, \
-         open(label_file, 'r') as rf:
+        dl[int(v)] = -1
 
+    with open(label_file, 'r') as rf:
         for line in rf:
             curr_line = line.rstrip()
-            dl["curr_50"] = curr_line.split("\t")[0]
-            label_out = ""
+            dl[50] = int(curr_line.split("\t")[0].split("_")[-1])
 
             for label in curr_line.split("\t")[1].split(" "):
-                id = label.split("_")[-2]
-                dl["curr_{}".format(id)] = label
-
-                if int(id) == 100:
-                    for key in dl:
-                        if key == "curr_100":
-                            label_out = "{}\t".format(dl["curr_100"])
-                        else:
-                            label_out += "{} ".format(dl[key])
-                    if qc_low_clusters:
-                        if label_out.split("\t")[0] not in excluded_clusters:
-                            wf.write("{}\n".format(label_out[:-1]))
-                    else:
-                        wf.write("{}\n".format(label_out[:-1]))
-
-
-def get_repr(path, result_path, v_loop, run_label):
+                id = int(label.split("_")[-2])
+                dl[id] = int(label.split("_")[-1])
+
+                if (
+                    id == 100
+                    and full_label(run_label, label) not in excluded_clusters
+                ):
+                    yield list(dl.values())
+
+
+def get_repr(path, result_path, v_loop, run_label, compress=""):
     """Creates a final_repr file which contains all lines from all final_repr
     files in the runs from 50-100% sequence identity. Every line is the label,
-    entry id, and representative taxonomy, seperated by tabs.
+    entry id, and representative taxonomy, seperated by tabs. Taxonomies are
+    expanded from the taxonomy dictionary.
     """
     final_repr = "{}mqr.repr".format(result_path)
+    remove_db_file(final_repr)
+    tax_dict = TaxDictionary(run_label)
 
-    with open(final_repr, 'w') as f:
+    with open_output(final_repr, compress) as f:
         for id in v_loop:
             curr_repr = "{}{}/final_repr".format(path, id)
             with open(curr_repr, 'r') as tmp:
-                curr = tmp.readlines()
-                for line in curr:
-                    if line:
-                        f.write(line)
+                for line in tmp:
+                    label, entry_id, tax_id = line.rstrip("\n").split("\t")
+                    f.write("{}\t{}\t{}\n".format(
+                        label,
+                        entry_id,
+                        tax_dict.decode(tax_id)
+                    ))
 
 
 def find_bad_hits(run_label, cutoff_point=5, str_id='70', depth=False):
@@ -146,14 +159,18 @@ def find_bad_hits(run_label, cutoff_point=5, str_id='70', depth=False):
     removed_path = return_removed_path(run_label)
     label_file = "{}/label_tree".format(run_path)
     bad_hits = "{}bad_hits".format(removed_path)
-    hit_label = "_100_"
+    hit_label = "100_"
 
     with open(label_file, 'r') as tree, \
-         open(bad_hits, 'w') as out:
+         open(bad_hits, 'w') as out, \
+         ClusterStore(return_proj_path(run_label) + "100") as store:
 
         for label in tree:
             labels = label.rstrip().split("\t")[1].split(" ")
-            hits = [v for v in labels if hit_label in v]
+            hits = [
+                full_label(run_label, v) for v in labels
+                if v.startswith(hit_label)
+            ]
 
             if len(hits) < cutoff_point:
 
@@ -163,12 +180,7 @@ def find_bad_hits(run_label, cutoff_point=5, str_id='70', depth=False):
 
                     for hit in hits:
                         ind = hit.split("_")[-1]
-                        cluster_file = "{}100/clusters/cluster_{}".format(
-                            run_path,
-                            ind
-                        )
-                        with open(cluster_file, 'r') as f:
-                            orig_count += f.read().count(">")
+                        orig_count += store.entry_count(ind)
 
                     if orig_count < cutoff_point:
                         for hit in hits:
@@ -179,12 +191,14 @@ def find_bad_hits(run_label, cutoff_point=5, str_id='70', depth=False):
                         out.write("{}\n".format(hit))
 
 
-def make_db(run_label, qc_limited_clusters, qc_taxonomy_quality):
+def make_db(run_label, qc_limited_clusters, qc_taxonomy_quality,
+            compress=""):
     """Creates the output datasets used by MetaxaQR. A centroid file which
     contains all entries clustered at 100% sequence identity, a representative
     taxonomy file containing all representative taxonomies at all sequence
     identity levels and finally a file containing the tree structure of all
-    labels at all sequence identity levels.
+    labels at all sequence identity levels. The files are block compressed,
+    with an index, if compress (gz, zst).
     """
     path = return_proj_path(run_label)
     result_path = f"{Path(path).parent}/"
@@ -199,7 +213,11 @@ def make_db(run_label, qc_limited_clusters, qc_taxonomy_quality):
     qc = qc_limited_clusters or qc_taxonomy_quality
 
     if qc_limited_clusters:
-        find_bad_hits(run_label)
-    get_centroids(path, result_path, qc, run_label)
-    get_label_tree(path, result_path, v_loop, qc, run_label)
-    get_repr(path, result_path, v_loop, run_label)
+        with span("find_bad_hits"):
+            find_bad_hits(run_label)
+    with span("get_centroids"):
+        get_centroids(path, result_path, qc, run_label, compress)
+    with span("get_label_tree"):
+        get_label_tree(path, result_path, v_loop, qc, run_label, compress)
+    with span("get_repr"):
+        get_repr(path, result_path, v_loop, run_label, compress)
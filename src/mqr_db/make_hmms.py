@@ -1,10 +1,28 @@
 """Make HMM module, makes hidden markov models from a MetaxaQR database.
 """
+import json
+import os
 import subprocess
 import random
+import time
+from bisect import bisect_left
+from collections import deque
+from itertools import islice
 from pathlib import Path
-from collections import Counter
-from .handling import return_proj_path, count_entries
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from .handling import return_proj_path, count_entries, check_file
+from .cluster_store import ClusterStore
+from .align_cache import return_cache_path, set_align_cache, cache_key
+from .align_cache import return_mafft_version
+from .align_cache import fetch_alignment, store_alignment, evict_alignments
+from .compression import resolve_db_file
+from .label_tree import load_label_tree
+from .manifest import hash_file
+from .fasta import fasta_records, FastaWriter
+from .telemetry import span, add_count
+
+#: clusters with fewer entries are aligned and built with one thread
+parallel_entries = 100
 
 
 def make_hmms(
@@ -19,222 +37,691 @@ def make_hmms(
     conservation_cutoff=0.6,
     look_ahead=4,
     min_length=20,
-    max_gaps=5
+    max_gaps=5,
+    cap_seed=None,
+    cap_stratified=False,
+    delta=False,
+    align_cache=0,
+    slice_regions=False,
+    slice_report=False
 ):
     """Creates HMMs from MetaxaQR database or a provided sequence database, 3
     modes - divergent, hybrid and conserved. Uses MAFFT to align the sequences
-    then HMMER to make the HMMs.
+    then HMMER to make the HMMs. Capped alignments (limit_entries) are
+    sampled with cap_seed, over the 100% clusters if cap_stratified. The
+    source cluster and content hash of every HMM are recorded in the HMM
+    directory, if delta only the clusters that changed since the last build
+    with the same settings are built again, and only their origins pressed.
+    Alignments are looked up in the alignment cache, limited to align_cache
+    MB (0 disables the cache). In hybrid and conserved modes slice_regions
+    builds the HMMs from the sliced alignments without realigning them,
+    slice_report writes a report of the time and agreement of the
+    realignments (see build_conserved_hmms). Returns the share of the cpu
+    used while the HMMs were built, see run_hmm_jobs.
     """
     create_align_structure(run_label)
     hmm_dir = f"{Path(return_proj_path(run_label)).parent}/HMMs/"
-    cluster_dir = f"{return_proj_path(run_label)}100/clusters/"
+    cluster_path = f"{return_proj_path(run_label)}100"
     align_dir = f"{return_proj_path(run_label)}alignment/"
     hmm_files = {}
     origin_runs = {}
 
-    #: divergent mode
-    if mode.lower() == "divergent":
-
-        #: get all clusters
-        orig_ids = make_cluster_seq_files(
-            seq_id,
-            tree_file,
-            cluster_dir,
-            align_dir
-            )
-
-        for id in orig_ids:
-            for origin in orig_ids[id]:
-                file = f"{align_dir}cluster_{id}_{origin}"
-
-                #: limits number of entries in the alignment
-                if limit_entries:
-                    file = process_alignment_cap(file, max_limit)
+    #: divergent and hybrid modes uses all clusters at seq_id
+    if mode.lower() == "divergent" or mode.lower() == "hybrid":
+        with span("make_cluster_seq_files", id=seq_id):
+            orig_ids = make_cluster_seq_files(
+                seq_id,
+                tree_file,
+                cluster_path,
+                align_dir,
+                stratified=limit_entries and cap_stratified
+                )
 
-                #: align the sequences
-                a_file = run_mafft(file, cpu)
+    #: conserved mode uses the sequence database as one cluster
+    elif mode.lower() == "conserved":
+        con_id = "0"
+        with span("make_conserved_seq_files"):
+            orig_ids = make_conserved_seq_files(seq_db, con_id, align_dir)
 
-                #: split the alignment in two
-                head, tail = split_alignment(a_file)
+    #: builds the HMMs of every cluster and origin in parallel
+    jobs = {}
+    for id in orig_ids:
+        for origin in orig_ids[id]:
+            jobs[(id, origin)] = f"{align_dir}cluster_{id}_{origin}"
 
-                #: order the HMMs created numerically
+    if mode.lower() == "divergent":
+        build_func = build_divergent_hmms
+        build_args = (
+            align_dir,
+            limit_entries,
+            max_limit,
+            cap_seed,
+            cap_stratified
+        )
+    else:
+        build_func = build_conserved_hmms
+        build_args = (
+            align_dir,
+            limit_entries,
+            max_limit,
+            cap_seed,
+            cap_stratified,
+            conservation_cutoff,
+            look_ahead,
+            min_length,
+            max_gaps,
+            slice_regions,
+            slice_report
+        )
+
+    #: jobs unchanged since the last build reuse its HMMs
+    params = {
+        "mode": mode.lower(),
+        "seq_id": seq_id,
+        "limit_entries": limit_entries,
+        "max_limit": max_limit,
+        "cap_seed": cap_seed,
+        "cap_stratified": cap_stratified,
+        "conservation_cutoff": conservation_cutoff,
+        "look_ahead": look_ahead,
+        "min_length": min_length,
+        "max_gaps": max_gaps,
+        "slice_regions": slice_regions
+    }
+    hashes = {job: hash_file(jobs[job]) for job in jobs}
+    sources = {}
+    if delta:
+        sources = read_hmm_sources(hmm_dir, params)
+    reused = reused_jobs(jobs, hashes, sources, hmm_dir)
+    build_jobs = {job: jobs[job] for job in jobs if job not in reused}
+    add_count("reused", len(reused))
+
+    #: origins with a new, changed or removed job are pressed again
+    press_origins = {origin for id, origin in build_jobs}
+    for id, origin in sources:
+        if (id, origin) not in jobs:
+            press_origins.add(origin)
+
+    cache_path = ""
+    mafft_version = ""
+    if align_cache:
+        cache_path = return_cache_path()
+        mafft_version = return_mafft_version()
+    set_align_cache(cache_path, mafft_version)
+
+    job_results, usage = run_hmm_jobs(
+        build_jobs,
+        build_func,
+        build_args,
+        cpu,
+        cache_path,
+        mafft_version
+    )
+    job_results.update(reuse_hmms(
+        reused,
+        sources,
+        press_origins,
+        hmm_dir,
+        align_dir
+    ))
+
+    #: collects the results in cluster order, as if built one at a time
+    for id in orig_ids:
+        for origin in orig_ids[id]:
+            h_files = job_results[(id, origin)]
+
+            #: order the HMMs created numerically
+            if mode.lower() == "divergent":
                 if origin not in origin_runs:
                     origin_runs[origin] = 0
                 else:
                     origin_runs[origin] += 1
+            else:
+                curr_runs = len(h_files)
+                if origin not in origin_runs:
+                    origin_runs[origin] = curr_runs
+                else:
+                    if curr_runs > origin_runs[origin]:
+                        origin_runs[origin] = curr_runs
 
-                h_id = f"01-cluster_{id}"
-                t_id = f"02-cluster_{id}"
-                split_files = {h_id: head, t_id: tail}
+            for h_file in h_files:
+                if origin not in hmm_files:
+                    hmm_files[origin] = [h_file]
+                else:
+                    hmm_files[origin].append(h_file)
+
+    #: builds full hmm files from the hmmbuilder files
+    for origin in hmm_files:
+        if origin not in press_origins:
+            continue
+        orig_files = hmm_files[origin]
+        add_count("hmms", len(orig_files))
+        with span("run_hmmer_press", origin=origin):
+            run_hmmer_press(orig_files, origin, hmm_dir)
 
-                #: make the HMM files
-                for split_id in split_files:
-                    h_file = run_hmmer_build(
-                        split_files[split_id],
-                        origin,
-                        split_id,
-                        align_dir,
-                        cpu
-                        )
-                    if origin not in hmm_files:
-                        hmm_files[origin] = [h_file]
-                    else:
-                        hmm_files[origin].append(h_file)
+    create_hmm_names(origin_runs, hmm_dir, mode.lower())
+    write_hmm_sources(hmm_dir, params, orig_ids, hashes, job_results)
 
-        for origin in hmm_files:
-            orig_files = hmm_files[origin]
-            run_hmmer_press(orig_files, origin, hmm_dir)
+    if slice_report and mode.lower() != "divergent":
+        write_slice_report(
+            [f"{build_jobs[job]}.slice_report" for job in build_jobs],
+            hmm_dir,
+            mode.lower()
+        )
 
-        create_hmm_names(origin_runs, hmm_dir, mode.lower())
+    if align_cache:
+        evict_alignments(cache_path, align_cache * 1024 * 1024)
 
-    #: hybrid mode
-    elif mode.lower() == "hybrid":
+    return usage
 
-        #: get all clusters
-        orig_ids = make_cluster_seq_files(
-            seq_id,
-            tree_file,
-            cluster_dir,
-            align_dir
-            )
 
-        for id in orig_ids:
-            for origin in orig_ids[id]:
-                file = f"{align_dir}cluster_{id}_{origin}"
+def return_sources_file(hmm_dir):
+    """Returns the path to the HMM sources file of an HMM directory.
+    """
+    return f"{hmm_dir}hmm_sources.json"
 
-                #: limits number of entries in the alignment
-                if limit_entries:
-                    file = process_alignment_cap(file, max_limit)
 
-                #: aligns the file
-                a_file = run_mafft(file, cpu)
+def read_hmm_sources(hmm_dir, params):
+    """Reads the HMM sources of the last build into a dictionary keyed by
+    cluster/origin job, empty if missing or built with other params.
+    """
+    sources_file = return_sources_file(hmm_dir)
+    if not check_file(sources_file):
+        return {}
 
-                #: trims the aligned file
-                t_file = trim_alignment(a_file)
+    with open(sources_file, 'r') as f:
+        sources = json.load(f)
 
-                #: aligns the trimmed file
-                a_file = run_mafft(t_file, cpu)
+    if sources["params"] != params:
+        return {}
 
-                #: gets all conserved regions
-                conserved_regions = get_conserved_regions(
-                    a_file,
-                    conservation_cutoff,
-                    look_ahead,
-                    min_length,
-                    max_gaps
-                )
+    return {
+        (id, origin): {"hash": hash, "hmms": hmms}
+        for id, origin, hash, hmms in sources["jobs"]
+    }
+
+
+def write_hmm_sources(hmm_dir, params, orig_ids, hashes, job_results):
+    """Writes the HMM sources, the cluster and origin of every job with the
+    hash of its sequence file and the names of its HMMs, in build order.
+    """
+    sources_file = return_sources_file(hmm_dir)
+    tmp_file = f"{sources_file}.tmp"
+    jobs = []
+    for id in orig_ids:
+        for origin in orig_ids[id]:
+            jobs.append([
+                id,
+                origin,
+                hashes[(id, origin)],
+                [Path(h_file).stem for h_file in job_results[(id, origin)]]
+            ])
+
+    with open(tmp_file, 'w') as f:
+        json.dump({"params": params, "jobs": jobs}, f, indent=1)
+    os.replace(tmp_file, sources_file)
+
+
+def reused_jobs(jobs, hashes, sources, hmm_dir):
+    """Returns the jobs whose sequence file is unchanged since the last
+    build, and whose pressed origin file is still found.
+    """
+    reused = []
+    for job in jobs:
+        id, origin = job
+        if (
+            job in sources
+            and sources[job]["hash"] == hashes[job]
+            and check_file(f"{hmm_dir}{origin}.hmm")
+        ):
+            reused.append(job)
+
+    return reused
+
+
+def split_hmm_file(hmm_file):
+    """Returns a dictionary of the name and text of every HMM in a
+    combined HMM file.
+    """
+    models = {}
+    lines = []
+    name = ""
+    with open(hmm_file, 'r') as f:
+        for line in f:
+            lines.append(line)
+            if line.startswith("NAME "):
+                name = line.split()[1]
+            elif line.startswith("//"):
+                models[name] = "".join(lines)
+                lines = []
+                name = ""
 
-                curr_runs = 0
+    return models
 
-                for conserved_id in conserved_regions:
-                    #: alignes the conserved region
-                    a_file = run_mafft(conserved_regions[conserved_id], cpu)
 
-                    #: order the HMMs created numerically
-                    curr_runs += 1
-                    c_id = ""
-                    if curr_runs < 10:
-                        c_id = f"0{curr_runs}-cluster_{id}"
-                    else:
-                        c_id = f"{curr_runs}-cluster_{id}"
+def reuse_hmms(reused, sources, press_origins, hmm_dir, align_dir):
+    """Returns the HMM files of the reused jobs. The HMMs of origins that are
+    pressed again are written to the alignment directory from the pressed
+    file of the last build.
+    """
+    results = {}
+    models = {}
+    for origin in {origin for id, origin in reused} & press_origins:
+        models[origin] = split_hmm_file(f"{hmm_dir}{origin}.hmm")
+
+    for job in reused:
+        id, origin = job
+        h_files = []
+        for name in sources[job]["hmms"]:
+            h_file = f"{align_dir}{name}.hmm"
+            if origin in models:
+                with open(h_file, 'w') as f:
+                    f.write(models[origin][name])
+            h_files.append(h_file)
+        results[job] = h_files
+
+    return results
+
+
+def alignment_cost(file):
+    """Returns the estimated cost of aligning a sequence file, the number of
+    entries squared times their mean length, and the number of entries.
+    """
+    entries = 0
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            entries += chunk.count(b">")
+
+    return entries * Path(file).stat().st_size, entries
+
 
-                    #: makes hmm file from the conserved region
-                    h_file = run_hmmer_build(
-                        a_file,
+def job_threads(jobs, cpu):
+    """Returns the cost and threads of every job. Every job is given a share
+    of the cpu by its share of the total cost, at least one thread. Jobs of
+    fewer than parallel_entries entries gain nothing from more threads and
+    are given one.
+    """
+    costs = {}
+    threads = {}
+    entries = {}
+    for job in jobs:
+        costs[job], entries[job] = alignment_cost(jobs[job])
+    total = sum(costs.values())
+
+    for job in jobs:
+        threads[job] = 1
+        if total and entries[job] >= parallel_entries:
+            threads[job] = max(1, min(cpu, round(cpu * costs[job] / total)))
+
+    return costs, threads
+
+
+def run_hmm_jobs(
+                 jobs,
+                 build_func,
+                 build_args,
+                 cpu,
+                 cache_path="",
+                 mafft_version=""
+                 ):
+    """Runs the alignment and HMM build of every cluster/origin job in a
+    process pool, starting with the most costly jobs. Every job is given
+    threads by its cost (see job_threads), jobs are started while their
+    threads fit in the cpu budget, taking the most costly job of the largest
+    threads that fit, so small single threaded jobs are packed next to the
+    large ones without using more than cpu threads. The workers use the
+    alignment cache at cache_path, keyed by mafft_version. Returns a
+    dictionary of the HMM files created by each job, and the share of the
+    cpu used by the jobs (CPU time of the jobs and their tools over cpu
+    times the wall time).
+    """
+    cpu = int(cpu)
+    results = {}
+    cpu_time = 0
+    start_time = time.perf_counter()
+
+    costs, threads = job_threads(jobs, cpu)
+    job_order = sorted(jobs, key=lambda job: costs[job], reverse=True)
+
+    if cpu == 1 or len(job_order) == 1:
+        for job in job_order:
+            id, origin = job
+            results[job], job_cpu = run_hmm_job(
+                build_func, jobs[job], id, origin, threads[job], *build_args
+            )
+            cpu_time += job_cpu
+
+    else:
+        with ProcessPoolExecutor(
+            max_workers=cpu,
+            initializer=set_align_cache,
+            initargs=(cache_path, mafft_version)
+        ) as executor:
+            #: pending jobs by their threads, most costly first
+            pending = {}
+            for job in job_order:
+                if threads[job] not in pending:
+                    pending[threads[job]] = deque()
+                pending[threads[job]].append(job)
+
+            running = {}
+            free = cpu
+            while pending or running:
+                #: starts jobs from the largest threads that fit
+                while free:
+                    fits = [n for n in pending if n <= free]
+                    if not fits:
+                        break
+                    n = max(fits)
+                    job = pending[n].popleft()
+                    if not pending[n]:
+                        del pending[n]
+                    id, origin = job
+                    future = executor.submit(
+                        run_hmm_job,
+                        build_func,
+                        jobs[job],
+                        id,
                         origin,
-                        c_id,
-                        align_dir,
-                        cpu
-                        )
-                    if origin not in hmm_files:
-                        hmm_files[origin] = [h_file]
-                    else:
-                        hmm_files[origin].append(h_file)
+                        n,
+                        *build_args
+                    )
+                    running[future] = job
+                    free -= n
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    results[job], job_cpu = future.result()
+                    cpu_time += job_cpu
+                    free += threads[job]
+
+    usage = 0
+    wall = time.perf_counter() - start_time
+    if jobs and wall:
+        usage = cpu_time / (cpu * wall)
+
+    return results, usage
+
+
+def run_hmm_job(build_func, file, id, origin, cpu, *build_args):
+    """Runs the build of one cluster/origin job as a telemetry span,
+    returning the list of HMM files created and the CPU time used by the
+    job and the tools it ran.
+    """
+    with span("build_hmms", cluster=id, origin=origin, threads=cpu) as record:
+        h_files = build_func(file, id, origin, cpu, *build_args)
+        add_count("hmms", len(h_files))
 
-                if origin not in origin_runs:
-                    origin_runs[origin] = curr_runs
-                else:
-                    if curr_runs > origin_runs[origin]:
-                        origin_runs[origin] = curr_runs
+    return h_files, record["cpu"] + record["child_cpu"]
 
-        #: builds full hmm files from the hmmbuilder files
-        for origin in hmm_files:
-            orig_files = hmm_files[origin]
-            run_hmmer_press(orig_files, origin, hmm_dir)
 
-        create_hmm_names(origin_runs, hmm_dir, mode.lower())
+def build_divergent_hmms(
+    file,
+    id,
+    origin,
+    cpu,
+    align_dir,
+    limit_entries,
+    max_limit,
+    cap_seed,
+    cap_stratified
+):
+    """Builds the HMMs of one cluster/origin in divergent mode, aligning the
+    cluster and splitting the alignment in two, creating one HMM per half.
+    Returns list of the HMM files created.
+    """
+    h_files = []
+
+    #: limits number of entries in the alignment
+    if limit_entries:
+        file = process_alignment_cap(
+            file,
+            max_limit,
+            cap_seed,
+            cap_stratified
+        )
+
+    #: align the sequences
+    a_file = run_mafft(file, cpu)
+
+    #: split the alignment in two
+    head, tail = split_alignment(a_file)
+
+    h_id = f"01-cluster_{id}"
+    t_id = f"02-cluster_{id}"
+    split_files = {h_id: head, t_id: tail}
+
+    #: make the HMM files
+    for split_id in split_files:
+        h_file = run_hmmer_build(
+            split_files[split_id],
+            origin,
+            split_id,
+            align_dir,
+            cpu
+            )
+        h_files.append(h_file)
 
-    #: conserved mode
-    elif mode.lower() == "conserved":
-        con_id = "0"
+    return h_files
 
-        orig_ids = make_conserved_seq_files(seq_db, con_id, align_dir)
 
-        for id in orig_ids:
-            for origin in orig_ids[id]:
-                file = f"{align_dir}cluster_{id}_{origin}"
+def build_conserved_hmms(
+    file,
+    id,
+    origin,
+    cpu,
+    align_dir,
+    limit_entries,
+    max_limit,
+    cap_seed,
+    cap_stratified,
+    conservation_cutoff,
+    look_ahead,
+    min_length,
+    max_gaps,
+    slice_regions=False,
+    slice_report=False
+):
+    """Builds the HMMs of one cluster/origin in hybrid or conserved mode,
+    creating one HMM for every conserved region found in the alignment.
+    If slice_regions the trimmed alignment and the conserved regions are
+    used as sliced, without aligning them again. If slice_report the time of
+    every alignment and the agreement of every realignment with the sliced
+    alignment is written to {file}.slice_report. Returns list of the HMM
+    files created.
+    """
+    h_files = []
+    report_file = ""
+    if slice_report:
+        report_file = f"{file}.slice_report"
+        with open(report_file, 'w'):
+            pass
+
+    #: limits number of entries in the alignment
+    if limit_entries:
+        file = process_alignment_cap(
+            file,
+            max_limit,
+            cap_seed,
+            cap_stratified
+        )
+
+    #: aligns the file
+    a_file = report_mafft(file, cpu, report_file, "cluster")
+
+    #: trims the aligned file
+    t_file = trim_alignment(a_file)
+
+    #: aligns the trimmed file
+    if slice_regions:
+        a_file = t_file
+    else:
+        a_file = report_mafft(t_file, cpu, report_file, "trimmed")
+
+    #: gets all conserved regions
+    conserved_regions = get_conserved_regions(
+        a_file,
+        conservation_cutoff,
+        look_ahead,
+        min_length,
+        max_gaps,
+        drop_gaps=slice_regions
+    )
 
-                #: limits number of entries in the alignment
-                if limit_entries:
-                    file = process_alignment_cap(file, max_limit)
+    curr_runs = 0
 
-                #: aligns the file
-                a_file = run_mafft(file, cpu, align_dir=align_dir)
+    for conserved_id in conserved_regions:
+        #: alignes the conserved region
+        if slice_regions:
+            a_file = conserved_regions[conserved_id]
+        else:
+            a_file = report_mafft(
+                conserved_regions[conserved_id],
+                cpu,
+                report_file,
+                "region"
+            )
 
-                #: trims the aligned file
-                t_file = trim_alignment(a_file)
+        #: order the HMMs created numerically
+        curr_runs += 1
+        c_id = ""
+        if curr_runs < 10:
+            c_id = f"0{curr_runs}-cluster_{id}"
+        else:
+            c_id = f"{curr_runs}-cluster_{id}"
+
+        #: makes hmm file from the conserved region
+        h_file = run_hmmer_build(
+            a_file,
+            origin,
+            c_id,
+            align_dir,
+            cpu
+            )
+        h_files.append(h_file)
 
-                #: aligns the trimmed file
-                a_file = run_mafft(t_file, cpu)
+    return h_files
 
-                #: gets all conserved regions
-                conserved_regions = get_conserved_regions(
-                    a_file,
-                    conservation_cutoff,
-                    look_ahead,
-                    min_length,
-                    max_gaps
-                )
 
-                curr_runs = 0
+def report_mafft(file, cpu, report_file, step):
+    """Runs mafft, see run_mafft. If report_file (the slice report of the
+    job) the time of the alignment is added to the report, with the
+    agreement of the alignment with its input for realignments.
+    """
+    if not report_file:
+        return run_mafft(file, cpu)
 
-                for conserved_id in conserved_regions:
-                    #: alignes the conserved region
-                    a_file = run_mafft(conserved_regions[conserved_id], cpu)
+    start_time = time.perf_counter()
+    a_file = run_mafft(file, cpu)
+    seconds = time.perf_counter() - start_time
 
-                    #: order the HMMs created numerically
-                    curr_runs += 1
-                    c_id = ""
-                    if curr_runs < 10:
-                        c_id = f"0{curr_runs}-cluster_{id}"
-                    else:
-                        c_id = f"{curr_runs}-cluster_{id}"
+    agreement = "-"
+    if step != "cluster":
+        agreement = f"{alignment_agreement(file, a_file):.4f}"
 
-                    #: makes hmm file from the conserved region
-                    h_file = run_hmmer_build(
-                        a_file,
-                        origin,
-                        c_id,
-                        align_dir,
-                        cpu
-                        )
-                    if origin not in hmm_files:
-                        hmm_files[origin] = [h_file]
-                    else:
-                        hmm_files[origin].append(h_file)
+    with open(report_file, 'a') as f:
+        f.write(f"{step}\t{seconds:.3f}\t{agreement}\n")
 
-                if origin not in origin_runs:
-                    origin_runs[origin] = curr_runs
-                else:
-                    if curr_runs > origin_runs[origin]:
-                        origin_runs[origin] = curr_runs
+    return a_file
 
-        #: builds full hmm files from the hmmbuilder files
-        for origin in hmm_files:
-            orig_files = hmm_files[origin]
-            run_hmmer_press(orig_files, origin, hmm_dir)
 
-        create_hmm_names(origin_runs, hmm_dir, mode.lower())
+def alignment_agreement(test_file, ref_file):
+    """Returns the sum-of-pairs agreement of two alignments of the same
+    sequences, the share of the residue pairs aligned in ref_file that are
+    also aligned in test_file. Entries are matched by id, entries found in
+    only one file or with other residues are left out.
+    """
+    import numpy as np
+
+    test_rows = dict(fasta_records(test_file, text=False))
+    ref_cols = []
+    test_cols = []
+    test_len = 0
+    for acc_id, ref_seq in fasta_records(ref_file, text=False):
+        test_seq = test_rows.get(acc_id)
+        if test_seq is None:
+            continue
+        ref_res = np.flatnonzero(np.frombuffer(ref_seq, np.uint8) != ord("-"))
+        test_res = np.flatnonzero(
+            np.frombuffer(test_seq, np.uint8) != ord("-")
+        )
+        if len(ref_res) != len(test_res):
+            continue
+        ref_cols.append(ref_res)
+        test_cols.append(test_res)
+        test_len = max(test_len, len(test_seq))
+
+    if not ref_cols:
+        return 1.0
+
+    ref_cols = np.concatenate(ref_cols).astype(np.int64)
+    test_cols = np.concatenate(test_cols).astype(np.int64)
+
+    #: pairs in the same column of ref_file, and of both files
+    counts = np.unique(ref_cols, return_counts=True)[1]
+    ref_pairs = (counts * (counts - 1) // 2).sum()
+    counts = np.unique(
+        ref_cols * (test_len + 1) + test_cols,
+        return_counts=True
+    )[1]
+    both_pairs = (counts * (counts - 1) // 2).sum()
+
+    if not ref_pairs:
+        return 1.0
+
+    return both_pairs / ref_pairs
+
+
+def write_slice_report(report_files, hmm_dir, mode):
+    """Sums the slice reports of all jobs into slice_report.txt in the HMM
+    directory, the number and MAFFT time of the cluster alignments and of
+    the realignments skipped by --hmm_slice_regions, with the agreement of
+    the realignments with the sliced alignments.
+    """
+    steps = {"cluster": [], "trimmed": [], "region": []}
+    for report_file in report_files:
+        if not check_file(report_file):
+            continue
+        with open(report_file, 'r') as f:
+            for line in f:
+                step, seconds, agreement = line.rstrip("\n").split("\t")
+                steps[step].append((float(seconds), agreement))
+
+    total = sum([seconds for step in steps for seconds, _ in steps[step]])
+    res_lines = [
+        f"Region slicing report, {mode} mode",
+        "{:<12}{:>10}{:>12}{:>16}{:>16}".format(
+            "alignment", "count", "mafft_s", "mean_agreement",
+            "min_agreement"
+        )
+    ]
+    realign_time = 0
+    for step in steps:
+        seconds = sum([s for s, _ in steps[step]])
+        agreements = [float(a) for _, a in steps[step] if a != "-"]
+        mean_agr = "-"
+        min_agr = "-"
+        if agreements:
+            mean_agr = f"{sum(agreements)/len(agreements):.4f}"
+            min_agr = f"{min(agreements):.4f}"
+        if step != "cluster":
+            realign_time += seconds
+        res_lines.append("{:<12}{:>10}{:>12.2f}{:>16}{:>16}".format(
+            step, len(steps[step]), seconds, mean_agr, min_agr
+        ))
+
+    share = 0
+    if total:
+        share = 100 * realign_time / total
+    res_lines.append(
+        f"Realignments skipped by --hmm_slice_regions: {realign_time:.2f} s "
+        f"of {total:.2f} s MAFFT time ({share:.1f}%)"
+    )
+
+    with open(f"{hmm_dir}slice_report.txt", 'w') as f:
+        for res_line in res_lines:
+            f.write(f"{res_line}\n")
 
 
 def run_hmmer_build(file, cluster_id, hmm_id, align_dir, cpu):
@@ -247,7 +734,8 @@ def run_hmmer_build(file, cluster_id, hmm_id, align_dir, cpu):
     cmd_hmmbuild.append(hmm_file)
     cmd_hmmbuild.append(file)
 
-    subprocess.run(cmd_hmmbuild)
+    with span("run_hmmer_build", hmm=hmm_name):
+        subprocess.run(cmd_hmmbuild)
 
     return hmm_file
 
@@ -256,7 +744,7 @@ def run_hmmer_press(files, cluster_id, hmm_dir):
     """Runs the hmmpress command, pressing all HMMs into a single database.
     """
     combined_file = hmm_combine(files, cluster_id, hmm_dir)
-    cmd_hmmpress = "hmmpress".split(" ")
+    cmd_hmmpress = "hmmpress -f".split(" ")
     cmd_hmmpress.append(combined_file)
     subprocess.run(cmd_hmmpress)
 
@@ -276,7 +764,8 @@ def hmm_combine(files, cluster_id, hmm_dir):
 
 
 def run_mafft(file, cpu, align_dir=""):
-    """Runs mafft, creating multiple sequence alignment from input sequences
+    """Runs mafft, creating multiple sequence alignment from input sequences.
+    The alignment is copied from the alignment cache if already made.
     """
     #: use mafft to align input file
     err_file = f"{file}.error"
@@ -288,12 +777,23 @@ def run_mafft(file, cpu, align_dir=""):
         err_file = f"{tmp_file}.error"
         out_file = f"{tmp_file}.aligned"
 
-    cmd_mafft = f"mafft --auto --reorder --quiet --thread {cpu}".split(" ")
+    #: the thread count does not change the alignment, not part of the key
+    mafft_opts = "--auto --reorder"
+    cmd_mafft = f"mafft {mafft_opts} --quiet --thread {cpu}".split(" ")
     cmd_mafft.append(file)
+    key = cache_key(file, mafft_opts)
+
+    with span("run_mafft", file=Path(file).name):
+        if fetch_alignment(key, out_file):
+            add_count("cached", 1)
+            return out_file
 
-    with open(out_file, 'w') as stout, \
-         open(err_file, 'a+') as sterr:
-        subprocess.run(cmd_mafft, stdout=stout, stderr=sterr)
+        with open(out_file, 'w') as stout, \
+             open(err_file, 'a+') as sterr:
+            result = subprocess.run(cmd_mafft, stdout=stout, stderr=sterr)
+
+        if result.returncode == 0:
+            store_alignment(key, out_file)
 
     return out_file
 
@@ -306,30 +806,13 @@ def split_alignment(align_file):
     align_head = f"{align_file}.head"
     align_tail = f"{align_file}.tail"
 
-    with open(align_file, 'r') as f, \
-         open(align_head, 'w') as f_head, \
-         open(align_tail, 'w') as f_tail:
-        seq = ""
-        acc_id = ""
-        seq_len = 0
-
-        for line in f:
-            curr_line = line.rstrip()
+    with FastaWriter(align_head, width=60) as f_head, \
+         FastaWriter(align_tail, width=60) as f_tail:
 
-            if curr_line[0] == ">":
-                if seq:
-                    head_seq, tail_seq = split_seq(seq)
-                    f_head.write(f"{acc_id}\n{head_seq}\n")
-                    f_tail.write(f"{acc_id}\n{tail_seq}\n")
-
-                acc_id = curr_line
-                seq = ""
-            else:
-                seq += curr_line
-
-        head_seq, tail_seq = split_seq(seq)
-        f_head.write(f"{acc_id}\n{head_seq}\n")
-        f_tail.write(f"{acc_id}\n{tail_seq}\n")
+        for acc_id, seq in fasta_records(align_file):
+            head_seq, tail_seq = split_seq(seq)
+            f_head.write(acc_id, head_seq)
+            f_tail.write(acc_id, tail_seq)
 
     return align_head, align_tail
 
@@ -362,217 +845,225 @@ def make_conserved_seq_files(seq_db, id, align_dir):
     origins = []
     id_dict = {}
     out_dict = {}
-    with open(seq_db, 'r') as f:
-        curr_seq = ""
-        acc_id = ""
-        for cluster_line in f:
-            if cluster_line[0] == ">":
-                if curr_seq:
-                    o_l = f"{acc_id}\n{curr_seq}\n"
-                    id_dict[origin].append(o_l)
-                acc_id = cluster_line.split(" ")[0]
-                curr_seq = ""
-                taxes = cluster_line.split(" ")[1].split(";")
-                if "Mitochondria" in taxes:
-                    tmp_origin = "Mitochondria"
-                elif "Chloroplast" in taxes:
-                    tmp_origin = "Chloroplast"
-                else:
-                    tmp_origin = taxes[0]
-                origin = format_origin(tmp_origin)
-
-                if origin not in id_dict:
-                    id_dict[origin] = []
-
-                if origin not in origins:
-                    origins.append(origin)
+    curr_seq = ""
+    for header, curr_seq in fasta_records(seq_db):
+        acc_id = header.split(" ")[0]
+        taxes = header.split(" ")[1].split(";")
+        if "Mitochondria" in taxes:
+            tmp_origin = "Mitochondria"
+        elif "Chloroplast" in taxes:
+            tmp_origin = "Chloroplast"
+        else:
+            tmp_origin = taxes[0]
+        origin = format_origin(tmp_origin)
 
-            else:
-                curr_seq += cluster_line.rstrip()
+        if origin not in id_dict:
+            id_dict[origin] = []
 
-        o_l = f"{acc_id}\n{curr_seq}\n"
-        id_dict[origin].append(o_l)
+        if origin not in origins:
+            origins.append(origin)
 
-    for orig in origins:
-        out_cluster_file = f"{align_dir}cluster_{id}_{orig}"
-        with open(out_cluster_file, 'w') as h_f:
-            if len(id_dict[orig]) > 1:
-                for item in id_dict[orig]:
-                    h_f.write(item)
-            else:
-                acc_id = id_dict[orig][0].split("\n")[0]
-                tax = id_dict[orig][0].split("\n")[1]
-                dupl_entry = f"{acc_id}_dupl\n{curr_seq}\n"
-                h_f.write(id_dict[orig][0])
-                h_f.write(dupl_entry)
+        id_dict[origin].append((acc_id, curr_seq))
 
+    write_origin_files(id_dict, origins, id, align_dir, curr_seq)
     out_dict[id] = origins
 
     return out_dict
 
 
-def make_cluster_seq_files(seq_id, tree_file, cluster_dir, align_dir):
+def write_origin_files(
+    id_dict,
+    origins,
+    id,
+    align_dir,
+    last_seq,
+    strata=None
+):
+    """Writes the sequence file of every origin in a cluster, an origin with
+    a single entry gets a duplicate entry of last_seq (MAFFT single sequence
+    alignment protection). The strata of every origin are written next to
+    the file if given, see write_strata.
+    """
+    for orig in origins:
+        out_cluster_file = f"{align_dir}cluster_{id}_{orig}"
+        with FastaWriter(out_cluster_file) as h_f:
+            for acc_id, seq in id_dict[orig]:
+                h_f.write(acc_id, seq)
+            if len(id_dict[orig]) == 1:
+                acc_id = id_dict[orig][0][0]
+                h_f.write(f"{acc_id}_dupl", last_seq)
+                if strata:
+                    strata[orig][-1] += 1
+        if strata:
+            write_strata(out_cluster_file, strata[orig])
+
+
+def make_cluster_seq_files(
+    seq_id,
+    tree_file,
+    cluster_path,
+    align_dir,
+    stratified=False
+):
     """Creates the cluster files, containing all sequences from all 100
     sequence identity clusters, returning dict of all ids with their respective
-    origin
+    origin. If stratified the number of entries of every 100 cluster is
+    written next to the files, for stratified capping of the alignments.
     """
     #: makes dict with 100 cluster files belonging to each seq_id cluster
     #: dict with each id being one 50 id, containing all 100 ids
-    id_clusters = {}
-    curr_cluster = ""
-    seq_id_pos = -1
-    if seq_id != "50":
-        if int(seq_id) >= 90:
-            seq_id_pos = -9 - (int(seq_id)-90)
-        elif int(seq_id) > 50:
-            seq_id_pos = -1 - round((int(seq_id)-50)/5)
-
-    with open(tree_file, 'r') as r:
-        for line in r:
-            curr_line = line.rstrip().split("\t")
-            curr_cluster = curr_line[1].split(" ")[seq_id_pos].split("_")[-1]
-            curr_100_cluster = curr_line[0].split("_")[-1]
-
-            if curr_cluster in id_clusters:
-                id_clusters[curr_cluster] += f" cluster_{curr_100_cluster}"
-            else:
-                id_clusters[curr_cluster] = f" cluster_{curr_100_cluster}"
+    with load_label_tree(tree_file) as tree:
+        id_clusters = {
+            str(cluster): members
+            for cluster, members in tree.groups(seq_id).items()
+        }
 
     #: makes the sequence file from a cluster
     #: uses id_cluster to loop, writing one file per 50 cluster
     #: containing all 100 seqs
+    store = ClusterStore(cluster_path)
     out_dict = {}
+
+    #: clusters added by add_entries are only found in the database
+    added = {
+        cluster_100_id
+        for members in id_clusters.values()
+        for cluster_100_id in members
+        if cluster_100_id not in store
+    }
+    added_records = {}
+    if added:
+        added_records = read_added_records(tree_file, added)
+
     for id in id_clusters:
         singleton = False
         tmp_origin = ""
         origins = []
         id_dict = {}
-        if len(id_clusters[id].split(" ")[1:]) == 1:
+        strata = {}
+        if len(id_clusters[id]) == 1:
             singleton = True
-        for cluster_100_id in id_clusters[id].split(" ")[1:]:
-            cluster_file = f"{cluster_dir}{cluster_100_id}"
-            with open(cluster_file, 'r') as c_f:
-                curr_seq = ""
-                acc_id = ""
-                for cluster_line in c_f:
-                    if cluster_line[0] == ">":
-                        if curr_seq:
-                            o_l = f"{acc_id}\n{curr_seq}\n"
-                            id_dict[origin].append(o_l)
-                        acc_id = cluster_line.split(" ")[0]
-                        curr_seq = ""
-                        taxes = cluster_line.split(" ")[1].split(";")
-                        if "Mitochondria" in taxes:
-                            tmp_origin = "Mitochondria"
-                        elif "Chloroplast" in taxes:
-                            tmp_origin = "Chloroplast"
-                        else:
-                            tmp_origin = taxes[0]
-                        origin = format_origin(tmp_origin)
+        for cluster_100_id in id_clusters[id]:
+            curr_seq = ""
+            acc_id = ""
+            starts = {orig: len(id_dict[orig]) for orig in id_dict}
+            if cluster_100_id in added_records:
+                records = added_records[cluster_100_id]
+            else:
+                records = store.records(cluster_100_id)
+            for header, curr_seq in records:
+                acc_id = header.split(" ")[0]
+                taxes = header.split(" ")[1].split(";")
+                if "Mitochondria" in taxes:
+                    tmp_origin = "Mitochondria"
+                elif "Chloroplast" in taxes:
+                    tmp_origin = "Chloroplast"
+                else:
+                    tmp_origin = taxes[0]
+                origin = format_origin(tmp_origin)
 
-                        if origin not in id_dict:
-                            id_dict[origin] = []
+                if origin not in id_dict:
+                    id_dict[origin] = []
 
-                        if origin not in origins:
-                            origins.append(origin)
+                if origin not in origins:
+                    origins.append(origin)
 
-                    else:
-                        curr_seq += cluster_line.rstrip()
+                id_dict[origin].append((acc_id, curr_seq))
+
+            #: MAFFT single sequence alignment protection
+            #: duplicates sequences in clusters with only 1 sequence
+            if singleton:
+                id_dict[origin].append((f"{acc_id}_dupl", curr_seq))
+
+            #: entries of the 100 cluster in every origin
+            for orig in id_dict:
+                size = len(id_dict[orig]) - starts.get(orig, 0)
+                if size:
+                    if orig not in strata:
+                        strata[orig] = []
+                    strata[orig].append(size)
+
+        write_origin_files(
+            id_dict,
+            origins,
+            id,
+            align_dir,
+            curr_seq,
+            strata if stratified else None
+        )
+        out_dict[id] = origins
 
-                o_l = f"{acc_id}\n{curr_seq}\n"
-                id_dict[origin].append(o_l)
+    store.close()
 
-                #: MAFFT single sequence alignment protection
-                #: duplicates sequences in clusters with only 1 sequence
-                if singleton:
-                    o_l = f"{acc_id}_dupl\n{curr_seq}\n"
-                    id_dict[origin].append(o_l)
-
-        for orig in origins:
-            out_cluster_file = f"{align_dir}cluster_{id}_{orig}"
-            with open(out_cluster_file, 'w') as h_f:
-                if len(id_dict[orig]) > 1:
-                    for item in id_dict[orig]:
-                        h_f.write(item)
-                else:
-                    acc_id = id_dict[orig][0].split("\n")[0]
-                    tax = id_dict[orig][0].split("\n")[1]
-                    dupl_entry = f"{acc_id}_dupl\n{curr_seq}\n"
-                    h_f.write(id_dict[orig][0])
-                    h_f.write(dupl_entry)
+    return out_dict
 
-        out_dict[id] = origins
 
-    return out_dict
+def read_added_records(tree_file, clusters):
+    """Returns a dictionary of the records (header, sequence) of 100
+    clusters that are in the database (mqr.fasta) but not in the cluster
+    store, entries added by add_entries. Headers are written as in the
+    cluster store, id and taxonomy.
+    """
+    db_file = resolve_db_file(f"{Path(tree_file).parent}/mqr.fasta")
+    added_records = {}
+    for header, seq in fasta_records(db_file):
+        acc_id, label, tax = header.split("\t")
+        cluster_100_id = int(label.split("_")[-1])
+        if cluster_100_id in clusters:
+            if cluster_100_id not in added_records:
+                added_records[cluster_100_id] = []
+            added_records[cluster_100_id].append((f"{acc_id} {tax}", seq))
+
+    return added_records
 
 
-def make_cluster_seq_file(seq_id, tree_file, cluster_dir, align_dir):
+def make_cluster_seq_file(seq_id, tree_file, cluster_path, align_dir):
     """Creates the cluster file, containing all sequences from all 100 sequence
     identity clusters, returning dict of all ids with their respective origin
     """
     #: makes dict with 100 cluster files belonging to each seq_id cluster
     #: dict with each id being one 50 id, containing all 100 ids
-    id_clusters = {}
-    curr_cluster = ""
-    seq_id_pos = -1
-    if seq_id != "50":
-        if int(seq_id) >= 90:
-            seq_id_pos = -9 - (int(seq_id)-90)
-        elif int(seq_id) > 50:
-            seq_id_pos = -1 - round((int(seq_id)-50)/5)
-
-    with open(tree_file, 'r') as r:
-        for line in r:
-            curr_line = line.rstrip().split("\t")
-            curr_cluster = curr_line[1].split(" ")[seq_id_pos].split("_")[-1]
-            curr_100_cluster = curr_line[0].split("_")[-1]
-
-            if curr_cluster in id_clusters:
-                id_clusters[curr_cluster] += f" cluster_{curr_100_cluster}"
-            else:
-                id_clusters[curr_cluster] = f" cluster_{curr_100_cluster}"
+    with load_label_tree(tree_file) as tree:
+        id_clusters = {
+            str(cluster): members
+            for cluster, members in tree.groups(seq_id).items()
+        }
 
     #: makes the sequence file from a cluster
     #: uses id_cluster to loop, writing one file per 50 cluster
     #: containing all 100 seqs
+    store = ClusterStore(cluster_path)
     out_dict = {}
     for id in id_clusters:
         singleton = False
         out_cluster_file = f"{align_dir}cluster_{id}"
         origin = ""
-        with open(out_cluster_file, 'w') as h_f:
-            if len(id_clusters[id].split(" ")[1:]) == 1:
+        with FastaWriter(out_cluster_file) as h_f:
+            if len(id_clusters[id]) == 1:
                 singleton = True
-            for cluster_100_id in id_clusters[id].split(" ")[1:]:
-                cluster_file = f"{cluster_dir}{cluster_100_id}"
-                with open(cluster_file, 'r') as c_f:
-                    curr_seq = ""
-                    acc_id = ""
-                    for cluster_line in c_f:
-                        if cluster_line[0] == ">":
-                            if curr_seq:
-                                h_f.write(f"{acc_id}\n{curr_seq}\n")
-                            acc_id = cluster_line.split(" ")[0]
-                            curr_seq = ""
-                            if not origin:
-                                taxes = cluster_line.split(" ")[1].split(";")
-                                if "Mitochondria" in taxes:
-                                    origin = "Mitochondria"
-                                elif "Chloroplast" in taxes:
-                                    origin = "Chloroplast"
-                                else:
-                                    origin = taxes[0]
-
+            for cluster_100_id in id_clusters[id]:
+                curr_seq = ""
+                acc_id = ""
+                for header, curr_seq in store.records(cluster_100_id):
+                    acc_id = header.split(" ")[0]
+                    h_f.write(acc_id, curr_seq)
+                    if not origin:
+                        taxes = header.split(" ")[1].split(";")
+                        if "Mitochondria" in taxes:
+                            origin = "Mitochondria"
+                        elif "Chloroplast" in taxes:
+                            origin = "Chloroplast"
                         else:
-                            curr_seq += cluster_line.rstrip()
-                    h_f.write(f"{acc_id}\n{curr_seq}\n")
+                            origin = taxes[0]
 
-                    #: MAFFT single sequence alignment protection
-                    #: duplicates sequences in clusters with only 1 sequence
-                    if singleton:
-                        h_f.write(f"{acc_id}_dupl\n{curr_seq}\n")
+                #: MAFFT single sequence alignment protection
+                #: duplicates sequences in clusters with only 1 sequence
+                if singleton:
+                    h_f.write(f"{acc_id}_dupl", curr_seq)
         out_dict[id] = origin
 
+    store.close()
+
     return out_dict
 
 
@@ -590,18 +1081,8 @@ def split_seq(sequence):
     """Cuts a sequence in half, producing head and tail sequences
     """
     cut_seq = round(len(sequence)/2)
-    head_seq = ""
-    tail_seq = ""
-
-    #: making the head sequence
-    tmp_seq = sequence[:cut_seq]
-    head_seq = "\n".join([tmp_seq[i:i+60] for i in range(
-        0, len(tmp_seq), 60)])
-
-    #: making the tail sequence
-    tmp_seq = sequence[cut_seq:]
-    tail_seq = "\n".join([tmp_seq[i:i+60] for i in range(
-        0, len(tmp_seq), 60)])
+    head_seq = sequence[:cut_seq]
+    tail_seq = sequence[cut_seq:]
 
     return head_seq, tail_seq
 
@@ -613,37 +1094,15 @@ def trim_alignment(file):
     file_out = f"{file}.trimmed"
     start = 0
     end = 0
-    align_dict = {}
     first = True
-    first_seq = ""
-
-    with open(file, 'r') as f, \
-         open(file_out, 'w') as f_out:
-        seq = ""
-        acc_id = ""
-        for line in f:
-            curr_line = line.rstrip()
-            if curr_line[0] == ">":
-                if seq:
-                    if first:
-                        start, end = get_start_end_indices(seq)
-                        first = False
 
-                    tmp_seq = seq[start:end+1]
-                    trim_seq = "\n".join([tmp_seq[i:i+60] for i in range(
-                        0, len(tmp_seq), 60)])
-                    f_out.write(f"{acc_id}\n{trim_seq}\n")
+    with FastaWriter(file_out, width=60) as f_out:
+        for acc_id, seq in fasta_records(file):
+            if first:
+                start, end = get_start_end_indices(seq)
+                first = False
 
-                acc_id = curr_line
-                seq = ""
-
-            else:
-                seq += curr_line
-
-        tmp_seq = seq[start:end+1]
-        trim_seq = "\n".join([tmp_seq[i:i+60] for i in range(
-            0, len(tmp_seq), 60)])
-        f_out.write(f"{acc_id}\n{trim_seq}\n")
+            f_out.write(acc_id, seq[start:end+1])
 
     return file_out
 
@@ -674,42 +1133,37 @@ def get_conserved_regions(
     conservation_cutoff=0.6,
     look_ahead=4,
     min_length=20,
-    max_gaps=5
+    max_gaps=5,
+    drop_gaps=False
 ):
     """Takes a multiple sequence alignment and produces files containing all
-    conserved regions found
+    conserved regions found, without the columns of a region that are gaps
+    in all entries if drop_gaps
     """
+    #: numpy is only needed for the hybrid and conserved modes
+    import numpy as np
+
     #: makes the dictionary containing all entries from the cluster
     cluster_dict = {}
-    with open(file, 'r') as f:
-        acc_id = ""
-        sequence = ""
-        for line in f:
-            curr_line = line.rstrip()
-            if curr_line[0] == ">":
-                if sequence:
-                    cluster_dict[acc_id] = sequence
-                acc_id = curr_line
-                sequence = ""
-            else:
-                sequence += curr_line.lower()
-        cluster_dict[acc_id] = sequence
+    for acc_id, sequence in fasta_records(file, text=False):
+        cluster_dict[acc_id] = sequence.lower()
+
+    #: loads the alignment as a matrix, one row per entry
+    acc_ids = list(cluster_dict)
+    total_ids = len(acc_ids)
+    sequence_length = len(cluster_dict[acc_ids[0]])
+    align_matrix = np.frombuffer(
+        b"".join(cluster_dict.values()),
+        dtype=np.uint8
+    ).reshape(total_ids, sequence_length)
 
     #: makes the most conserved sequence
-    conservation_sequence = ""
-    sequence_length = len(cluster_dict[list(cluster_dict)[0]])
-    total_ids = len(list(cluster_dict))
-    for i in range(sequence_length):
-        curr_pos_content = []
-        for id in cluster_dict:
-            curr_pos_content.append(cluster_dict[id][i])
-        c = Counter(curr_pos_content)
-        common_base = c.most_common(1)[0][0]
-        cons_base = c.most_common(1)[0][1]
-        if cons_base/total_ids >= conservation_cutoff:
-            conservation_sequence += common_base
-        else:
-            conservation_sequence += "x"
+    common_bases, cons_bases = column_conservation(align_matrix)
+    conservation_sequence = np.where(
+        cons_bases/total_ids >= conservation_cutoff,
+        common_bases,
+        ord("x")
+    ).astype(np.uint8).tobytes().decode()
 
     #: gets conserved regions from the conservation sequence
     conserved_regions = calc_conserved_regions(
@@ -751,16 +1205,58 @@ def get_conserved_regions(
         cr_files[id] = cr_file
         start, end = conserved_regions[i]
 
-        with open(cr_file, 'w') as cr_out:
-            for acc_id in cluster_dict:
-                tmp_seq = cluster_dict[acc_id][start:end+1]
-                seq = "\n".join([tmp_seq[i:i+60] for i in range(
-                    0, len(tmp_seq), 60)])
-                cr_out.write(f"{acc_id}\n{seq}\n")
+        #: slices the region from the matrix, adding the line breaks
+        region = align_matrix[:, start:end+1]
+        if drop_gaps:
+            region = region[:, (region != ord("-")).any(axis=0)]
+        region = np.insert(
+            region,
+            range(60, region.shape[1], 60),
+            ord("\n"),
+            axis=1
+        )
+        region = np.insert(region, region.shape[1], ord("\n"), axis=1)
+
+        with open(cr_file, 'wb') as cr_out:
+            for row, acc_id in enumerate(acc_ids):
+                cr_out.write(b">" + acc_id + b"\n")
+                cr_out.write(region[row].tobytes())
 
     return cr_files
 
 
+def column_conservation(align_matrix, block_size=1 << 24):
+    """Returns the most common symbol of every column in the alignment matrix
+    and its count. Ties go to the symbol found first in the column, as with
+    Counter. Columns are processed in blocks to limit memory use.
+    """
+    import numpy as np
+
+    rows, columns = align_matrix.shape
+    symbols = np.unique(align_matrix)
+    common_bases = np.zeros(columns, dtype=np.uint8)
+    cons_bases = np.zeros(columns, dtype=np.int64)
+    block_columns = max(1, block_size // max(1, rows))
+
+    for block_start in range(0, columns, block_columns):
+        block = align_matrix[:, block_start:block_start+block_columns]
+        counts = np.empty((len(symbols), block.shape[1]), dtype=np.int64)
+        firsts = np.empty((len(symbols), block.shape[1]), dtype=np.int64)
+        for i, symbol in enumerate(symbols):
+            hits = block == symbol
+            counts[i] = hits.sum(axis=0)
+            firsts[i] = np.where(counts[i] > 0, hits.argmax(axis=0), rows)
+
+        #: highest count first, then first occurrence in the column
+        best = (counts * (rows + 1) + (rows - firsts)).argmax(axis=0)
+        block_range = np.arange(block.shape[1])
+        block_end = block_start + block.shape[1]
+        common_bases[block_start:block_end] = symbols[best]
+        cons_bases[block_start:block_end] = counts[best, block_range]
+
+    return common_bases, cons_bases
+
+
 def calc_conserved_regions(sequence,
                            look_ahead,
                            min_length,
@@ -770,85 +1266,133 @@ def calc_conserved_regions(sequence,
     scored and the top scoring regions that do not overlap are returned
     """
     conserved_regions = []
-    hits = {}
+    hits = find_conserved_hits(sequence, look_ahead, min_length, max_gaps)
 
-    #: makes segments from each position to the end to test for regions
-    for i in range(len(sequence)-min_length+1):
-        curr_seq = sequence[i:]
-        start = i
-        end = 0
-        curr_len = 0
-        local_gaps = 0
-        curr_gap = 0
-        score_cutoff = 10
-        score = 0
-        last_gap = 0
-        #: only starts if start on conserved position
-        if curr_seq[0] != "x":
-            #: checking every position in segment
-            for j in range(len(curr_seq)):
-                nt = curr_seq[j]
-                if nt == "x":
-                    curr_gap += 1
-                    score -= curr_gap * local_gaps
-                else:
-                    score += 1
-                    if curr_gap > 0:
-                        local_gaps += 1
-                        last_gap = curr_gap
-                        curr_gap = 0
-                curr_len += 1
-
-                #: breaks if more unconserved pos than look_ahead
-                if curr_gap > look_ahead:
-                    end = start + j - (look_ahead + 1)
-                    break
+    #: get top scoring, non-intersecting, conserved regions
+    conserved_regions = remove_overlaps(hits)
 
-                #: breaks if more gaps than max_gaps
-                if local_gaps > max_gaps:
-                    end = start + j - (last_gap + 1)
-                    break
+    return conserved_regions
 
-            if end == 0:
-                end = start + (len(curr_seq)-1)
 
-            if curr_len >= min_length and score >= score_cutoff:
-                hits[(start, end)] = score
+def find_conserved_hits(sequence, look_ahead, min_length, max_gaps):
+    """Finds all candidate conserved regions, a region is started from every
+    conserved position and extended until more than look_ahead unconserved
+    positions are found in a row or more than max_gaps gaps are closed. Gaps
+    are penalised by their length times the number of gaps before them. All
+    starts in the same block of conserved positions end at the same position,
+    so the extension is only made once per block. Returns a dictionary of
+    (start, end) and score, ordered by start.
+    """
+    hits = {}
+    score_cutoff = 10
+    seq_len = len(sequence)
+    last_start = seq_len - min_length
+
+    #: blocks of conserved positions, as [start, end]
+    blocks = []
+    pos = 0
+    while pos < seq_len:
+        if sequence[pos] == "x":
+            pos += 1
+            continue
+        block_start = pos
+        while pos < seq_len and sequence[pos] != "x":
+            pos += 1
+        blocks.append([block_start, pos - 1])
+
+    for b in range(len(blocks)):
+        block_start, block_end = blocks[b]
+        if block_start > last_start:
+            break
 
-    #: get top scoring, non-intersecting, conserved regions
-    conserved_regions = remove_overlaps(hits)
+        #: extends from the end of the block, the score and length added
+        #: after the block are the same for every start in the block
+        score = 0
+        curr_len = 0
+        local_gaps = 0
+        end = seq_len - 1
+        curr_end = block_end
+        #: the index len(blocks) is the end of the sequence
+        for n in range(b + 1, len(blocks) + 1):
+            if n == len(blocks):
+                next_start, next_end = seq_len, seq_len
+            else:
+                next_start, next_end = blocks[n]
+            gap = next_start - curr_end - 1
+
+            #: breaks if more unconserved pos than look_ahead
+            if gap > look_ahead:
+                gap = look_ahead + 1
+                score -= local_gaps * gap * (gap + 1) // 2
+                curr_len += gap
+                end = curr_end
+                break
+
+            score -= local_gaps * gap * (gap + 1) // 2
+            curr_len += gap
+            if next_start == seq_len:
+                break
+
+            score += 1
+            curr_len += 1
+            local_gaps += 1
+
+            #: breaks if more gaps than max_gaps
+            if local_gaps > max_gaps:
+                end = curr_end
+                break
+
+            block_len = next_end - next_start
+            score += block_len
+            curr_len += block_len
+            curr_end = next_end
+
+        for start in range(block_start, min(block_end, last_start) + 1):
+            rest_len = block_end - start + 1
+            if (
+                rest_len + curr_len >= min_length
+                and rest_len + score >= score_cutoff
+            ):
+                if end == 0:
+                    hits[(start, seq_len - 1)] = rest_len + score
+                else:
+                    hits[(start, end)] = rest_len + score
 
-    return conserved_regions
+    return hits
 
 
 def remove_overlaps(conserved_dictionary):
     """ Takes a dictionary of tuples with start/end positions and their
-    conservation scores, sorting by score and adding the highest scoring
-    regions that do not overlap. Returning all conserved regions found not
-    overlapping maximizing total conservation score.
+    conservation scores, selecting the regions that do not overlap with the
+    highest total conservation score (weighted interval scheduling). Returns
+    the selected conserved regions sorted by position.
     """
-    conserved_regions = []
-    sorted_hits = dict(sorted(
-        conserved_dictionary.items(),
-        key=lambda item: item[1],
-        reverse=True
-        ))
+    hits = sorted(conserved_dictionary, key=lambda hit: (hit[1], hit[0]))
+    ends = [hit[1] for hit in hits]
+
+    #: best total score using the first k hits, and if hit k-1 is used
+    best = [0] * (len(hits) + 1)
+    used = [False] * (len(hits) + 1)
+    prev = [0] * (len(hits) + 1)
+    for k in range(1, len(hits) + 1):
+        start, end = hits[k-1]
+        #: number of hits ending before the start of this hit
+        prev[k] = bisect_left(ends, start, 0, k-1)
+        with_hit = conserved_dictionary[hits[k-1]] + best[prev[k]]
+        if with_hit > best[k-1]:
+            best[k] = with_hit
+            used[k] = True
+        else:
+            best[k] = best[k-1]
 
-    for hit in sorted_hits:
-        if not conserved_regions:
-            conserved_regions.append([hit[0], hit[1]])
+    conserved_regions = []
+    k = len(hits)
+    while k > 0:
+        if used[k]:
+            conserved_regions.append([hits[k-1][0], hits[k-1][1]])
+            k = prev[k]
         else:
-            found = False
-            for cr in conserved_regions:
-                if (
-                    hit[0] >= cr[0] and hit[0] <= cr[1]
-                    or hit[1] >= cr[0] and hit[1] <= cr[1]
-                ):
-                    found = True
-                    break
-
-            if not found:
-                conserved_regions.append([hit[0], hit[1]])
+            k -= 1
 
     return sorted(conserved_regions)
 
@@ -892,45 +1436,111 @@ def create_hmm_names(runs_dict, hmm_dir, mode):
                     f.write(f"{end}\t{end}\tend\n")
 
 
-def cap_alignment(file, max_cap):
-    """Takes input file pre-alignment, creates a capped file containing entries
-    from the original file. Total number of entries matching max_cap, chosen
-    randomly.
+def cap_rng(file, seed=None):
+    """Returns the random generator used to cap a file. With a seed every
+    file gets its own generator, seeded by the seed and the file name, so a
+    capped alignment is the same whatever order the jobs are run in.
     """
-    orig_dict = {}
-    capped_dict = {}
-    capped_file = f"{file}.capped"
+    if seed is None:
+        return random.Random()
 
-    #: reads the original file into a dictionary
-    with open(file, 'r') as f:
-        for line in f:
-            if line[0] == ">":
-                id = line.rstrip()
-            else:
-                seq = line.rstrip()
-                orig_dict[id] = seq
-
-    #: reads dictionary, retrieving entries randomly and storing in capped dict
-    while len(capped_dict) < max_cap:
-        new_key = random.choice(list(orig_dict))
-        if new_key not in capped_dict:
-            capped_dict[new_key] = orig_dict[new_key]
-        orig_dict.pop(new_key)
-
-    #: creates a new file using the capped dict
-    with open(capped_file, 'w') as f:
-        for id in capped_dict:
-            seq = capped_dict[id]
-            f.write(f"{id}\n{seq}\n")
+    return random.Random(f"{seed}:{Path(file).name}")
+
+
+def reservoir_sample(records, size, rng):
+    """Samples size records uniformly from a stream of records, keeping only
+    the sample in memory (reservoir sampling). Returns the sampled records in
+    the order of the stream.
+    """
+    reservoir = []
+    for i, record in enumerate(records):
+        if i < size:
+            reservoir.append((i, record))
+        else:
+            j = rng.randrange(i + 1)
+            if j < size:
+                reservoir[j] = (i, record)
+
+    return [record for i, record in sorted(reservoir, key=lambda r: r[0])]
+
+
+def stratum_quotas(sizes, max_cap, rng):
+    """Divides max_cap entries between strata of sizes, as evenly as the
+    sizes allow, small strata are taken whole and the remainder is shared by
+    the larger ones. With more strata than max_cap, max_cap random strata get
+    one entry each.
+    """
+    quotas = [0] * len(sizes)
+    if max_cap < len(sizes):
+        for i in rng.sample(range(len(sizes)), max_cap):
+            quotas[i] = 1
+        return quotas
+
+    left = max_cap
+    order = sorted(range(len(sizes)), key=lambda i: sizes[i])
+    for n, i in enumerate(order):
+        quotas[i] = min(sizes[i], left // (len(order) - n))
+        left -= quotas[i]
+
+    return quotas
+
+
+def read_strata(file):
+    """Returns the strata of a pre-alignment file, the number of entries of
+    every 100% cluster in the order of the file, empty if not written.
+    """
+    strata_file = f"{file}.strata"
+    if not check_file(strata_file):
+        return []
+
+    with open(strata_file, 'r') as f:
+        return [int(line) for line in f if line.strip()]
+
+
+def write_strata(file, strata):
+    """Writes the strata of a pre-alignment file, see read_strata.
+    """
+    with open(f"{file}.strata", 'w') as f:
+        f.write("".join([f"{size}\n" for size in strata]))
+
+
+def cap_alignment(file, max_cap, seed=None, stratified=False):
+    """Takes input file pre-alignment, creates a capped file containing
+    max_cap entries from the original file, chosen randomly while the file is
+    streamed. If stratified the entries are spread over the 100% clusters of
+    the file (see stratum_quotas), so the capped file keeps the diversity of
+    the cluster, files without strata are sampled as a whole.
+    """
+    capped_file = f"{file}.capped"
+    rng = cap_rng(file, seed)
+    strata = []
+    if stratified:
+        strata = read_strata(file)
+
+    records = fasta_records(file)
+    with FastaWriter(capped_file) as f:
+        if strata:
+            quotas = stratum_quotas(strata, max_cap, rng)
+            for size, quota in zip(strata, quotas):
+                stratum = islice(records, size)
+                if quota:
+                    for id, seq in reservoir_sample(stratum, quota, rng):
+                        f.write(id, seq)
+                else:
+                    for _ in stratum:
+                        pass
+        else:
+            for id, seq in reservoir_sample(records, max_cap, rng):
+                f.write(id, seq)
 
     return capped_file
 
 
-def process_alignment_cap(file, max_cap):
-    """Processes pre-alignment files, returning list of capped failes, if a
-    file contains less entries than the max_cap it is not processed
+def process_alignment_cap(file, max_cap, seed=None, stratified=False):
+    """Processes pre-alignment files, returning the capped file, if a file
+    contains less entries than the max_cap it is not processed
     """
     if count_entries(file) > max_cap:
-        return cap_alignment(file, max_cap)
+        return cap_alignment(file, max_cap, seed, stratified)
     else:
         return file
@@ -0,0 +1,206 @@
+"""Run manifest used by the make step, recording the size and modification
+time of the inputs and outputs of every stage in the identity ladder. Allows
+an interrupted make run to be resumed, skipping all stages whose outputs are
+already up to date. The files are not read, so recording a stage costs the
+same whether or not the run is resumed later.
+"""
+
+import hashlib
+import json
+import os
+from .handling import return_proj_path, check_file
+from .telemetry import span
+
+
+def return_manifest_path(run_label):
+    """Returns the path to the run manifest file.
+    """
+    return f"{return_proj_path(run_label)}manifest.json"
+
+
+def hash_file(file):
+    """Returns the sha1 hash of a file. Missing files return an empty string.
+    """
+    sha = hashlib.sha1()
+
+    if not check_file(file):
+        return ""
+
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+def file_stamp(file):
+    """Returns the size and modification time of a file. Missing files return
+    an empty string.
+    """
+    try:
+        stat = os.stat(file)
+    except FileNotFoundError:
+        return ""
+
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def stamp_files(files):
+    """Returns a dictionary of file path and stamp for all files.
+    """
+    return {file: file_stamp(file) for file in files}
+
+
+def read_manifest(run_label):
+    """Reads the run manifest into a dictionary, keyed by identity and stage.
+    """
+    manifest_file = return_manifest_path(run_label)
+    manifest = {}
+
+    if check_file(manifest_file):
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+
+    return manifest
+
+
+def write_manifest(run_label, manifest):
+    """Writes the run manifest, replacing the old file only once the new one
+    has been fully written.
+    """
+    manifest_file = return_manifest_path(run_label)
+    tmp_file = f"{manifest_file}.tmp"
+
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+
+def stage_done(manifest, str_id, stage, inputs, outputs, params):
+    """Checks if a stage has been recorded in the manifest with the same
+    inputs, parameters and outputs as currently found on disk.
+    """
+    record = manifest.get(str_id, {}).get(stage)
+    if not record:
+        return False
+
+    if record["params"] != params:
+        return False
+
+    if record["inputs"] != stamp_files(inputs):
+        return False
+
+    curr_outputs = stamp_files(outputs)
+    if "" in curr_outputs.values():
+        return False
+
+    return record["outputs"] == curr_outputs
+
+
+def run_stage(
+              run_label,
+              str_id,
+              stage,
+              inputs,
+              outputs,
+              func,
+              *args,
+              params=None,
+              resume=False,
+              **kwargs
+              ):
+    """Runs a stage of the identity ladder and records it in the manifest.
+    If resuming, a stage whose inputs and outputs match the manifest is
+    skipped. Stamps are taken once the stage has finished. Files appended to
+    by several stages (removed clusters) are not given as inputs, as their
+    stamps change after the stage is recorded. Returns True if the stage was
+    run, False if skipped. The stage is run as a telemetry span.
+    """
+    if params is None:
+        params = {}
+    manifest = read_manifest(run_label)
+
+    if resume and stage_done(manifest, str_id, stage, inputs, outputs, params):
+        return False
+
+    with span(stage, id=str_id, label=run_label):
+        func(*args, **kwargs)
+
+    record_stage(run_label, str_id, stage, inputs, outputs, params)
+
+    return True
+
+
+def record_stage(run_label, str_id, stage, inputs, outputs, params):
+    """Records a finished stage in the manifest, with the stamps of its
+    inputs and outputs.
+    """
+    manifest = read_manifest(run_label)
+    if str_id not in manifest:
+        manifest[str_id] = {}
+    manifest[str_id][stage] = {
+        "params": params,
+        "inputs": stamp_files(inputs),
+        "outputs": stamp_files(outputs)
+    }
+    write_manifest(run_label, manifest)
+
+
+def run_stage_span(stage, str_id, run_label, func, args, kwargs):
+    """Runs the function of a stage as a telemetry span, used by
+    submit_stage in a worker process.
+    """
+    with span(stage, id=str_id, label=run_label):
+        func(*args, **kwargs)
+
+
+def submit_stage(
+                 executor,
+                 run_label,
+                 str_id,
+                 stage,
+                 inputs,
+                 outputs,
+                 func,
+                 *args,
+                 params=None,
+                 resume=False,
+                 **kwargs
+                 ):
+    """Starts a stage in the background, in a worker process of executor,
+    see run_stage. Returns the pending stage to be given to finish_stage,
+    None if the stage is skipped. The manifest is only written by the main
+    process, once the stage is finished.
+    """
+    if params is None:
+        params = {}
+    manifest = read_manifest(run_label)
+
+    if resume and stage_done(manifest, str_id, stage, inputs, outputs, params):
+        return None
+
+    future = executor.submit(
+        run_stage_span,
+        stage,
+        str_id,
+        run_label,
+        func,
+        args,
+        kwargs
+    )
+
+    return future, (run_label, str_id, stage, inputs, outputs, params)
+
+
+def finish_stage(pending):
+    """Waits for a stage started by submit_stage and records it in the
+    manifest. Returns True if the stage was run, False if skipped.
+    """
+    if pending is None:
+        return False
+
+    future, stage_args = pending
+    future.result()
+    record_stage(*stage_args)
+
+    return True
@@ -10,14 +10,48 @@ from .cluster_tax import flag_correction
 from .cluster_loop import cluster_loop
 from .clustering import cluster_vs
 from .handling import logging, print_license, return_proj_path
-from .handling import cleanup, format_file, sep_tax, get_v_loop, check_file
+from .handling import cleanup, get_v_loop, check_file
 from .handling import print_updates, check_installation, error_check
 from .handling import check_fasta_file, check_qc
 from .handling import return_removed_path, return_init_path
+from .compression import resolve_db_file
 from .make_db import make_db
 from .add_entries import add_entries
 from .make_hmms import make_hmms
 from .cross_validation import cross_validation
+from .benchmark import run_benchmark
+from .manifest import run_stage
+from .telemetry import span, enable_telemetry
+from .incremental import set_previous_label, get_previous_label
+from .incremental import return_reuse_file
+
+
+def run_flag_correction(str_id, run_label, exclude_all, resume):
+    """Runs the manual review as a stage of the run manifest, a resumed run
+    reuses the earlier review instead of prompting for it again.
+    """
+    run_path = return_proj_path(run_label) + str_id
+    inputs = [
+        f"{run_path}/flag_clusters",
+        f"{run_path}/repr_clusters",
+        f"{run_path}/cluster_keys"
+    ]
+    previous_label = get_previous_label(run_label)
+    if previous_label is not None:
+        inputs.append(return_reuse_file(previous_label, "review"))
+    run_stage(
+              run_label,
+              str_id,
+              "flag_correction",
+              inputs,
+              [f"{run_path}/flag_correction", f"{run_path}/repr_correction"],
+              flag_correction,
+              str_id,
+              run_label,
+              exclude_all,
+              params={"exclude_all": exclude_all},
+              resume=resume
+              )
 
 
 def main_mqrdb(args):
@@ -26,6 +60,10 @@ def main_mqrdb(args):
     quiet = args.opt_quiet
     cpu = args.opt_cpu
 
+    #: stages are written as spans to the telemetry file
+    if args.opt_telemetry:
+        enable_telemetry(args.opt_telemetry)
+
     #: preparing database, initial 100% clustering run and prep of files
     if args.opt_prepare:
         error_check(args)
@@ -53,12 +91,8 @@ def main_mqrdb(args):
         with open(label_file, 'w') as f:
             f.write(run_label)
 
-        if args.opt_taxfile:
-            db = sep_tax(db, args.opt_taxfile)
-
-        #: formatting if another format is used in the database
-        if args.opt_format:
-            db = format_file(db, args.opt_format)
+        #: incremental build, reusing unchanged clusters of a previous build
+        set_previous_label(run_label, args.opt_previous)
 
         #: gets quality checking options
         if args.opt_qc:
@@ -73,19 +107,33 @@ def main_mqrdb(args):
             gene_marker = str(args.opt_gene_marker).lower()
 
         logging("clustering_start", quiet=quiet)
-        cluster_vs(db, float_id, run_label, cpu)
+        with span("cluster_vs", id=str_id, label=run_label):
+            #: compressed databases, other formats and separate taxonomy
+            #: files are converted while clustering
+            cluster_vs(
+                       db,
+                       float_id,
+                       run_label,
+                       cpu,
+                       format=args.opt_format or "",
+                       tax_file=args.opt_taxfile or ""
+                       )
         logging("clustering_seq_end", quiet=quiet)
 
         logging("clustering_tax_start", quiet=quiet)
-        create_taxdb(run_label)
-        create_cluster_tax(
-                           str_id,
-                           run_label,
-                           qc_taxonomy_quality,
-                           qc_sequence_quality,
-                           gene_marker=gene_marker
-                           )
-        repr_and_flag(str_id, run_label)
+        with span("create_taxdb", label=run_label):
+            create_taxdb(run_label)
+        with span("create_cluster_tax", id=str_id, label=run_label):
+            create_cluster_tax(
+                               str_id,
+                               run_label,
+                               qc_taxonomy_quality,
+                               qc_sequence_quality,
+                               gene_marker=gene_marker,
+                               cpu=cpu
+                               )
+        with span("repr_and_flag", id=str_id, label=run_label):
+            repr_and_flag(str_id, run_label, cpu)
         logging("clustering_tax_end", quiet=quiet)
 
         logging("clustering_end", quiet=quiet)
@@ -103,6 +151,9 @@ def main_mqrdb(args):
         path = return_proj_path(run_label)
         if args.opt_exclude_all:
             exclude_all = True
+        resume = args.opt_resume
+        if resume:
+            logging("resume", quiet=quiet)
 
         #: initializing quality check options
         qc_limited_clusters = False
@@ -131,7 +182,7 @@ def main_mqrdb(args):
 
         #: manual review of flag file and creation of corrected repr file
         logging("manual review_start", quiet=quiet)
-        flag_correction(str_id, run_label, exclude_all)
+        run_flag_correction(str_id, run_label, exclude_all, resume)
         logging("manual review_end", quiet=quiet)
 
         #: finalizing files and further clustering
@@ -143,39 +194,56 @@ def main_mqrdb(args):
         for id in v_loop:
 
             logging("finalize_loop_start", id=id, quiet=quiet)
-            cluster_loop(
-                         id,
-                         run_label,
-                         qc_sequence_quality,
-                         gene_marker,
-                         cpu
-                        )
+            with span("cluster_loop", id=id, label=run_label):
+                cluster_loop(
+                             id,
+                             run_label,
+                             qc_sequence_quality,
+                             gene_marker,
+                             cpu,
+                             resume=resume
+                            )
             logging("finalize_loop_end", id=id, quiet=quiet)
 
         logging("finalize_end", quiet=quiet)
 
         #: creating the database
         logging("make db_start", quiet=quiet)
-        make_db(run_label, qc_limited_clusters, qc_taxonomy_quality)
+        with span("make_db", label=run_label):
+            make_db(
+                    run_label,
+                    qc_limited_clusters,
+                    qc_taxonomy_quality,
+                    compress=args.opt_compress or ""
+                    )
         logging("make db_end", quiet=quiet)
 
         #: cleans up intermediate files after process
         cleanup("md", args.opt_keep, run_label)
 
         #: making HMMs
-        tree_file = f"{Path(return_proj_path(run_label)).parent}/mqr.tree"
+        tree_file = resolve_db_file(
+            f"{Path(return_proj_path(run_label)).parent}/mqr.tree"
+        )
         mode = args.opt_mode
         logging("make hmms_start", quiet=quiet)
-        make_hmms(
-                 mode,
-                 tree_file,
-                 run_label,
-                 limit_entries,
-                 max_limit,
-                 seq_id=str(args.opt_con_seq_id),
-                 seq_db=args.opt_con_seq_db,
-                 cpu=cpu
-                 )
+        with span("make_hmms", mode=mode, label=run_label):
+            usage = make_hmms(
+                     mode,
+                     tree_file,
+                     run_label,
+                     limit_entries,
+                     max_limit,
+                     seq_id=str(args.opt_con_seq_id),
+                     seq_db=args.opt_con_seq_db,
+                     cpu=cpu,
+                     cap_seed=args.opt_cap_seed,
+                     cap_stratified=args.opt_cap_stratified,
+                     align_cache=args.opt_align_cache,
+                     slice_regions=args.opt_slice_regions,
+                     slice_report=args.opt_slice_report
+                     )
+        logging("make hmms_usage", id=f"{usage:.1%}", quiet=quiet)
         logging("make hmms_end", quiet=quiet)
 
         #: cleans up intermediate files after process
@@ -193,6 +261,9 @@ def main_mqrdb(args):
         path = return_proj_path(run_label)
         if args.opt_exclude_all:
             exclude_all = True
+        resume = args.opt_resume
+        if resume:
+            logging("resume", quiet=quiet)
 
         #: initializing quality check options
         qc_limited_clusters = False
@@ -221,7 +292,7 @@ def main_mqrdb(args):
 
         #: manual review of flag file and creation of corrected repr file
         logging("manual review_start", quiet=quiet)
-        flag_correction(str_id, exclude_all)
+        run_flag_correction(str_id, run_label, exclude_all, resume)
         logging("manual review_end", quiet=quiet)
 
         #: finalizing files and further clustering
@@ -233,20 +304,28 @@ def main_mqrdb(args):
         for id in v_loop:
 
             logging("finalize_loop_start", id=id, quiet=quiet)
-            cluster_loop(
-                         id,
-                         run_label,
-                         qc_sequence_quality,
-                         gene_marker,
-                         cpu
-                        )
+            with span("cluster_loop", id=id, label=run_label):
+                cluster_loop(
+                             id,
+                             run_label,
+                             qc_sequence_quality,
+                             gene_marker,
+                             cpu,
+                             resume=resume
+                            )
             logging("finalize_loop_end", id=id, quiet=quiet)
 
         logging("finalize_end", quiet=quiet)
 
         #: creating the database
         logging("make db_start", quiet=quiet)
-        make_db(run_label, qc_limited_clusters, qc_taxonomy_quality)
+        with span("make_db", label=run_label):
+            make_db(
+                    run_label,
+                    qc_limited_clusters,
+                    qc_taxonomy_quality,
+                    compress=args.opt_compress or ""
+                    )
         logging("make db_end", quiet=quiet)
 
         #: cleans up intermediate files after process
@@ -259,7 +338,9 @@ def main_mqrdb(args):
         run_label = ''
         if args.opt_label:
             run_label = args.opt_label
-        tree_file = f"{Path(return_proj_path(run_label)).parent}/mqr.tree"
+        tree_file = resolve_db_file(
+            f"{Path(return_proj_path(run_label)).parent}/mqr.tree"
+        )
         mode = args.opt_mode
 
         #: defaults for limiting max entries in HMM alignments
@@ -273,16 +354,24 @@ def main_mqrdb(args):
                 max_limit = 100000
 
         logging("make hmms_start", quiet=quiet)
-        make_hmms(
-                 mode,
-                 tree_file,
-                 run_label,
-                 limit_entries,
-                 max_limit,
-                 seq_id=str(args.opt_con_seq_id),
-                 seq_db=args.opt_con_seq_db,
-                 cpu=cpu
-                 )
+        with span("make_hmms", mode=mode, label=run_label):
+            usage = make_hmms(
+                     mode,
+                     tree_file,
+                     run_label,
+                     limit_entries,
+                     max_limit,
+                     seq_id=str(args.opt_con_seq_id),
+                     seq_db=args.opt_con_seq_db,
+                     cpu=cpu,
+                     cap_seed=args.opt_cap_seed,
+                     cap_stratified=args.opt_cap_stratified,
+                     delta=args.opt_hmm_delta,
+                     align_cache=args.opt_align_cache,
+                     slice_regions=args.opt_slice_regions,
+                     slice_report=args.opt_slice_report
+                     )
+        logging("make hmms_usage", id=f"{usage:.1%}", quiet=quiet)
         logging("make hmms_end", quiet=quiet)
 
         #: cleans up intermediate files after process
@@ -315,12 +404,12 @@ def main_mqrdb(args):
             db_file = args.opt_cvfile
             check_fasta_file(db_file)  # error checks file
 
-            #: formatting if another format is used in the database
-            if args.opt_format:
-                db_file = format_file(db_file, args.opt_format)
-
         if args.opt_evalprop:
-            eval_prop = args.opt_evalprop
+            eval_prop = float(args.opt_evalprop)
+
+        folds = 1
+        if args.opt_folds:
+            folds = args.opt_folds
 
         if args.opt_exclude_all:
             exclude_all = True
@@ -348,21 +437,28 @@ def main_mqrdb(args):
                 max_limit = 100000
 
         logging("cross val_start", quiet=quiet)
-        cross_validation(
-                        run_label,
-                        hmm_mode,
-                        eval_prop,
-                        db_file,
-                        qc_limited_clusters,
-                        qc_taxonomy_quality,
-                        qc_sequence_quality,
-                        limit_entries,
-                        max_limit,
-                        exclude_all,
-                        quiet,
-                        keep,
-                        cpu
-                        )
+        with span("cross_validation", label=run_label, folds=folds):
+            cross_validation(
+                            run_label,
+                            hmm_mode,
+                            eval_prop,
+                            db_file,
+                            qc_limited_clusters,
+                            qc_taxonomy_quality,
+                            qc_sequence_quality,
+                            limit_entries,
+                            max_limit,
+                            args.opt_cap_seed,
+                            args.opt_cap_stratified,
+                            args.opt_align_cache,
+                            exclude_all,
+                            quiet,
+                            keep,
+                            cpu,
+                            folds=folds,
+                            repeated_holdout=args.opt_repeated_holdout,
+                            db_format=args.opt_format or ""
+                            )
         logging("cross val_end", quiet=quiet)
 
     #: running the add new sequences method
@@ -373,13 +469,45 @@ def main_mqrdb(args):
         db = args.opt_addseq
         check_fasta_file(db)
 
-        if args.opt_format:
-            db = format_file(db, args.opt_format)
-
         logging("add entries_start", quiet=quiet)
-        add_entries(db, run_label, cpu)
+        with span("add_entries", label=run_label):
+            add_entries(
+                        db,
+                        run_label,
+                        cpu,
+                        keep_index=args.opt_keep_index,
+                        format=args.opt_format or ""
+                        )
         logging("add entries_end", quiet=quiet)
 
+    #: running the benchmark on a synthetic database
+    if args.opt_benchmark:
+        error_check(args)
+        check_installation(args)
+
+        #: defaults
+        bench_seqs = 2000
+        bench_depth = 6
+        bench_div = 0.04
+
+        if args.opt_bench_seqs:
+            bench_seqs = args.opt_bench_seqs
+        if args.opt_bench_depth:
+            bench_depth = args.opt_bench_depth
+        if args.opt_bench_div is not None:
+            bench_div = args.opt_bench_div
+
+        logging("benchmark_start", quiet=quiet)
+        run_benchmark(
+                      bench_seqs,
+                      bench_depth,
+                      bench_div,
+                      cpu,
+                      keep=args.opt_keep,
+                      quiet=quiet
+                      )
+        logging("benchmark_end", quiet=quiet)
+
     #: returns the license for MetaxaQR Database Builder
     if args.opt_license:
         print_license()
@@ -75,6 +75,12 @@ def create_parser():
                         action='store_true', default=False,
                         help="""Keeps intermediate files after run""")
 
+    parser.add_argument('--resume', dest='opt_resume',
+                        action='store_true', default=False,
+                        help="""Resumes an interrupted -m or -m_d run, skipping
+                        all stages already finished according to the run
+                        manifest""")
+
     parser.add_argument('--exclude_all_flags', dest='opt_exclude_all',
                         action='store_true', default=False,
                         help="""Skips the manual review step by excluding all
@@ -90,6 +96,41 @@ def create_parser():
                         help="""Specify maximum number of entries per alignment
                         when creating HMMs)""")
 
+    parser.add_argument('--hmm_cap_seed', dest='opt_cap_seed',
+                        type=int, metavar='',
+                        help="""Seed of the random sampling of capped
+                        alignments, makes the capped HMMs reproducible""")
+
+    parser.add_argument('--hmm_cap_stratified', dest='opt_cap_stratified',
+                        action='store_true', default=False,
+                        help="""Spread the entries of capped alignments over
+                        the 100%% clusters of every cluster, instead of
+                        sampling the cluster as a whole""")
+
+    parser.add_argument('--hmm_delta', dest='opt_hmm_delta',
+                        action='store_true', default=False,
+                        help="""Only rebuild the HMMs of clusters that changed
+                        since the last -m_h build, e.g. after -a""")
+
+    parser.add_argument('--align_cache', dest='opt_align_cache',
+                        type=int, metavar='', default=0,
+                        help="""Keeps the MAFFT alignments in
+                        metaxaQR_db/alignment_cache/, shared by all runs,
+                        up to this size in MB, 0 disables the cache
+                        (default=0)""")
+
+    parser.add_argument('--hmm_slice_regions', dest='opt_slice_regions',
+                        action='store_true', default=False,
+                        help="""Hybrid and conserved modes, build the HMMs from
+                        the conserved regions sliced out of the cluster
+                        alignment, without aligning them again""")
+
+    parser.add_argument('--hmm_slice_report', dest='opt_slice_report',
+                        action='store_true', default=False,
+                        help="""Hybrid and conserved modes, report the MAFFT
+                        time of the realignments and their agreement with
+                        the sliced alignments""")
+
     parser.add_argument('-m_h', dest='opt_makehmms',
                         action='store_true', default=False,
                         help="""Creates HMMs from a MetaxaQR Database""")
@@ -139,11 +180,65 @@ def create_parser():
                         type=str, metavar='',
                         help="""FASTA file used for cross validation""")
 
+    parser.add_argument('--folds', dest='opt_folds',
+                        type=int, metavar='',
+                        help="""Number of cross validation folds, run
+                        concurrently (default 1)""")
+
+    parser.add_argument('--repeated_holdout', dest='opt_repeated_holdout',
+                        action='store_true', default=False,
+                        help="""Uses a new random test set of
+                        --eval_proportion for every fold instead of k
+                        disjoint folds""")
+
     parser.add_argument('-a', dest='opt_addseq', type=str,
                         metavar='',
                         help="""Reads FASTA format file of new entries and adds
                         to a finished database""")
 
+    parser.add_argument('--keep_index', dest='opt_keep_index',
+                        action='store_true', default=False,
+                        help="""Stores the index of the finished database next
+                        to mqr.fasta, reused by later -a runs""")
+
+    parser.add_argument('--benchmark', dest='opt_benchmark',
+                        action='store_true', default=False,
+                        help="""Runs all steps on a synthetic database using
+                        stand-in tools, reporting time and resources used by
+                        every stage""")
+
+    parser.add_argument('--benchmark_seqs', dest='opt_bench_seqs',
+                        type=int, metavar='',
+                        help="""Number of entries in the synthetic database
+                        (default 2000)""")
+
+    parser.add_argument('--benchmark_depth', dest='opt_bench_depth',
+                        type=int, metavar='',
+                        help="""Number of taxonomic ranks in the synthetic
+                        database (default 6)""")
+
+    parser.add_argument('--benchmark_divergence', dest='opt_bench_div',
+                        type=float, metavar='',
+                        help="""Sequence divergence per taxonomic rank in the
+                        synthetic database (default 0.04)""")
+
+    parser.add_argument('--previous_label', dest='opt_previous', type=str,
+                        metavar='',
+                        help="""Label of a previous build, reusing the
+                        representative taxonomies and review decisions of all
+                        unchanged clusters""")
+
+    parser.add_argument('--telemetry', dest='opt_telemetry', type=str,
+                        metavar='',
+                        help="""Writes time and resources used by every stage
+                        and sub-stage as JSON lines to the given file""")
+
+    parser.add_argument('--compress_output', dest='opt_compress', type=str,
+                        metavar='', choices=['gz', 'zst'],
+                        help="""Writes mqr.fasta, mqr.repr and mqr.tree block
+                        compressed with an index for random access
+                        {gz, zst}""")
+
     parser.add_argument('--quiet', dest='opt_quiet',
                         action='store_true', default=False,
                         help="""No status print out""")
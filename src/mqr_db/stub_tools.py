@@ -0,0 +1,255 @@
+"""Deterministic stand-ins for VSEARCH, MAFFT, hmmbuild and hmmpress, used by
+the benchmark (--benchmark) to run all steps without the real tools. Only the
+options and output files used by MetaxaQR Database Builder are supported, the
+output is in the same format but not biologically meaningful. Run as a
+script: stub_tools.py {vsearch, mafft, hmmbuild, hmmpress} [options]
+"""
+
+import sys
+
+#: k-mer size used to estimate sequence identity
+kmer_size = 8
+
+
+def read_fasta(file):
+    """Reads a FASTA file into a list of (header, sequence), header without
+    the '>'. The file '-' is read from standard input.
+    """
+    records = []
+    header = None
+    sequence = []
+
+    with open(sys.stdin.fileno() if file == "-" else file, 'r') as f:
+        for line in f:
+            curr_line = line.rstrip("\n")
+            if curr_line[:1] == ">":
+                if header is not None:
+                    records.append((header, "".join(sequence)))
+                header = curr_line[1:]
+                sequence = []
+            elif curr_line:
+                sequence.append(curr_line.strip())
+
+    if header is not None:
+        records.append((header, "".join(sequence)))
+
+    return records
+
+
+def wrap(sequence, width):
+    """Returns the sequence split into lines of width.
+    """
+    return "\n".join(
+        [sequence[i:i+width] for i in range(0, len(sequence), width)]
+    )
+
+
+def get_option(args, names, default=None):
+    """Returns the value following the first of the option names found.
+    """
+    for name in names:
+        if name in args:
+            return args[args.index(name)+1]
+
+    return default
+
+
+def get_kmers(sequence):
+    """Returns the set of k-mers of a sequence.
+    """
+    return {
+        sequence[i:i+kmer_size]
+        for i in range(len(sequence) - kmer_size + 1)
+    }
+
+
+def kmer_identity(query, target, query_len, target_len):
+    """Estimates the identity of two sequences from their shared k-mers, a
+    mismatch removes up to kmer_size k-mers. Identical sequences have
+    identity 1.0.
+    """
+    if query == target:
+        return 1.0
+    if not query or not target:
+        return 0.0
+
+    shared = len(query & target) / max(len(query), len(target))
+    shared *= min(query_len, target_len) / max(query_len, target_len)
+
+    return min(shared ** (1 / kmer_size), 0.999)
+
+
+def vsearch(args):
+    """Clustering (--cluster_fast, --cluster_smallmem) writing the uc,
+    centroids and log files, or searching (--usearch_global) writing the
+    blast6out file.
+    """
+    if "--usearch_global" in args:
+        vsearch_search(args)
+        return
+
+    database = get_option(args, ["--cluster_fast", "--cluster_smallmem"])
+    identity = float(get_option(args, ["--id"]))
+    records = read_fasta(database)
+
+    order = list(range(len(records)))
+    #: cluster_fast sorts by length, cluster_smallmem uses the input order
+    #: which has to be sorted by length
+    if "--cluster_fast" in args:
+        order.sort(key=lambda i: -len(records[i][1]))
+    elif any(
+        len(records[i][1]) < len(records[i+1][1])
+        for i in range(len(records) - 1)
+    ):
+        sys.exit("Fatal error: Sequences not sorted by length and "
+                 "--usersort not specified.")
+
+    centroids = []
+    centroid_kmers = []
+    exact = {}
+    members = []
+    uc_lines = []
+
+    for i in order:
+        header, sequence = records[i]
+        hit = exact.get(sequence, -1)
+        perc = 100.0
+
+        #: compares with all centroids unless an identical one exists
+        if hit < 0 and identity < 1.0:
+            kmers = get_kmers(sequence)
+            best = 0.0
+            for c in range(len(centroids)):
+                curr_ident = kmer_identity(
+                    kmers,
+                    centroid_kmers[c],
+                    len(sequence),
+                    len(records[centroids[c]][1])
+                )
+                if curr_ident >= identity and curr_ident > best:
+                    best = curr_ident
+                    hit = c
+            perc = best * 100
+
+        if hit < 0:
+            cluster = len(centroids)
+            centroids.append(i)
+            members.append([i])
+            exact.setdefault(sequence, cluster)
+            if identity < 1.0:
+                centroid_kmers.append(get_kmers(sequence))
+            uc_lines.append(
+                f"S\t{cluster}\t{len(sequence)}\t*\t*\t*\t*\t*\t{header}\t*"
+            )
+        else:
+            members[hit].append(i)
+            uc_lines.append(
+                f"H\t{hit}\t{len(sequence)}\t{perc:.1f}\t+\t0\t0\t"
+                f"{len(sequence)}M\t{header}\t{records[centroids[hit]][0]}"
+            )
+
+    for cluster, i in enumerate(centroids):
+        uc_lines.append(
+            f"C\t{cluster}\t{len(members[cluster])}\t*\t*\t*\t*\t*\t"
+            f"{records[i][0]}\t*"
+        )
+
+    with open(get_option(args, ["--uc"]), 'w') as f:
+        for line in uc_lines:
+            f.write(f"{line}\n")
+
+    centroids_file = get_option(args, ["--centroids"])
+    if centroids_file:
+        with open(centroids_file, 'w') as f:
+            for i in centroids:
+                f.write(f">{records[i][0]}\n{wrap(records[i][1], 80)}\n")
+
+    log_file = get_option(args, ["--log"])
+    if log_file:
+        with open(log_file, 'w') as f:
+            f.write(f"stub vsearch {len(records)} {len(centroids)}\n")
+
+
+def vsearch_search(args):
+    """Searches every query against the database, writing the best hit at or
+    above the identity to the blast6out file.
+    """
+    queries = read_fasta(get_option(args, ["--usearch_global"]))
+    database = read_fasta(get_option(args, ["-db", "--db"]))
+    identity = float(get_option(args, ["-id", "--id"]))
+    db_kmers = [get_kmers(sequence) for _, sequence in database]
+
+    with open(get_option(args, ["-blast6out", "--blast6out"]), 'w') as f:
+        for header, sequence in queries:
+            kmers = get_kmers(sequence)
+            best = 0.0
+            hit = -1
+            for i in range(len(database)):
+                curr_ident = kmer_identity(
+                    kmers,
+                    db_kmers[i],
+                    len(sequence),
+                    len(database[i][1])
+                )
+                if curr_ident >= identity and curr_ident > best:
+                    best = curr_ident
+                    hit = i
+
+            if hit >= 0:
+                query_id = header.split()[0]
+                target_id = database[hit][0].split()[0]
+                f.write(f"{query_id}\t{target_id}\t{best*100:.1f}"
+                        + "\t0" * 9 + "\n")
+
+
+def mafft(args):
+    """Aligns by padding all sequences with gaps to the longest sequence,
+    writing the alignment to stdout. --version writes the version to
+    stderr, as MAFFT does.
+    """
+    if "--version" in args:
+        sys.stderr.write("v7.000 (stub)\n")
+        return
+
+    records = read_fasta(args[-1])
+    align_len = max([len(sequence) for _, sequence in records] + [0])
+
+    for header, sequence in records:
+        aligned = sequence.ljust(align_len, "-")
+        sys.stdout.write(f">{header}\n{wrap(aligned, 60)}\n")
+
+
+def hmmbuild(args):
+    """Writes a minimal HMM file named by -n, with the alignment length and
+    number of sequences.
+    """
+    name = get_option(args, ["-n"])
+    hmm_file, align_file = args[-2], args[-1]
+    records = read_fasta(align_file)
+    align_len = 0
+    if records:
+        align_len = len(records[0][1])
+
+    with open(hmm_file, 'w') as f:
+        f.write(f"HMMER3/f [stub]\nNAME  {name}\nLENG  {align_len}\n"
+                f"NSEQ  {len(records)}\n//\n")
+
+
+def hmmpress(args):
+    """Writes the four pressed database files.
+    """
+    for ext in ["h3m", "h3i", "h3f", "h3p"]:
+        with open(f"{args[-1]}.{ext}", 'w') as f:
+            f.write("stub\n")
+
+
+tools = {
+    "vsearch": vsearch,
+    "mafft": mafft,
+    "hmmbuild": hmmbuild,
+    "hmmpress": hmmpress
+}
+
+
+if __name__ == "__main__":
+    tools[sys.argv[1]](sys.argv[2:])
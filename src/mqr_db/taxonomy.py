@@ -0,0 +1,145 @@
+"""Taxonomies interned into a trie. Every category of a taxonomy is a node
+with an integer id, found by its parent node and the id of its name, so equal
+taxonomies, and equal categories above them, are the same node. A cluster is
+then a list of the leaf ids of its entries, every taxonomy string is split
+only once and taxonomies are compared as integers.
+"""
+
+#: origins of the origin flag, in the order they are checked
+origins = ["Archaea", "Bacteria", "Chloroplast", "Eukaryota", "Mitochondria"]
+no_origin = len(origins)
+
+undef = 'undefined taxonomy'
+
+
+class TaxonomyTrie:
+    """Trie of interned taxonomies. Node 0 is the root (empty taxonomy), the
+    parent, name id and depth (number of categories) of every node are kept
+    in lists indexed by node id. The origin of a node, the first of origins
+    found in its taxonomy, and whether the taxonomy is undefined are set
+    when the node is added.
+    """
+    def __init__(self):
+        self.names = []
+        self.name_ids = {}
+        self.parents = [-1]
+        self.name_of = [-1]
+        self.depths = [0]
+        self.origins = [no_origin]
+        self.undefined = [False]
+        self.children = {}
+        self.leaves = {}
+        self.paths = {}
+        self.strings = {0: ""}
+        self.word_counts = {}
+        self.cut_species = {}
+
+    def name_id(self, name):
+        """Returns the id of a name, adding it if new.
+        """
+        nid = self.name_ids.get(name)
+        if nid is None:
+            nid = len(self.names)
+            self.names.append(name)
+            self.name_ids[name] = nid
+
+        return nid
+
+    def child(self, parent, name):
+        """Returns the node of category name below parent, adding it if new.
+        """
+        nid = self.name_id(name)
+        node = self.children.get((parent, nid))
+        if node is None:
+            node = len(self.parents)
+            self.children[(parent, nid)] = node
+            self.parents.append(parent)
+            self.name_of.append(nid)
+            self.depths.append(self.depths[parent] + 1)
+            origin = self.origins[parent]
+            if name in origins:
+                origin = min(origin, origins.index(name))
+            self.origins.append(origin)
+            self.undefined.append(self.undefined[parent] or name == undef)
+
+        return node
+
+    def leaf(self, tax):
+        """Returns the leaf node of a taxonomy string (categories split by
+        ';'), the string is only split the first time it is seen.
+        """
+        node = self.leaves.get(tax)
+        if node is None:
+            node = 0
+            for name in tax.split(";"):
+                node = self.child(node, name)
+            self.leaves[tax] = node
+
+        return node
+
+    def name(self, node):
+        """Returns the name of the last category of a node.
+        """
+        return self.names[self.name_of[node]]
+
+    def path(self, node):
+        """Returns the nodes of all categories of a node, highest first.
+        """
+        path = self.paths.get(node)
+        if path is None:
+            path = []
+            curr = node
+            while curr:
+                path.append(curr)
+                curr = self.parents[curr]
+            path = path[::-1]
+            self.paths[node] = path
+
+        return path
+
+    def contains(self, node, nid):
+        """Checks if name id is one of the categories of a node.
+        """
+        while node:
+            if self.name_of[node] == nid:
+                return True
+            node = self.parents[node]
+
+        return False
+
+    def string(self, node):
+        """Returns the taxonomy string of a node.
+        """
+        tax = self.strings.get(node)
+        if tax is None:
+            tax = ";".join([self.name(n) for n in self.path(node)])
+            self.strings[node] = tax
+
+        return tax
+
+    def words(self, node):
+        """Returns the number of words (split by spaces) in the last category
+        of a node.
+        """
+        nid = self.name_of[node]
+        count = self.word_counts.get(nid)
+        if count is None:
+            count = len(self.names[nid].split(" "))
+            self.word_counts[nid] = count
+
+        return count
+
+    def species(self, node, words):
+        """Returns the node of a taxonomy with the last category (species)
+        cut to its first words.
+        """
+        cut = self.cut_species.get((node, words))
+        if cut is None:
+            if self.words(node) <= words:
+                cut = node
+            else:
+                sp_name = " ".join(self.name(node).split(" ")[:words])
+                cut = self.child(self.parents[node], sp_name)
+            self.cut_species[(node, words)] = cut
+
+        return cut
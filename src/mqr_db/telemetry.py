@@ -0,0 +1,153 @@
+"""Telemetry, structured spans around the stages and sub-stages of a run,
+written as JSON lines when enabled by --telemetry. Every span records its
+duration, CPU time of the process and of the external tools it ran, peak RSS,
+bytes read/written and item counts (clusters, entries, HMMs...). The file and
+the current span are passed on to worker processes through the environment.
+"""
+
+import itertools
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+#: environment variables holding the telemetry file and the open span
+file_env = "MQR_TELEMETRY"
+parent_env = "MQR_TELEMETRY_PARENT"
+
+#: spans open in this process, innermost last
+span_stack = []
+span_numbers = itertools.count()
+
+
+def enable_telemetry(file):
+    """Enables telemetry for this process and all processes started by it,
+    spans are appended to file.
+    """
+    os.environ[file_env] = os.path.abspath(file)
+
+
+def telemetry_file():
+    """Returns the telemetry file, empty string if telemetry is not enabled.
+    """
+    return os.environ.get(file_env, "")
+
+
+def read_io_bytes():
+    """Returns the bytes read and written by this process and its finished
+    child processes, from /proc/self/io if available, otherwise from the
+    block counts of getrusage.
+    """
+    try:
+        io_stats = {}
+        with open("/proc/self/io", 'r') as f:
+            for line in f:
+                key, value = line.split(":")
+                io_stats[key] = int(value)
+        return io_stats["rchar"], io_stats["wchar"]
+
+    except (OSError, KeyError, ValueError):
+        usage_self = resource.getrusage(resource.RUSAGE_SELF)
+        usage_child = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return (
+            (usage_self.ru_inblock + usage_child.ru_inblock) * 512,
+            (usage_self.ru_oublock + usage_child.ru_oublock) * 512
+        )
+
+
+def resource_usage():
+    """Returns the CPU time, peak RSS (bytes) and bytes read/written so far of
+    this process and of its finished child processes.
+    """
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_child = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read_bytes, write_bytes = read_io_bytes()
+    #: ru_maxrss is in bytes on macOS, kilobytes elsewhere
+    rss_unit = 1 if sys.platform == "darwin" else 1024
+
+    return {
+        "cpu": usage_self.ru_utime + usage_self.ru_stime,
+        "child_cpu": usage_child.ru_utime + usage_child.ru_stime,
+        "max_rss": usage_self.ru_maxrss * rss_unit,
+        "child_max_rss": usage_child.ru_maxrss * rss_unit,
+        "read_bytes": read_bytes,
+        "write_bytes": write_bytes
+    }
+
+
+@contextmanager
+def span(name, **attrs):
+    """Measures the enclosed code as the span name, attrs are stored with it
+    (identity, cluster...). Yields the span record, filled in once the span
+    is closed. CPU time and bytes are the differences over the span, max_rss
+    and child_max_rss the peaks reached by the end of it. The record is
+    written to the telemetry file if telemetry is enabled.
+    """
+    out_file = telemetry_file()
+    parent = os.environ.get(parent_env)
+    if span_stack:
+        parent = span_stack[-1]["span_id"]
+
+    record = {
+        "span": name,
+        "span_id": f"{os.getpid()}.{next(span_numbers)}",
+        "parent_id": parent,
+        "pid": os.getpid(),
+        "attrs": attrs,
+        "counts": {}
+    }
+    span_stack.append(record)
+    if out_file:
+        os.environ[parent_env] = record["span_id"]
+
+    start_usage = resource_usage()
+    start_time = time.time()
+    start_counter = time.perf_counter()
+    try:
+        yield record
+
+    except BaseException as err:
+        record["error"] = type(err).__name__
+        raise
+
+    finally:
+        duration = time.perf_counter() - start_counter
+        end_usage = resource_usage()
+        span_stack.pop()
+        if out_file:
+            if parent is None:
+                os.environ.pop(parent_env, None)
+            else:
+                os.environ[parent_env] = parent
+
+        record["start"] = start_time
+        record["duration"] = duration
+        for key in ["cpu", "child_cpu", "read_bytes", "write_bytes"]:
+            record[key] = end_usage[key] - start_usage[key]
+        record["max_rss"] = end_usage["max_rss"]
+        record["child_max_rss"] = end_usage["child_max_rss"]
+
+        if out_file:
+            write_span(record, out_file)
+
+
+def add_count(key, value=1):
+    """Adds value to the item count key of the innermost open span.
+    """
+    if span_stack:
+        counts = span_stack[-1]["counts"]
+        counts[key] = counts.get(key, 0) + value
+
+
+def write_span(record, out_file):
+    """Appends the span as one JSON line, written in a single call so lines
+    from concurrent processes are not interleaved.
+    """
+    line = json.dumps(record, default=str) + "\n"
+    fd = os.open(out_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode())
+    finally:
+        os.close(fd)